@@ -0,0 +1,173 @@
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+
+# Allow running as `python Scripts/benchmark_ann.py` from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_handler import DBHandler, snapshot_path
+from embedding_snapshot import EmbeddingSnapshot
+
+_PAGE_SIZE = 1000
+
+
+def load_book_embeddings(book_id, collection_name="full_text_source"):
+    """
+    Returns a book's stored embeddings as a float32 matrix, from its snapshot
+    if it has one, otherwise from ChromaDB.
+    """
+    snapshot = EmbeddingSnapshot.load(snapshot_path(book_id, collection_name))
+    if snapshot is not None and snapshot.live_count:
+        return snapshot.live_vectors()[1]
+
+    db_handler = DBHandler(book_id=book_id)
+    try:
+        collection = getattr(db_handler, collection_name)
+        pages = []
+        for offset in range(0, collection.count(), _PAGE_SIZE):
+            rows = collection.get(include=["embeddings"], limit=_PAGE_SIZE, offset=offset)
+            pages.append(np.asarray(rows["embeddings"], dtype=np.float32))
+    finally:
+        db_handler.close()
+    return np.concatenate(pages) if pages else np.zeros((0, 0), dtype=np.float32)
+
+
+def synthetic_embeddings(count, dim=384, clusters=64, seed=0):
+    """
+    Returns normalized vectors drawn around random cluster centres, which is
+    closer to real sentence embeddings than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    vectors = centres[rng.integers(clusters, size=count)] + 0.5 * rng.normal(size=(count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def exact_top_k(vectors, queries, k, space):
+    """
+    Returns the true top-k row indices of each query, by brute force.
+    """
+    if space == "l2":
+        scores = -(np.einsum("ij,ij->i", vectors, vectors)[None, :] - 2 * queries @ vectors.T)
+    elif space == "cosine":
+        normed = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        scores = queries @ normed.T
+    else:
+        scores = queries @ vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000
+
+
+def build_index(db_handler, vectors, space, m, construction_ef):
+    """
+    Builds an HNSW collection over vectors in the handler's store.
+
+    Returns:
+        (collection, build seconds)
+    """
+    client = db_handler.client
+    collection = client.create_collection(
+        name=f"bench-{uuid.uuid4().hex[:12]}",
+        metadata={"hnsw:space": space, "hnsw:M": m, "hnsw:construction_ef": construction_ef},
+        embedding_function=db_handler.embedding_function
+    )
+    ids = [str(i) for i in range(len(vectors))]
+    batch_size = client.get_max_batch_size()
+    started = time.perf_counter()
+    for start in range(0, len(vectors), batch_size):
+        collection.add(ids=ids[start:start + batch_size], embeddings=vectors[start:start + batch_size])
+    return collection, time.perf_counter() - started
+
+
+def measure(collection, queries, truth, k):
+    """
+    Returns recall@k and p50/p99 query latency for a built collection.
+    """
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        result = collection.query(query_embeddings=[query], n_results=k, include=[])
+        latencies.append(time.perf_counter() - started)
+        hits += len(expected & {int(i) for i in result["ids"][0]})
+    return {
+        "recall": hits / (k * len(queries)),
+        "p50_ms": percentile_ms(latencies, 50),
+        "p99_ms": percentile_ms(latencies, 99),
+    }
+
+
+def benchmark_exact(vectors, queries, k, space):
+    """
+    Measures exact search over an EmbeddingSnapshot, the baseline every HNSW setting is compared with.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot = EmbeddingSnapshot.create(os.path.join(tmp_dir, "snapshot"), vectors.shape[1], space=space)
+        snapshot.upsert([str(i) for i in range(len(vectors))], vectors, [""] * len(vectors), [None] * len(vectors))
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            snapshot.query([query], n_results=k)
+            latencies.append(time.perf_counter() - started)
+        snapshot.close()
+    return {"p50_ms": percentile_ms(latencies, 50), "p99_ms": percentile_ms(latencies, 99)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure HNSW recall@k and query latency against exact search.")
+    parser.add_argument("--book", help="Benchmark on this book's stored full_text_source embeddings")
+    parser.add_argument("--synthetic", type=int, default=20000, help="Number of synthetic vectors when no book is given")
+    parser.add_argument("--queries", type=int, default=200, help="Number of held-out query vectors")
+    parser.add_argument("--k", type=int, default=10, help="Results per query (recall@k)")
+    parser.add_argument("--space", default="l2", choices=["l2", "cosine", "ip"], help="Distance function")
+    parser.add_argument("--m", type=int, nargs="+", default=[16, 32], help="Values of hnsw:M to try")
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[100, 200], help="Values of hnsw:construction_ef to try")
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[10, 50, 100, 200], help="Values of hnsw:search_ef to try")
+    args = parser.parse_args(argv)
+
+    vectors = load_book_embeddings(args.book) if args.book else synthetic_embeddings(args.synthetic + args.queries)
+    if len(vectors) <= args.queries:
+        print(f"Not enough vectors to benchmark ({len(vectors)})")
+        return
+
+    # Hold the queries out of the index, perturbed so they aren't exact duplicates of anything
+    rng = np.random.default_rng(1)
+    order = rng.permutation(len(vectors))
+    queries = vectors[order[:args.queries]] + 0.01 * rng.normal(size=(args.queries, vectors.shape[1])).astype(np.float32)
+    vectors = np.ascontiguousarray(vectors[order[args.queries:]])
+    truth = exact_top_k(vectors, queries, args.k, args.space)
+    print(f"Benchmarking {len(vectors)} vectors x {vectors.shape[1]} dims, {len(queries)} queries, k={args.k}, space={args.space}")
+
+    exact = benchmark_exact(vectors, queries, args.k, args.space)
+    print(f"\n{'M':>4} {'constr_ef':>9} {'search_ef':>9} {'build_s':>8} {'recall':>7} {'p50_ms':>7} {'p99_ms':>7}")
+    print(f"{'exact (snapshot)':>32} {'':>8} {1.0:>7.3f} {exact['p50_ms']:>7.2f} {exact['p99_ms']:>7.2f}")
+
+    # A scratch store, so search_ef is changed exactly as DBHandler.set_search_ef does for real books
+    db_handler = DBHandler(book_id=f"ann-benchmark-{uuid.uuid4().hex[:8]}")
+    try:
+        for m, construction_ef in itertools.product(args.m, args.construction_ef):
+            collection, build_seconds = build_index(db_handler, vectors, args.space, m, construction_ef)
+            try:
+                # search_ef only affects queries, so one build serves every value
+                for search_ef in args.search_ef:
+                    collection = db_handler.set_search_ef(collection, search_ef)
+                    result = measure(collection, queries, truth, args.k)
+                    print(f"{m:>4} {construction_ef:>9} {search_ef:>9} {build_seconds:>8.1f} "
+                          f"{result['recall']:>7.3f} {result['p50_ms']:>7.2f} {result['p99_ms']:>7.2f}")
+            finally:
+                db_handler.client.delete_collection(name=collection.name)
+    finally:
+        db_handler.close()
+        shutil.rmtree(db_handler.db_path, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
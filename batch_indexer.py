@@ -0,0 +1,157 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from db_handler import DBHandler
+from indexer import IndexManifest, index_document
+from chunker import DEFAULT_MODEL_PATH, load_chunker
+from embeddings import LocalEmbeddingFunction, DEFAULT_EMBED_BATCH_SIZE
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.epub')
+
+# Each indexing thread gets its own chunker, since tokenizers are not safe to share across threads
+_thread_state = threading.local()
+
+
+def _get_chunker(tokenizer_path):
+    if getattr(_thread_state, "tokenizer_path", None) != tokenizer_path:
+        _thread_state.chunker = load_chunker(tokenizer_path)
+        _thread_state.tokenizer_path = tokenizer_path
+    return _thread_state.chunker
+
+
+def find_books(directory):
+    """
+    Returns the paths of every PDF and EPUB under a directory, in sorted order.
+    """
+    books = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                books.append(os.path.join(root, name))
+    return sorted(books)
+
+
+def index_book(file_path, parallel=False, extract_workers=None, force=False, tokenizer_path=DEFAULT_MODEL_PATH, embedding_function=None):
+    """
+    Indexes a single book headlessly, the same way the GUI does.
+
+    Returns:
+        (book_id, stats), where stats is None if the book was already
+        completely indexed and has not changed since.
+    """
+    book_id = os.path.splitext(os.path.basename(file_path))[0]
+    db_handler = DBHandler(book_id=book_id, embedding_function=embedding_function)
+    try:
+        if not force and IndexManifest(db_handler.manifest_path).is_current(file_path, db_handler.full_text_source, db_handler.embedding_model_id):
+            return book_id, None
+
+        stats = index_document(
+            db_handler, file_path, book_id,
+            parallel=parallel, workers=extract_workers, chunker=_get_chunker(tokenizer_path)
+        )
+        return book_id, stats
+    finally:
+        # Release each book's client so a large library doesn't hold them all open
+        db_handler.close()
+
+
+def index_library(directory, workers=2, parallel=False, extract_workers=None, force=False, tokenizer_path=DEFAULT_MODEL_PATH, embedding_function=None):
+    """
+    Indexes every book in a directory, running `workers` books concurrently.
+
+    Embedding and SQLite writes release the GIL, so books are run on threads;
+    set parallel=True to also extract each PDF across worker processes.
+
+    Returns:
+        A dict mapping book_id to its IndexStats (None for skipped books).
+    """
+    books = find_books(directory)
+    print(f"Found {len(books)} books in {directory}")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(index_book, path, parallel, extract_workers, force, tokenizer_path, embedding_function): path
+            for path in books
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                book_id, stats = future.result()
+            except Exception as e:
+                print(f"Error indexing {path}: {e}")
+                continue
+            results[book_id] = stats
+            if stats is None:
+                print(f"Skipped '{book_id}' (already indexed)")
+            else:
+                print(
+                    f"Indexed '{book_id}': {stats.chunks_indexed} written, {stats.chunks_unchanged} unchanged, "
+                    f"{stats.chunks_removed} removed, {stats.chunks_failed} failed in {stats.elapsed:.1f}s"
+                )
+    return results
+
+
+def print_summary(results, wall_seconds):
+    """
+    Prints library-wide throughput for a batch run.
+    """
+    indexed = [stats for stats in results.values() if stats is not None]
+    skipped = len(results) - len(indexed)
+    pages = sum(stats.units_done for stats in indexed)
+    chunks = sum(stats.chunks_indexed for stats in indexed)
+    failed = sum(stats.chunks_failed for stats in indexed)
+    embed_seconds = sum(stats.embed_seconds for stats in indexed)
+    extract_seconds = sum(stats.extract_seconds for stats in indexed)
+    busy_seconds = embed_seconds + extract_seconds
+
+    print("\n--- Batch Indexing Summary ---")
+    print(f"Books: {len(indexed)} indexed, {skipped} skipped")
+    print(f"Pages/sections: {pages} ({pages / wall_seconds:.1f}/s)" if wall_seconds else f"Pages/sections: {pages}")
+    print(f"Chunks written: {chunks} ({chunks / wall_seconds:.1f}/s), {failed} failed" if wall_seconds else f"Chunks written: {chunks}, {failed} failed")
+    if busy_seconds:
+        print(f"Embedding/write time: {embed_seconds:.1f}s ({embed_seconds / busy_seconds:.0%})")
+        print(f"Extraction time: {extract_seconds:.1f}s ({extract_seconds / busy_seconds:.0%})")
+    print(f"Wall time: {wall_seconds:.1f}s")
+
+
+def main(argv=None):
+    """Headless entry point for indexing a whole library."""
+    default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DocSource")
+
+    parser = argparse.ArgumentParser(description="Index every PDF/EPUB in a directory without the GUI.")
+    parser.add_argument("directory", nargs="?", default=default_dir, help="Directory of books (default: DocSource)")
+    parser.add_argument("--workers", type=int, default=2, help="Number of books indexed concurrently")
+    parser.add_argument("--parallel-extract", action="store_true", help="Extract each PDF across worker processes")
+    parser.add_argument("--extract-workers", type=int, default=None, help="Processes per book for --parallel-extract")
+    parser.add_argument("--force", action="store_true", help="Re-check books even if their manifest is complete")
+    parser.add_argument("--tokenizer", default=DEFAULT_MODEL_PATH, help="Model directory whose tokenizer sizes the chunks")
+    parser.add_argument("--embed-batch-size", type=int, default=DEFAULT_EMBED_BATCH_SIZE, help="Texts per embedding model call")
+    parser.add_argument("--embed-threads", type=int, default=None, help="Intra-op threads for the embedding model")
+    parser.add_argument("--quantized", action="store_true", help="Embed with an int8-quantized ONNX model")
+    args = parser.parse_args(argv)
+
+    # One embedding backend shared by every book, so the model is loaded once
+    embedding_function = LocalEmbeddingFunction(
+        batch_size=args.embed_batch_size,
+        intra_op_threads=args.embed_threads,
+        quantized=args.quantized
+    )
+
+    started = time.perf_counter()
+    results = index_library(
+        args.directory,
+        workers=args.workers,
+        parallel=args.parallel_extract,
+        extract_workers=args.extract_workers,
+        force=args.force,
+        tokenizer_path=args.tokenizer,
+        embedding_function=embedding_function
+    )
+    print_summary(results, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
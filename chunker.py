@@ -0,0 +1,109 @@
+import os
+import re
+
+# The local LLM. Its tokenizer sizes the chunks, and the app and CLIs generate with it
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_models", "gemma-3n-E2B-it")
+# Default chunk size and overlap, in tokens of the LLM tokenizer
+DEFAULT_TARGET_TOKENS = 256
+DEFAULT_OVERLAP_TOKENS = 32
+
+# Fallback tokenization when no LLM tokenizer is available: words and
+# individual punctuation marks, which tracks subword token counts closely enough
+_APPROX_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SEGMENT_BREAK_RE = re.compile(r"\n\s*\n")
+
+
+class TextChunker:
+    """
+    Merges small text segments and splits large ones into chunks of roughly
+    `target_tokens` tokens, with `overlap_tokens` repeated between consecutive
+    chunks of the same unit (PDF page or EPUB section).
+
+    Chunk ends are snapped back to the nearest segment boundary (a PDF block
+    or EPUB paragraph) when one falls in the second half of the window, so
+    chunks rarely cut a paragraph in two.
+    """
+    def __init__(self, tokenizer=None, target_tokens=DEFAULT_TARGET_TOKENS, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+        if overlap_tokens >= target_tokens:
+            raise ValueError("overlap_tokens must be smaller than target_tokens")
+        self.tokenizer = tokenizer
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def _token_spans(self, text):
+        """
+        Returns the (start, end) character span of every token in the text.
+        """
+        if self.tokenizer is not None:
+            try:
+                encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+                return [(start, end) for start, end in encoding["offset_mapping"] if end > start]
+            except (NotImplementedError, TypeError, KeyError):
+                # Slow tokenizers can't report offsets; fall back to the approximation
+                pass
+        return [match.span() for match in _APPROX_TOKEN_RE.finditer(text)]
+
+    def chunk(self, text, segment_starts=None):
+        """
+        Splits a unit's text into token-bounded chunks.
+
+        Args:
+            text (str): The full text of the unit.
+            segment_starts (list): Character offsets where segments begin. Defaults
+                to the starts of blank-line separated paragraphs.
+
+        Returns:
+            A list of (chunk_text, char_start, char_end, token_count) tuples, where
+            text[char_start:char_end] == chunk_text.
+        """
+        spans = self._token_spans(text)
+        if not spans:
+            return []
+
+        if segment_starts is None:
+            segment_starts = [0] + [match.end() for match in _SEGMENT_BREAK_RE.finditer(text)]
+
+        # Token indices at which a new segment begins are the preferred chunk ends
+        breaks = set()
+        segment_iter = iter(sorted(segment_starts))
+        next_segment = next(segment_iter, None)
+        for i, (start, _) in enumerate(spans):
+            while next_segment is not None and next_segment <= start:
+                breaks.add(i)
+                next_segment = next(segment_iter, None)
+
+        chunks = []
+        start = 0
+        while start < len(spans):
+            end = min(start + self.target_tokens, len(spans))
+            if end < len(spans):
+                snapped = next((b for b in range(end, start + self.target_tokens // 2, -1) if b in breaks), None)
+                if snapped:
+                    end = snapped
+
+            char_start, char_end = spans[start][0], spans[end - 1][1]
+            chunks.append((text[char_start:char_end], char_start, char_end, end - start))
+
+            if end == len(spans):
+                break
+            start = max(end - self.overlap_tokens, start + 1)
+
+        return chunks
+
+
+def load_chunker(model_path, **kwargs):
+    """
+    Returns a TextChunker that counts tokens with the LLM tokenizer at model_path,
+    or the approximate tokenizer if the model is not available.
+
+    The GUI and the batch indexer must chunk identically, or the manifest
+    would see every chunk as changed, so both build their chunker here.
+    """
+    tokenizer = None
+    if os.path.isdir(model_path):
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        except Exception as e:
+            print(f"Error loading tokenizer for chunking, using approximate token counts: {e}")
+    return TextChunker(tokenizer=tokenizer, **kwargs)
@@ -1,34 +1,659 @@
 import chromadb
+from chromadb.utils import embedding_functions
+import hashlib
+import json
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from embedding_cache import get_shared_cache, normalize_text
+from embedding_snapshot import EmbeddingSnapshot
+from embeddings import MODEL_ID as EMBEDDING_MODEL_ID
+from lexical_index import BM25Index
+
+# Root directory holding one PersistentClient directory per book
+STORAGE_ROOT = "./chroma_storage"
+# Embedding cache shared by every book
+EMBEDDING_CACHE_PATH = os.path.join(STORAGE_ROOT, "embedding_cache.sqlite3")
+# ID of ChromaDB's default embedding model, used to key cached embeddings
+DEFAULT_EMBEDDING_MODEL_ID = EMBEDDING_MODEL_ID
+# Reciprocal rank fusion constant; damps the influence of the very top ranks
+RRF_K = 60
+# HNSW settings per collection, as ChromaDB collection metadata. full_text_source
+# can hold hundreds of thousands of chunks, so it gets a denser graph and a wider
+# search; the insight collections stay small and keep ChromaDB's defaults.
+# Space, construction_ef and M are fixed when a collection is created (see
+# `python main.py maintain --rebuild-index`); search_ef can change at any time.
+DEFAULT_HNSW_CONFIG = {
+    "full_text_source": {"hnsw:space": "l2", "hnsw:construction_ef": 200, "hnsw:search_ef": 100, "hnsw:M": 32},
+    "already_covered_db": {"hnsw:space": "l2", "hnsw:construction_ef": 100, "hnsw:search_ef": 10, "hnsw:M": 16},
+    "current_chapter_insights_db": {"hnsw:space": "l2", "hnsw:construction_ef": 100, "hnsw:search_ef": 10, "hnsw:M": 16},
+}
+_IMMUTABLE_HNSW_KEYS = ("hnsw:space", "hnsw:construction_ef", "hnsw:M")
+# Names of the HNSW settings in ChromaDB's newer collection configuration
+_HNSW_CONFIGURATION_KEYS = {
+    "space": "hnsw:space",
+    "ef_construction": "hnsw:construction_ef",
+    "ef_search": "hnsw:search_ef",
+    "max_neighbors": "hnsw:M",
+}
+# Version of the captured-insight ID scheme; existing rows are migrated once per version
+INSIGHT_ID_VERSION = 1
+# Marks captured rows written before their position (page_num/item_num, chapter) was recorded
+UNSCOPED_FIELD = "unscoped"
+
+
+def safe_book_id(book_id):
+    """
+    Sanitizes a book ID to be a valid directory name.
+    """
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', book_id)
+
+
+def list_books():
+    """
+    Returns the storage directory name of every book under STORAGE_ROOT.
+    """
+    if not os.path.isdir(STORAGE_ROOT):
+        return []
+    return sorted(
+        name for name in os.listdir(STORAGE_ROOT)
+        if os.path.isfile(os.path.join(STORAGE_ROOT, name, "chroma.sqlite3"))
+    )
+
+
+def manifest_path(book_id):
+    """
+    Returns the path of a book's content-hash manifest, next to its storage directory.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.manifest.jsonl")
+
+
+def lexical_index_path(book_id):
+    """
+    Returns the path of a book's BM25 index over full_text_source.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.bm25.json")
+
+
+def range_filter(field, start, end):
+    """
+    Returns a ChromaDB `where` filter matching start <= metadata[field] <= end.
+    """
+    return {"$and": [{field: {"$gte": start}}, {field: {"$lte": end}}]}
+
+
+def include_unscoped(where):
+    """
+    Widens a position filter on captured rows to also match rows marked
+    unscoped, which can't be placed in any window. Returns None for None.
+    """
+    if not where:
+        return where
+    return {"$or": [where, {UNSCOPED_FIELD: True}]}
+
+
+def snapshot_path(book_id, collection_name):
+    """
+    Returns the directory of a collection's memory-mapped embedding snapshot.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.{collection_name}.snapshot")
+
+
+def snapshot_pending_path(book_id, collection_name):
+    """
+    Returns the path of the marker that exists while a collection has writes
+    its snapshot doesn't have yet. A snapshot found with this marker after a
+    crash is out of date, even if its row count matches the collection.
+    """
+    return snapshot_path(book_id, collection_name) + ".pending"
+
+
+def insight_ids_marker_path(book_id):
+    """
+    Returns the path of the marker recording that a book's captured insights use content_id() IDs.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.insight_ids_v{INSIGHT_ID_VERSION}")
+
+
+def scope_fields_marker_path(book_id):
+    """
+    Returns the path of the marker recording that a book's captured rows without a position are marked unscoped.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.scope_fields_v1")
+
+
+def content_id(prefix, text):
+    """
+    Returns a stable ID for a piece of text, e.g. 'doc_3f2a9c...'.
+
+    Unlike hash(), which is salted per process, the digest is the same in
+    every session, and text that differs only in whitespace gets the same ID.
+    """
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()[:16]
+    return f"{prefix}_{digest}"
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results with a time-to-live.
+
+    Entries are keyed by (collection name, normalized query texts, n_results,
+    where filter). invalidate() drops every entry for one collection, and is
+    called whenever that collection is written to.
+    """
+    def __init__(self, max_entries=256, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(collection_name, query_texts, n_results, where=None):
+        normalized = tuple(" ".join(text.lower().split()) for text in query_texts)
+        where_key = json.dumps(where, sort_keys=True) if where else None
+        return (collection_name, normalized, n_results, where_key)
+
+    def get(self, key):
+        """
+        Returns the cached results for key, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, results):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection_name):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == collection_name]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+# Open DBHandlers per ChromaDB system. ChromaDB shares one system between all
+# clients on the same path, so it is only stopped when the last handler closes.
+_system_refs = {}
+_system_refs_lock = threading.Lock()
+
+
+def _retain_system(client):
+    identifier = getattr(client, "_identifier", None)
+    with _system_refs_lock:
+        _system_refs[identifier] = _system_refs.get(identifier, 0) + 1
+
+
+def _release_system(client):
+    """
+    Returns True if no other open handler uses the client's system.
+    """
+    identifier = getattr(client, "_identifier", None)
+    with _system_refs_lock:
+        refs = _system_refs.get(identifier, 1) - 1
+        if refs > 0:
+            _system_refs[identifier] = refs
+            return False
+        _system_refs.pop(identifier, None)
+        return True
+
 
 class DBHandler:
-    def __init__(self, book_id):
+    def __init__(self, book_id, embedding_cache=None, embedding_function=None, hnsw_config=None):
         """
         Initializes the database handler for a specific book.
+
+        Args:
+            book_id (str): The book this handler stores data for.
+            embedding_cache: The EmbeddingCache consulted before embedding documents.
+                Defaults to the cache shared by all books.
+            embedding_function: The embedding backend used for all three collections,
+                e.g. a configured embeddings.LocalEmbeddingFunction. Defaults to
+                ChromaDB's default embedding function.
+            hnsw_config (dict): Per-collection HNSW settings, e.g.
+                {"full_text_source": {"hnsw:search_ef": 200}}, overriding DEFAULT_HNSW_CONFIG.
         """
         # Sanitize book_id to be a valid directory name
-        safe_book_id = re.sub(r'[^a-zA-Z0-9_-]', '_', book_id)
-        self.db_path = os.path.join("./chroma_storage", safe_book_id)
+        self.safe_book_id = safe_book_id(book_id)
+        self.book_id = book_id
+        self.db_path = os.path.join(STORAGE_ROOT, self.safe_book_id)
+        # Content-hash manifest of full_text_source, kept next to the book's directory
+        self.manifest_path = manifest_path(book_id)
+        self.lexical_index_path = lexical_index_path(book_id)
         
         # Ensure the database directory exists
         os.makedirs(self.db_path, exist_ok=True)
         
         self.client = chromadb.PersistentClient(path=self.db_path)
+        _retain_system(self.client)
+
+        # Documents are embedded here rather than inside ChromaDB so the cache can be consulted first
+        self.embedding_function = embedding_function or embedding_functions.DefaultEmbeddingFunction()
+        self.embedding_model_id = getattr(self.embedding_function, "model_id", DEFAULT_EMBEDDING_MODEL_ID)
+        self.embedding_cache = embedding_cache or get_shared_cache(EMBEDDING_CACHE_PATH)
+
+        # Collection counts by name, refreshed after any write through this handler
+        self._counts = {}
+        # Recent query results, invalidated per collection on writes
+        self.query_cache = QueryCache()
+        # Bumped on every write, so a query that raced a write isn't cached
+        self._generations = {}
+        # BM25 index over full_text_source, loaded on first use
+        self._lexical_index = None
+        self._lexical_lock = threading.Lock()
+        # Created on first parallel multi-collection query
+        self._query_executor = None
+        # Memory-mapped snapshots by collection name (None for an empty collection),
+        # and the collections whose snapshot is missing or out of date
+        self._snapshots = {}
+        self._stale_snapshots = set()
+        # Writes made while a collection's snapshot is being exported, replayed onto it afterwards
+        self._snapshot_exports = {}
+        # Writes (and exports) in progress per collection; its pending marker exists while nonzero
+        self._snapshot_writers = {}
+        self._snapshot_lock = threading.Lock()
+        # Collections whose HNSW index ChromaDB has loaded, and those loading it in the
+        # background. Snapshots only answer queries until a collection's index is loaded.
+        self._hnsw_loaded = set()
+        self._hnsw_loading = set()
         
+        # HNSW settings each collection is created (or tuned) with
+        self.hnsw_config = {
+            name: dict(settings, **(hnsw_config or {}).get(name, {}))
+            for name, settings in DEFAULT_HNSW_CONFIG.items()
+        }
+
         # The three databases (collections in ChromaDB terms)
-        self.full_text_source = self.client.get_or_create_collection(
-            name="full_text_source"
-        )
-        self.already_covered_db = self.client.get_or_create_collection(
-            name="already_covered_db"
-        )
-        self.current_chapter_insights_db = self.client.get_or_create_collection(
-            name="current_chapter_insights_db"
-        )
+        self.full_text_source = self._open_collection("full_text_source")
+        self.already_covered_db = self._open_collection("already_covered_db")
+        self.current_chapter_insights_db = self._open_collection("current_chapter_insights_db")
         
         print(f"Database handler initialized for book '{book_id}' at {self.db_path}")
-        print(f"Collections: {self.client.list_collections()}")
+
+    def _open_collection(self, name):
+        """
+        Gets or creates a collection with its configured HNSW settings.
+
+        An existing collection keeps the settings it was created with, except
+        search_ef, which is updated in place to the configured value.
+        """
+        wanted = self.hnsw_config[name]
+        collection = self.client.get_or_create_collection(
+            name=name,
+            metadata=wanted,
+            embedding_function=self.embedding_function
+        )
+
+        current = self.index_config(collection)
+        if "hnsw:search_ef" in wanted and current.get("hnsw:search_ef") != wanted["hnsw:search_ef"]:
+            collection = self.set_search_ef(collection, wanted["hnsw:search_ef"])
+        differing = [key for key in _IMMUTABLE_HNSW_KEYS if key in wanted and key in current and current[key] != wanted[key]]
+        if differing:
+            print(f"Note: '{name}' was created with different {', '.join(differing)}; "
+                  f"rebuild it with `python main.py maintain --rebuild-index` to apply the new settings")
+        return collection
+
+    def index_config(self, collection):
+        """
+        Returns a collection's effective HNSW settings as hnsw:* keys.
+        """
+        config = {key: value for key, value in (collection.metadata or {}).items() if key.startswith("hnsw:")}
+        # Newer ChromaDB versions keep the live settings in the collection's configuration
+        configuration = getattr(collection, "configuration", None)
+        hnsw = configuration.get("hnsw") if isinstance(configuration, dict) else None
+        for key, metadata_key in _HNSW_CONFIGURATION_KEYS.items():
+            if hnsw and hnsw.get(key) is not None:
+                config[metadata_key] = hnsw[key]
+        return config
+
+    def set_search_ef(self, collection, search_ef):
+        """
+        Changes how many candidates an HNSW search explores, trading latency for recall.
+
+        Returns:
+            The collection, re-read so its settings are current.
+        """
+        try:
+            try:
+                collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+            except TypeError:
+                # Older ChromaDB versions take HNSW settings as metadata only
+                collection.modify(metadata=dict(collection.metadata or {}, **{"hnsw:search_ef": search_ef}))
+            collection = self.client.get_collection(name=collection.name, embedding_function=self.embedding_function)
+            print(f"Set search_ef of '{collection.name}' to {search_ef}")
+        except Exception as e:
+            print(f"Error setting search_ef of '{collection.name}': {e}")
+        finally:
+            self._collection_changed(collection.name)
+        return collection
+
+    def close(self):
+        """
+        Releases the handler's PersistentClient and collections.
+
+        ChromaDB caches one system per storage path and hands it to every new
+        PersistentClient for that path. Once no other open handler uses it,
+        the system is dropped from that cache and stopped.
+        """
+        if self._query_executor is not None:
+            self._query_executor.shutdown(wait=False)
+            self._query_executor = None
+        self._counts.clear()
+        self.query_cache.clear()
+        with self._snapshot_lock:
+            snapshots = [snapshot for snapshot in self._snapshots.values() if snapshot is not None]
+            self._snapshots.clear()
+            self._stale_snapshots.clear()
+            # Exports still running are discarded when they finish, leaving their pending markers
+            self._snapshot_exports.clear()
+            self._snapshot_writers.clear()
+            self._hnsw_loaded.clear()
+            self._hnsw_loading.clear()
+        for snapshot in snapshots:
+            snapshot.close()
+        with self._lexical_lock:
+            self._lexical_index = None
+
+        client = self.client
+        self.client = None
+        self.full_text_source = None
+        self.already_covered_db = None
+        self.current_chapter_insights_db = None
+        if client is None:
+            return
+        if not _release_system(client):
+            print(f"Closed database handler for book '{self.book_id}' (its store is still open elsewhere)")
+            return
+
+        try:
+            identifier = getattr(client, "_identifier", None)
+            system_cache = getattr(type(client), "_identifier_to_system", None)
+            if identifier is not None and system_cache is not None:
+                system = system_cache.pop(identifier, None)
+                if system is not None:
+                    system.stop()
+            print(f"Closed database handler for book '{self.book_id}'")
+        except Exception as e:
+            print(f"Error closing database handler for book '{self.book_id}': {e}")
+
+    def _collection_changed(self, collection_name):
+        """
+        Drops state derived from a collection's contents after it is written to.
+        """
+        self._counts.pop(collection_name, None)
+        self._generations[collection_name] = self._generations.get(collection_name, 0) + 1
+        self.query_cache.invalidate(collection_name)
+
+    def collection_count(self, collection):
+        """
+        Returns the number of documents in a collection, cached until the next
+        write to it through this handler.
+        """
+        count = self._counts.get(collection.name)
+        if count is None:
+            count = collection.count()
+            self._counts[collection.name] = count
+        return count
+
+    @property
+    def lexical_index(self):
+        """
+        The book's BM25 index over full_text_source, loaded on first use.
+
+        The index is saved at the end of each indexing run, after the manifest.
+        If it is missing, or older than the manifest because a run was killed,
+        it is rebuilt from the documents already in the collection.
+        """
+        with self._lexical_lock:
+            if self._lexical_index is None:
+                index = None
+                if self._lexical_index_is_fresh():
+                    index = BM25Index.load(self.lexical_index_path)
+                if index is None:
+                    index = self._build_lexical_index()
+                self._lexical_index = index
+            return self._lexical_index
+
+    def _lexical_index_is_fresh(self):
+        try:
+            index_mtime = os.stat(self.lexical_index_path).st_mtime_ns
+        except OSError:
+            return False
+        try:
+            return index_mtime >= os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return True
+
+    def _build_lexical_index(self, page_size=1000):
+        index = BM25Index(self.lexical_index_path)
+        total = self.full_text_source.count()
+        for offset in range(0, total, page_size):
+            rows = self.full_text_source.get(include=["documents"], limit=page_size, offset=offset)
+            index.add(rows["ids"], rows["documents"])
+        if total:
+            index.save()
+            print(f"Built lexical index with {total} chunks at {self.lexical_index_path}")
+        return index
+
+    def _collection_space(self, collection):
+        return self.index_config(collection).get("hnsw:space", "l2")
+
+    def _load_snapshot_locked(self, collection):
+        """
+        Opens a collection's snapshot from disk the first time it is needed,
+        marking it stale if it is missing, doesn't match the collection, or
+        was left with writes it doesn't have.
+        """
+        name = collection.name
+        if name in self._snapshots or name in self._stale_snapshots:
+            return
+        if not self._snapshot_writers.get(name) and os.path.exists(snapshot_pending_path(self.book_id, name)):
+            print(f"Snapshot of '{name}' was interrupted mid-write; it will be re-exported")
+            self._stale_snapshots.add(name)
+            return
+        try:
+            snapshot = EmbeddingSnapshot.load(snapshot_path(self.book_id, name), self.embedding_model_id)
+            count = collection.count()
+        except Exception as e:
+            print(f"Error opening snapshot of '{name}': {e}")
+            self._stale_snapshots.add(name)
+            return
+        if snapshot is not None and snapshot.live_count == count:
+            self._snapshots[name] = snapshot
+        elif count == 0:
+            self._snapshots[name] = None # Created on the first write
+        else:
+            self._stale_snapshots.add(name)
+
+    def _begin_snapshot_write_locked(self, name):
+        writers = self._snapshot_writers.get(name, 0)
+        self._snapshot_writers[name] = writers + 1
+        if writers == 0:
+            try:
+                open(snapshot_pending_path(self.book_id, name), "w").close()
+            except OSError as e:
+                print(f"Error marking snapshot of '{name}' as pending: {e}")
+
+    def _end_snapshot_write_locked(self, name):
+        writers = self._snapshot_writers.get(name, 0) - 1
+        if writers > 0:
+            self._snapshot_writers[name] = writers
+            return
+        self._snapshot_writers.pop(name, None)
+        # A stale snapshot keeps its marker until it has been re-exported
+        if name in self._stale_snapshots:
+            return
+        try:
+            os.remove(snapshot_pending_path(self.book_id, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error clearing the pending marker of '{name}': {e}")
+
+    def snapshot(self, collection):
+        """
+        Returns the memory-mapped snapshot of a collection, or None if it has
+        none yet. A missing or out-of-date snapshot is exported in the
+        background, and queries go to ChromaDB until it is ready.
+        """
+        name = collection.name
+        with self._snapshot_lock:
+            self._load_snapshot_locked(collection)
+            if name in self._stale_snapshots and name not in self._snapshot_exports:
+                writes = self._snapshot_exports[name] = []
+                self._begin_snapshot_write_locked(name)
+                threading.Thread(
+                    target=self._export_snapshot, args=(collection, writes),
+                    name=f"snapshot-{self.book_id}-{name}", daemon=True
+                ).start()
+            return self._snapshots.get(name)
+
+    def _export_snapshot(self, collection, writes):
+        """
+        Exports a collection's snapshot, then applies the writes made while it
+        was exporting. Replaying a write the export already saw is harmless,
+        so writes during indexing don't make the export start over.
+        """
+        name = collection.name
+        started = time.perf_counter()
+        snapshot = None
+        try:
+            snapshot = EmbeddingSnapshot.export(
+                collection, snapshot_path(self.book_id, name),
+                model_id=self.embedding_model_id,
+                space=self._collection_space(collection)
+            )
+        except Exception as e:
+            print(f"Error exporting snapshot of '{name}': {e}")
+        with self._snapshot_lock:
+            if self._snapshot_exports.get(name) is not writes:
+                return # The collection was cleared or the handler closed meanwhile
+            del self._snapshot_exports[name]
+            try:
+                for ids, embeddings, documents, metadatas in writes:
+                    if embeddings is None:
+                        if snapshot is not None:
+                            snapshot.delete(ids)
+                        continue
+                    if snapshot is None:
+                        snapshot = EmbeddingSnapshot.create(
+                            snapshot_path(self.book_id, name), len(embeddings[0]),
+                            space=self._collection_space(collection), model_id=self.embedding_model_id
+                        )
+                    snapshot.upsert(ids, embeddings, documents, metadatas)
+            except Exception as e:
+                print(f"Error applying writes to the snapshot of '{name}': {e}")
+                snapshot = None
+            if snapshot is None:
+                # Failed; tried again on the next query
+                self._end_snapshot_write_locked(name)
+                return
+            self._snapshots[name] = snapshot
+            self._stale_snapshots.discard(name)
+            self._end_snapshot_write_locked(name)
+        print(f"Exported snapshot of '{name}' ({snapshot.live_count} rows, {len(writes)} writes replayed) in {time.perf_counter() - started:.2f}s")
+
+    def _prepare_snapshot(self, collection):
+        # Opened before a write, so the write can be applied to it afterwards
+        with self._snapshot_lock:
+            self._load_snapshot_locked(collection)
+            self._begin_snapshot_write_locked(collection.name)
+
+    def _snapshot_write(self, collection, ids, embeddings=None, documents=None, metadatas=None):
+        """
+        Applies a successful write (or, without embeddings, a deletion) to the
+        collection's snapshot. A snapshot that can't be updated is marked stale.
+        """
+        name = collection.name
+        with self._snapshot_lock:
+            try:
+                self._apply_snapshot_write_locked(collection, ids, embeddings, documents, metadatas)
+            finally:
+                self._end_snapshot_write_locked(name)
+
+    def _apply_snapshot_write_locked(self, collection, ids, embeddings, documents, metadatas):
+        name = collection.name
+        if name not in self._snapshots:
+            writes = self._snapshot_exports.get(name)
+            if writes is not None:
+                writes.append((ids, embeddings, documents, metadatas))
+            return # Stale; re-exported on the next query
+        snapshot = self._snapshots[name]
+        try:
+            if embeddings is None:
+                if snapshot is not None:
+                    snapshot.delete(ids)
+            else:
+                if snapshot is None:
+                    snapshot = EmbeddingSnapshot.create(
+                        snapshot_path(self.book_id, name), len(embeddings[0]),
+                        space=self._collection_space(collection), model_id=self.embedding_model_id
+                    )
+                    self._snapshots[name] = snapshot
+                snapshot.upsert(ids, embeddings, documents, metadatas)
+        except Exception as e:
+            print(f"Error updating snapshot of '{name}': {e}")
+            snapshot = None
+        if snapshot is None and embeddings is None:
+            return
+        if snapshot is None or snapshot.needs_compaction():
+            self._snapshots.pop(name, None)
+            self._stale_snapshots.add(name)
+
+    def _snapshot_write_failed(self, collection):
+        """
+        Marks a collection's snapshot stale after a write that may have partly
+        reached ChromaDB.
+        """
+        name = collection.name
+        with self._snapshot_lock:
+            self._snapshots.pop(name, None)
+            self._stale_snapshots.add(name)
+            # An export running now may have missed part of the write, so it is abandoned too
+            if self._snapshot_exports.pop(name, None) is not None:
+                self._end_snapshot_write_locked(name)
+            self._end_snapshot_write_locked(name)
+
+    def embed_query(self, query_text):
+        """
+        Embeds a single query text with the collections' embedding function.
+        """
+        return [float(x) for x in self.embedding_function([query_text])[0]]
+
+    def embed_documents(self, documents):
+        """
+        Returns embeddings for documents, reusing cached embeddings of identical text.
+        """
+        return self.embedding_cache.embed(documents, self.embedding_function, self.embedding_model_id)
 
     def add_to_collection(self, collection, documents, metadatas, ids):
         """
@@ -39,21 +664,91 @@ class DBHandler:
             documents (list): A list of document strings to add.
             metadatas (list): A list of metadata dictionaries.
             ids (list): A list of unique string IDs for each document.
+
+        Returns:
+            True if the documents were added, False otherwise.
         """
         if not documents:
-            return
+            return True
         
         try:
+            self._prepare_snapshot(collection)
+            embeddings = self.embed_documents(documents)
             collection.add(
                 documents=documents,
+                embeddings=embeddings,
                 metadatas=metadatas,
                 ids=ids
             )
             print(f"Added {len(documents)} documents to '{collection.name}'.")
+            self._snapshot_write(collection, ids, embeddings, documents, metadatas)
+            return True
         except Exception as e:
             print(f"Error adding to collection '{collection.name}': {e}")
+            self._snapshot_write_failed(collection)
+            return False
+        finally:
+            self._collection_changed(collection.name)
+
+    def upsert_to_collection(self, collection, documents, metadatas, ids):
+        """
+        Adds documents to a collection, replacing any existing documents with the same IDs.
+
+        Args:
+            collection: The ChromaDB collection object.
+            documents (list): A list of document strings to write.
+            metadatas (list): A list of metadata dictionaries.
+            ids (list): A list of unique string IDs for each document.
+
+        Returns:
+            True if the documents were written, False otherwise.
+        """
+        if not documents:
+            return True
+
+        try:
+            self._prepare_snapshot(collection)
+            embeddings = self.embed_documents(documents)
+            collection.upsert(
+                documents=documents,
+                embeddings=embeddings,
+                metadatas=metadatas,
+                ids=ids
+            )
+            print(f"Upserted {len(documents)} documents to '{collection.name}'.")
+            self._snapshot_write(collection, ids, embeddings, documents, metadatas)
+            return True
+        except Exception as e:
+            print(f"Error upserting to collection '{collection.name}': {e}")
+            self._snapshot_write_failed(collection)
+            return False
+        finally:
+            self._collection_changed(collection.name)
+
+    def delete_from_collection(self, collection, ids):
+        """
+        Deletes documents from a collection by ID.
 
-    def query_collection(self, collection, query_texts, n_results=3):
+        Returns:
+            True if the documents were deleted, False otherwise.
+        """
+        if not ids:
+            return True
+
+        try:
+            self._prepare_snapshot(collection)
+            collection.delete(ids=ids)
+            print(f"Deleted {len(ids)} documents from '{collection.name}'.")
+            self._snapshot_write(collection, ids)
+            return True
+        except Exception as e:
+            print(f"Error deleting from collection '{collection.name}': {e}")
+            self._snapshot_write_failed(collection)
+            return False
+        finally:
+            self._collection_changed(collection.name)
+
+    def query_collection(self, collection, query_texts, n_results=3, where=None):
         """
         Queries a collection to find the most relevant documents.
         
@@ -61,36 +756,546 @@ class DBHandler:
             collection: The ChromaDB collection object.
             query_texts (list): The text(s) to search for.
             n_results (int): The number of results to return.
+            where (dict): Optional ChromaDB metadata filter.
             
         Returns:
             A dictionary containing the query results.
         """
-        if not query_texts or collection.count() == 0:
+        if not query_texts:
+            return None
+
+        cache_key = QueryCache.make_key(collection.name, query_texts, n_results, where)
+        cached = self.query_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        generation = self._generations.get(collection.name, 0)
+        count = self.collection_count(collection)
+        if count == 0:
             return None
             
+        try:
+            results = None
+            if collection.name not in self._hnsw_loaded:
+                query_embeddings = [[float(x) for x in vector] for vector in self.embedding_function(query_texts)]
+                snapshot = self._cold_snapshot(collection, query_embeddings[0])
+                if snapshot is not None:
+                    results = self._query_snapshot(snapshot, collection, query_embeddings, n_results, where)
+            if results is None:
+                results = collection.query(
+                    query_texts=query_texts,
+                    n_results=min(n_results, count), # Ensure n_results is not > items in collection
+                    where=where
+                )
+                self._hnsw_loaded.add(collection.name)
+            if self._generations.get(collection.name, 0) == generation:
+                self.query_cache.put(cache_key, results)
+            return results
+        except Exception as e:
+            print(f"Error querying collection '{collection.name}': {e}")
+            return None
+
+    def query_by_embedding(self, collection, query_embedding, n_results=3, where=None):
+        """
+        Queries a collection with a precomputed query embedding.
+        """
+        count = self.collection_count(collection)
+        if count == 0:
+            return None
+
+        snapshot = self._cold_snapshot(collection, query_embedding)
+        if snapshot is not None:
+            results = self._query_snapshot(snapshot, collection, [query_embedding], n_results, where)
+            if results is not None:
+                return results
+
         try:
             results = collection.query(
-                query_texts=query_texts,
-                n_results=min(n_results, collection.count()) # Ensure n_results is not > items in collection
+                query_embeddings=[query_embedding],
+                n_results=min(n_results, count),
+                where=where
             )
+            self._hnsw_loaded.add(collection.name)
             return results
         except Exception as e:
             print(f"Error querying collection '{collection.name}': {e}")
             return None
 
+    def _cold_snapshot(self, collection, query_embedding):
+        """
+        Returns the collection's snapshot to query while ChromaDB's HNSW index
+        for it is not loaded yet, or None once queries should go to ChromaDB,
+        where search_ef applies. The first call starts loading the index in
+        the background with query_embedding.
+        """
+        name = collection.name
+        with self._snapshot_lock:
+            if name in self._hnsw_loaded:
+                return None
+            if name not in self._hnsw_loading:
+                self._hnsw_loading.add(name)
+                threading.Thread(
+                    target=self._load_hnsw, args=(collection, query_embedding),
+                    name=f"hnsw-{self.book_id}-{name}", daemon=True
+                ).start()
+        return self.snapshot(collection)
+
+    def _load_hnsw(self, collection, query_embedding):
+        # ChromaDB loads a collection's HNSW index on its first query
+        name = collection.name
+        started = time.perf_counter()
+        try:
+            collection.query(query_embeddings=[query_embedding], n_results=1, include=["distances"])
+            loaded = True
+        except Exception as e:
+            print(f"Error loading the HNSW index of '{name}': {e}")
+            loaded = False
+        with self._snapshot_lock:
+            if name not in self._hnsw_loading:
+                return # The collection was cleared or the handler closed meanwhile
+            self._hnsw_loading.discard(name)
+            if loaded:
+                self._hnsw_loaded.add(name)
+        if loaded:
+            print(f"Loaded the HNSW index of '{name}' in {time.perf_counter() - started:.2f}s; queries now go to ChromaDB")
+
+    def _query_snapshot(self, snapshot, collection, query_embeddings, n_results, where):
+        """
+        Searches a snapshot, returning None if ChromaDB should answer instead.
+        """
+        try:
+            return snapshot.query(query_embeddings, n_results=n_results, where=where)
+        except Exception as e:
+            print(f"Error querying snapshot of '{collection.name}', falling back to ChromaDB: {e}")
+            return None
+
+    def query_collections(self, collections, query_text, n_results=3, parallel=False, where=None, wheres=None):
+        """
+        Queries several collections with one query, embedding it only once.
+
+        Args:
+            collections (list): The ChromaDB collection objects to search.
+            query_text (str): The text to search for.
+            n_results (int): The number of results to return per collection.
+            parallel (bool): Query the collections concurrently.
+            where (dict): Optional ChromaDB metadata filter applied to every collection.
+            wheres (dict): Optional filters by collection name, used instead of `where`
+                for those collections.
+
+        Returns:
+            A dictionary mapping each collection's name to its query results
+            (None for empty collections or failed queries).
+        """
+        results = {collection.name: None for collection in collections}
+        if not query_text:
+            return results
+
+        # Serve what we can from the result cache; only the rest needs the embedding
+        cache_keys = {}
+        targets = []
+        filters = {collection.name: (wheres or {}).get(collection.name, where) for collection in collections}
+        for collection in collections:
+            cache_key = QueryCache.make_key(collection.name, [query_text], n_results, filters[collection.name])
+            cached = self.query_cache.get(cache_key)
+            if cached is not None:
+                results[collection.name] = cached
+            elif self.collection_count(collection) > 0:
+                cache_keys[collection.name] = cache_key
+                targets.append(collection)
+        if not targets:
+            return results
+        generations = {collection.name: self._generations.get(collection.name, 0) for collection in targets}
+
+        try:
+            query_embedding = self.embed_query(query_text)
+        except Exception as e:
+            print(f"Error embedding query: {e}")
+            return results
+
+        if parallel and len(targets) > 1:
+            if self._query_executor is None:
+                self._query_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix=f"query-{self.book_id}")
+            futures = {
+                collection.name: self._query_executor.submit(
+                    self.query_by_embedding, collection, query_embedding, n_results, filters[collection.name]
+                )
+                for collection in targets
+            }
+            fresh = {name: future.result() for name, future in futures.items()}
+        else:
+            fresh = {
+                collection.name: self.query_by_embedding(collection, query_embedding, n_results, filters[collection.name])
+                for collection in targets
+            }
+
+        for name, collection_results in fresh.items():
+            if collection_results is not None and self._generations.get(name, 0) == generations[name]:
+                self.query_cache.put(cache_keys[name], collection_results)
+            results[name] = collection_results
+        return results
+
+    def matching_ids(self, collection, where):
+        """
+        Returns the set of IDs in a collection whose metadata matches a `where` filter.
+        """
+        snapshot = self.snapshot(collection)
+        if snapshot is not None:
+            try:
+                return snapshot.matching_ids(where)
+            except Exception as e:
+                print(f"Error filtering snapshot of '{collection.name}', falling back to ChromaDB: {e}")
+        return set(collection.get(where=where, include=[])["ids"])
+
+    def hybrid_query(self, query_text, n_results=3, lexical_weight=0.5, where=None):
+        """
+        Retrieves full_text_source chunks by fusing vector and BM25 rankings.
+
+        Each retriever proposes its top candidates and the two rankings are
+        combined with weighted reciprocal rank fusion, so exact identifiers
+        found lexically can surface even when the embedding misses them.
+
+        Args:
+            query_text (str): The text to search for.
+            n_results (int): The number of fused results to return.
+            lexical_weight (float): Weight of the BM25 ranking, from 0 (vector
+                only) to 1 (lexical only).
+            where (dict): Optional metadata filter, e.g. range_filter("page_num", 10, 20).
+                Both retrievers only consider matching chunks.
+
+        Returns:
+            A dictionary shaped like ChromaDB query results for a single query,
+            with fused 'scores' in place of distances, or None if nothing matched.
+        """
+        if not query_text:
+            return None
+
+        collection = self.full_text_source
+        candidate_count = n_results * 4
+        vector_results = self.query_collection(collection, [query_text], n_results=candidate_count, where=where) if lexical_weight < 1 else None
+        lexical_results = []
+        if lexical_weight > 0:
+            try:
+                candidate_ids = self.matching_ids(collection, where) if where else None
+            except Exception as e:
+                print(f"Error filtering '{collection.name}' for lexical search: {e}")
+                candidate_ids = set()
+            lexical_results = self.lexical_index.search(query_text, n_results=candidate_count, candidate_ids=candidate_ids)
+
+        rows = {}
+        fused = {}
+        if vector_results and vector_results['ids']:
+            for rank, (chunk_id, document, metadata) in enumerate(zip(
+                vector_results['ids'][0], vector_results['documents'][0], vector_results['metadatas'][0]
+            )):
+                rows[chunk_id] = (document, metadata)
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + (1 - lexical_weight) / (RRF_K + rank + 1)
+        for rank, (chunk_id, _) in enumerate(lexical_results):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + lexical_weight / (RRF_K + rank + 1)
+
+        top_ids = sorted(fused, key=fused.get, reverse=True)[:n_results]
+        if not top_ids:
+            return None
+
+        # Lexical-only hits still need their text and metadata
+        missing = [chunk_id for chunk_id in top_ids if chunk_id not in rows]
+        if missing:
+            try:
+                fetched = None
+                snapshot = self.snapshot(collection)
+                if snapshot is not None:
+                    try:
+                        fetched = snapshot.get(missing)
+                    except Exception as e:
+                        print(f"Error reading snapshot of '{collection.name}', falling back to ChromaDB: {e}")
+                if fetched is None:
+                    fetched = collection.get(ids=missing, include=["documents", "metadatas"])
+                for chunk_id, document, metadata in zip(fetched['ids'], fetched['documents'], fetched['metadatas']):
+                    rows[chunk_id] = (document, metadata)
+            except Exception as e:
+                print(f"Error fetching lexical results from '{collection.name}': {e}")
+            top_ids = [chunk_id for chunk_id in top_ids if chunk_id in rows]
+
+        return {
+            'ids': [top_ids],
+            'documents': [[rows[chunk_id][0] for chunk_id in top_ids]],
+            'metadatas': [[rows[chunk_id][1] for chunk_id in top_ids]],
+            'scores': [[fused[chunk_id] for chunk_id in top_ids]],
+        }
+
+    def migrate_insight_ids(self):
+        """
+        Moves captured insights from the old per-process hash() IDs to content_id() IDs.
+
+        Duplicate selections in already_covered_db collapse into one row per
+        distinct text, and each insight's source_doc_id is pointed at the new
+        ID. Insights themselves keep their IDs. Runs once per book; a marker
+        file next to the book's directory records that it has been done.
+
+        Returns:
+            True if the book's insights use content IDs, False if the migration failed.
+        """
+        marker_path = insight_ids_marker_path(self.book_id)
+        if os.path.exists(marker_path):
+            return True
+
+        try:
+            covered = self.already_covered_db.get(include=["documents", "metadatas"])
+            insights = self.current_chapter_insights_db.get(include=["documents", "metadatas"])
+        except Exception as e:
+            print(f"Error reading captured insights for migration: {e}")
+            return False
+
+        new_ids = {}
+        rows = {}
+        for old_id, document, metadata in zip(covered["ids"], covered["documents"], covered["metadatas"]):
+            new_id = content_id("doc", document)
+            new_ids[old_id] = new_id
+            rows.setdefault(new_id, (document, metadata))
+        stale_ids = [old_id for old_id in new_ids if old_id not in rows]
+
+        relinked = [
+            (insight_id, document, dict(metadata, source_doc_id=new_ids[metadata["source_doc_id"]]))
+            for insight_id, document, metadata in zip(insights["ids"], insights["documents"], insights["metadatas"])
+            if metadata and metadata.get("source_doc_id") in new_ids
+            and new_ids[metadata["source_doc_id"]] != metadata["source_doc_id"]
+        ]
+
+        # Write the new rows before deleting the old ones, so a failure part way leaves nothing lost
+        migrated = self.upsert_to_collection(
+            self.already_covered_db,
+            documents=[document for document, _ in rows.values()],
+            metadatas=[metadata for _, metadata in rows.values()],
+            ids=list(rows)
+        )
+        migrated = migrated and self.upsert_to_collection(
+            self.current_chapter_insights_db,
+            documents=[document for _, document, _ in relinked],
+            metadatas=[metadata for _, _, metadata in relinked],
+            ids=[insight_id for insight_id, _, _ in relinked]
+        )
+        migrated = migrated and self.delete_from_collection(self.already_covered_db, stale_ids)
+        if not migrated:
+            return False
+
+        with open(marker_path, "w", encoding="utf-8") as f:
+            json.dump({"covered_before": len(new_ids), "covered_after": len(rows), "insights_relinked": len(relinked)}, f)
+        print(f"Migrated captured insights to content IDs: {len(new_ids)} -> {len(rows)} covered passages, {len(relinked)} insights relinked")
+        return True
+
+    def migrate_scope_fields(self):
+        """
+        Marks captured rows written before positions were recorded with
+        UNSCOPED_FIELD, so position-scoped retrieval (see include_unscoped())
+        still finds them.
+
+        Their position can't be recovered, so they match every window, as
+        they did before retrieval was scoped: covered passages without
+        page_num/item_num, and insights without a chapter. Runs once per
+        book, recorded by a marker file like migrate_insight_ids().
+
+        Returns:
+            True if the book's rows are marked, False if the migration failed.
+        """
+        marker_path = scope_fields_marker_path(self.book_id)
+        if os.path.exists(marker_path):
+            return True
+
+        required = [
+            (self.already_covered_db, ("page_num", "item_num")),
+            (self.current_chapter_insights_db, ("chapter",)),
+        ]
+        marked = 0
+        for collection, fields in required:
+            try:
+                rows = collection.get(include=["documents", "metadatas"])
+            except Exception as e:
+                print(f"Error reading '{collection.name}' for migration: {e}")
+                return False
+            legacy = [
+                (row_id, document, dict(metadata or {}, **{UNSCOPED_FIELD: True}))
+                for row_id, document, metadata in zip(rows["ids"], rows["documents"], rows["metadatas"])
+                if not any(field in (metadata or {}) for field in fields) and not (metadata or {}).get(UNSCOPED_FIELD)
+            ]
+            if not self.upsert_to_collection(
+                collection,
+                documents=[document for _, document, _ in legacy],
+                metadatas=[metadata for _, _, metadata in legacy],
+                ids=[row_id for row_id, _, _ in legacy]
+            ):
+                return False
+            marked += len(legacy)
+
+        with open(marker_path, "w", encoding="utf-8") as f:
+            json.dump({"marked_unscoped": marked}, f)
+        if marked:
+            print(f"Marked {marked} captured rows without a position as unscoped")
+        return True
+
     def clear_collection(self, collection_name):
         """
         Deletes and recreates a collection to clear its contents.
         """
         try:
+            self._collection_changed(collection_name)
+            with self._snapshot_lock:
+                old_snapshot = self._snapshots.get(collection_name)
+                if old_snapshot is not None:
+                    old_snapshot.close()
+                self._snapshots[collection_name] = None
+                self._stale_snapshots.discard(collection_name)
+                if self._snapshot_exports.pop(collection_name, None) is not None:
+                    self._end_snapshot_write_locked(collection_name) # Drops the abandoned export's hold
+                self._hnsw_loaded.discard(collection_name)
+                self._hnsw_loading.discard(collection_name)
+                EmbeddingSnapshot.remove(snapshot_path(self.book_id, collection_name))
             self.client.delete_collection(name=collection_name)
-            new_collection = self.client.create_collection(name=collection_name)
+            new_collection = self.client.create_collection(
+                name=collection_name,
+                metadata=self.hnsw_config.get(collection_name),
+                embedding_function=self.embedding_function
+            )
             print(f"Successfully cleared and recreated collection: {collection_name}")
             return new_collection
         except Exception as e:
             print(f"Error clearing collection '{collection_name}': {e}")
             # If deletion fails, try to get the collection anyway
-            return self.client.get_or_create_collection(name=collection_name)
+            return self.client.get_or_create_collection(name=collection_name, embedding_function=self.embedding_function)
+
+class DBHandlerPool:
+    """
+    Keeps the most recently used DBHandlers open, keyed by book_id, so
+    switching back to a recent book reuses its client and collections
+    instead of paying the cold-open cost again.
+    """
+    def __init__(self, max_open=4, **handler_kwargs):
+        """
+        Args:
+            max_open (int): Number of handlers kept open before the least
+                recently used one is closed.
+            handler_kwargs: Passed to every DBHandler the pool creates.
+        """
+        self.max_open = max_open
+        self.handler_kwargs = handler_kwargs
+        self._handlers = OrderedDict()
+        # Number of active leases per book; leased handlers are never evicted
+        self._leases = {}
+        # Futures for handlers being opened, by book_id
+        self._opening = {}
+        self._lock = threading.Lock()
+
+    def _evict_locked(self):
+        """
+        Removes least recently used, unleased handlers beyond max_open.
+        Returns them, to be closed once the lock is released.
+        """
+        evicted = []
+        # The most recently used handler is the one just handed out, so it is never evicted
+        for book_id in list(self._handlers)[:-1]:
+            if len(self._handlers) <= self.max_open:
+                break
+            if self._leases.get(book_id):
+                continue
+            evicted.append(self._handlers.pop(book_id))
+        return evicted
+
+    def get(self, book_id):
+        """
+        Returns the open handler for a book, opening it (and evicting the
+        least recently used handler if the pool is full) if needed.
+
+        The handler is opened outside the pool's lock, so cold opens of
+        different books run concurrently; concurrent calls for the same book
+        wait for a single open.
+        """
+        with self._lock:
+            handler = self._handlers.get(book_id)
+            if handler is not None:
+                self._handlers.move_to_end(book_id)
+                return handler
+            opening = self._opening.get(book_id)
+            if opening is None:
+                opening = self._opening[book_id] = Future()
+                opener = True
+            else:
+                opener = False
+
+        if not opener:
+            # Another thread is opening the same book; ChromaDB can't create
+            # the same store's system from two threads at once
+            return opening.result()
+
+        try:
+            handler = DBHandler(book_id=book_id, **self.handler_kwargs)
+        except Exception as e:
+            with self._lock:
+                del self._opening[book_id]
+            opening.set_exception(e)
+            raise
+        with self._lock:
+            del self._opening[book_id]
+            self._handlers[book_id] = handler
+            self._handlers.move_to_end(book_id)
+            evicted = self._evict_locked()
+        opening.set_result(handler)
+        for stale in evicted:
+            stale.close()
+        return handler
+
+    def acquire(self, book_id):
+        """
+        Returns a book's handler and keeps it from being evicted until
+        release() is called, e.g. by a background worker using it.
+        """
+        with self._lock:
+            self._leases[book_id] = self._leases.get(book_id, 0) + 1
+        try:
+            return self.get(book_id)
+        except Exception:
+            self.release(book_id)
+            raise
+
+    def release(self, book_id):
+        with self._lock:
+            self._leases[book_id] -= 1
+            if not self._leases[book_id]:
+                del self._leases[book_id]
+            evicted = self._evict_locked()
+        for handler in evicted:
+            handler.close()
+
+    @contextmanager
+    def lease(self, book_id):
+        """
+        Yields a book's handler and keeps it from being evicted until the block
+        exits, for callers that use handlers from several threads at once.
+        """
+        handler = self.acquire(book_id)
+        try:
+            yield handler
+        finally:
+            self.release(book_id)
+
+    def close(self, book_id):
+        """
+        Closes and removes a book's handler, if it is open.
+        """
+        with self._lock:
+            handler = self._handlers.pop(book_id, None)
+        if handler is not None:
+            handler.close()
+
+    def close_all(self):
+        with self._lock:
+            handlers = list(self._handlers.values())
+            self._handlers.clear()
+        for handler in handlers:
+            handler.close()
+
+    def __contains__(self, book_id):
+        return book_id in self._handlers
+
+    def __len__(self):
+        return len(self._handlers)
 
 if __name__ == '__main__':
     # Test the DBHandler
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+
+# Default number of embeddings kept before least-recently-used entries are evicted
+DEFAULT_MAX_ENTRIES = 500000
+# Eviction trims down to this fraction of max_entries, so it runs rarely
+_EVICT_TO_FRACTION = 0.9
+# Keep IN (...) lists under SQLite's bound-parameter limit
+_SQL_BATCH = 500
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_shared_caches = {}
+_shared_lock = threading.Lock()
+
+
+def normalize_text(text):
+    """
+    Normalizes chunk text for cache keys. Only whitespace is collapsed, since
+    case and punctuation change what the embedding model produces.
+    """
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    On-disk, content-addressed cache of embeddings shared across books.
+
+    Entries are keyed by a hash of the embedding-model ID and the normalized
+    chunk text, so identical text in any book is embedded once per model.
+    The cache holds at most max_entries embeddings and evicts the least
+    recently used ones beyond that.
+    """
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # Upper bound on the row count, kept without scanning the table on every write
+        self._count = self._count_rows()
+
+    @staticmethod
+    def key(text, model_id):
+        return hashlib.sha256(f"{model_id}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Returns a dict of key -> embedding for the keys present in the cache.
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), _SQL_BATCH):
+                batch = keys[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        """
+        Stores a dict of key -> embedding, evicting old entries if the cache is full.
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items.items()]
+            )
+            self._conn.commit()
+            # Replaced keys and other processes' writes make this approximate; it is corrected before evicting
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._evict_locked()
+
+    def _count_rows(self):
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _evict_locked(self):
+        count = self._count = self._count_rows()
+        if count <= self.max_entries:
+            return
+        excess = count - int(self.max_entries * _EVICT_TO_FRACTION)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self._conn.commit()
+        self._count = count - excess
+        print(f"Evicted {excess} least recently used embeddings from {self.path}")
+
+    def embed(self, texts, embedding_function, model_id):
+        """
+        Returns embeddings for texts, running embedding_function only on texts
+        that are not already cached. Duplicates within texts are embedded once.
+        """
+        keys = [self.key(text, model_id) for text in texts]
+        cached = self.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            computed = embedding_function(list(missing.values()))
+            new_entries = {key: [float(x) for x in vector] for key, vector in zip(missing, computed)}
+            self.put_many(new_entries)
+            cached.update(new_entries)
+
+        return [cached[key] for key in keys]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_shared_cache(path, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Returns the process-wide EmbeddingCache for a path, creating it on first use.
+    """
+    with _shared_lock:
+        cache = _shared_caches.get(path)
+        if cache is None:
+            cache = EmbeddingCache(path, max_entries=max_entries)
+            _shared_caches[path] = cache
+        return cache
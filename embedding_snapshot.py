@@ -0,0 +1,509 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # e.g. Windows, where snapshots are only locked within a process
+
+SNAPSHOT_VERSION = 2
+# Rows fetched from ChromaDB per page while exporting
+_EXPORT_PAGE_SIZE = 1000
+# Rewrite the snapshot once this fraction of its rows are tombstoned
+_COMPACT_FRACTION = 0.25
+
+_VECTORS_FILE = "vectors.f32"
+_ROWS_FILE = "rows.jsonl"
+_DOCUMENTS_FILE = "documents.txt"
+_TOMBSTONES_FILE = "tombstones.i32"
+_META_FILE = "meta.json"
+# Next to the snapshot directory rather than in it, since export() replaces the directory
+_LOCK_SUFFIX = ".lock"
+
+
+_COMPARISONS = {
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal,
+}
+
+
+@contextmanager
+def _file_lock(path, shared=False, blocking=True):
+    """
+    Holds the cross-process lock of the snapshot at path: shared for
+    reading, exclusive for writing. Yields False if blocking is off and
+    another process holds it.
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(path + _LOCK_SUFFIX, "a") as f:
+        try:
+            fcntl.flock(f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, _META_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class EmbeddingSnapshot:
+    """
+    A collection's embeddings, IDs, documents and metadata in flat files
+    that can be searched without opening ChromaDB or loading its HNSW index.
+
+    Embeddings are a row-major float32 matrix read through np.memmap, so
+    opening a snapshot costs one pass over the (small) row index, and
+    search is an exact, vectorized scan over the mapped matrix. Documents
+    are kept in a separate file and only read for the rows returned.
+
+    Writes are append-only: added or replaced rows are appended, and
+    replaced or deleted rows are tombstoned by row number. A row is only
+    visible once its line in rows.jsonl is complete, so a torn write is
+    dropped the next time the snapshot is opened.
+
+    Several processes can share a snapshot (e.g. the GUI and
+    batch_indexer.py). Writes hold an exclusive file lock and reads a shared
+    one. Each export or create() gets a new generation, and before every
+    read or write the snapshot reloads its row index if the generation or
+    the files changed since it last read them.
+    """
+    def __init__(self, path, dim, space="l2", model_id=None, generation=None):
+        self.path = path
+        self.dim = dim
+        self.space = space
+        self.model_id = model_id
+        self.generation = generation
+
+        self._lock = threading.Lock()
+        # What this instance last saw on disk, to notice other processes' writes
+        self._rows_size = 0
+        self._tombstones_size = 0
+        self._ids = []
+        self._metadatas = []
+        self._doc_spans = []
+        self._row_of = {}
+        self._dead = np.zeros(0, dtype=bool)
+        self._vectors = None
+        self._norms = None
+        # Metadata fields as arrays, built on first use in a filter
+        self._columns = {}
+
+    @property
+    def live_count(self):
+        return len(self._row_of)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @classmethod
+    def load(cls, path, model_id=None):
+        """
+        Opens a snapshot, or returns None if there is none or it was built
+        with a different embedding model.
+        """
+        with _file_lock(path, shared=True):
+            meta = _read_meta(path)
+            if meta is None or meta.get("version") != SNAPSHOT_VERSION or (model_id and meta.get("model_id") != model_id):
+                return None
+            snapshot = cls(path, meta["dim"], meta.get("space", "l2"), meta.get("model_id"), meta.get("generation"))
+            snapshot._load_rows()
+            return snapshot
+
+    def _load_rows(self):
+        # Torn appends are only truncated while holding the file lock, when no write is in progress
+        rows_path = self._file(_ROWS_FILE)
+        line_ends = []
+        with open(rows_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # A torn final line from an interrupted append
+                row = json.loads(line)
+                self._row_of[row["id"]] = len(self._ids)
+                self._ids.append(row["id"])
+                self._metadatas.append(row["metadata"])
+                self._doc_spans.append((row["offset"], row["length"]))
+                line_ends.append((line_ends[-1] if line_ends else 0) + len(line))
+
+        # Keep the vector matrix and the row index the same length
+        row_bytes = 4 * self.dim
+        vector_rows = os.path.getsize(self._file(_VECTORS_FILE)) // row_bytes
+        count = min(len(self._ids), vector_rows)
+        if count < len(self._ids):
+            del self._ids[count:], self._metadatas[count:], self._doc_spans[count:]
+            self._row_of = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        with open(rows_path, "r+b") as f:
+            f.truncate(line_ends[count - 1] if count else 0)
+        with open(self._file(_VECTORS_FILE), "r+b") as f:
+            f.truncate(count * row_bytes)
+
+        # Only the latest row of each ID is live, even if a write stopped before tombstoning the old one
+        self._dead = np.ones(count, dtype=bool)
+        self._dead[list(self._row_of.values())] = False
+        tombstones_path = self._file(_TOMBSTONES_FILE)
+        if os.path.exists(tombstones_path):
+            with open(tombstones_path, "r+b") as f:
+                f.truncate(os.path.getsize(tombstones_path) // 4 * 4)
+            tombstones = np.fromfile(tombstones_path, dtype=np.int32)
+            self._dead[tombstones[tombstones < count]] = True
+        for doc_id, row in list(self._row_of.items()):
+            if self._dead[row]:
+                del self._row_of[doc_id]
+        self._rows_size = line_ends[count - 1] if count else 0
+        self._tombstones_size = _file_size(tombstones_path)
+
+    def _clear_locked(self):
+        self._vectors = None
+        self._norms = None
+        self._columns = {}
+        self._ids, self._metadatas, self._doc_spans = [], [], []
+        self._row_of = {}
+        self._dead = np.zeros(0, dtype=bool)
+
+    def _refresh_locked(self):
+        """
+        Reloads the row index if another process wrote to or replaced the
+        snapshot since this instance last read it. The file lock must be held.
+        """
+        meta = _read_meta(self.path)
+        if meta is None or meta.get("version") != SNAPSHOT_VERSION or meta.get("model_id") != self.model_id or meta.get("dim") != self.dim:
+            raise RuntimeError(f"Snapshot at {self.path} was removed or replaced by an incompatible one")
+        if (meta.get("generation") == self.generation
+                and _file_size(self._file(_ROWS_FILE)) == self._rows_size
+                and _file_size(self._file(_TOMBSTONES_FILE)) == self._tombstones_size):
+            return
+        self._clear_locked()
+        self.generation = meta.get("generation")
+        self.space = meta.get("space", "l2")
+        self._load_rows()
+
+    @contextmanager
+    def _reading(self):
+        # Doesn't wait for another process's write, so callers can fall back to ChromaDB
+        with self._lock, _file_lock(self.path, shared=True, blocking=False) as held:
+            if not held:
+                raise RuntimeError(f"Snapshot at {self.path} is being written by another process")
+            self._refresh_locked()
+            yield
+
+    @contextmanager
+    def _writing(self):
+        with self._lock, _file_lock(self.path):
+            self._refresh_locked()
+            yield
+
+    def _row_json(self, row):
+        offset, length = self._doc_spans[row]
+        return {"id": self._ids[row], "metadata": self._metadatas[row], "offset": offset, "length": length}
+
+    def _mapped_vectors(self):
+        if self._vectors is None:
+            count = len(self._ids)
+            if count == 0:
+                self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            else:
+                self._vectors = np.memmap(self._file(_VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, self.dim))
+            self._norms = np.einsum("ij,ij->i", self._vectors, self._vectors)
+        return self._vectors
+
+    def _read_documents(self, rows):
+        documents = []
+        with open(self._file(_DOCUMENTS_FILE), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ["" for _ in rows]
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for row in rows:
+                    offset, length = self._doc_spans[row]
+                    documents.append(data[offset:offset + length].decode("utf-8"))
+        return documents
+
+    def _column(self, field):
+        """
+        Returns (present, values, numbers) arrays for a metadata field across all rows.
+        """
+        column = self._columns.get(field)
+        if column is None:
+            missing = object()
+            raw = [(metadata or {}).get(field, missing) for metadata in self._metadatas]
+            present = np.fromiter((value is not missing for value in raw), dtype=bool, count=len(raw))
+            values = np.empty(len(raw), dtype=object)
+            values[:] = [None if value is missing else value for value in raw]
+            numbers = np.fromiter(
+                (value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan for value in raw),
+                dtype=np.float64, count=len(raw)
+            )
+            column = (present, values, numbers)
+            self._columns[field] = column
+        return column
+
+    def _where_mask(self, where):
+        """
+        Evaluates a ChromaDB `where` filter over every row at once.
+
+        Supports field equality, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin,
+        $and and $or. As in ChromaDB, rows without the field never match.
+        """
+        mask = np.ones(len(self._ids), dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self._where_mask(clause)
+                continue
+            if key == "$or":
+                any_mask = np.zeros(len(self._ids), dtype=bool)
+                for clause in condition:
+                    any_mask |= self._where_mask(clause)
+                mask &= any_mask
+                continue
+
+            present, values, numbers = self._column(key)
+            mask &= present
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for op, operand in condition.items():
+                if op in ("$eq", "$ne"):
+                    matched = values == operand
+                    mask &= matched if op == "$eq" else ~matched
+                elif op in ("$in", "$nin"):
+                    operands = set(operand)
+                    matched = np.fromiter((value in operands for value in values), dtype=bool, count=len(values))
+                    mask &= matched if op == "$in" else ~matched
+                elif op in _COMPARISONS:
+                    with np.errstate(invalid="ignore"):
+                        mask &= _COMPARISONS[op](numbers, operand)
+                else:
+                    raise ValueError(f"Unsupported where operator: {op}")
+        return mask
+
+    def matching_ids(self, where):
+        """
+        Returns the set of live IDs whose metadata matches a `where` filter.
+        """
+        with self._reading():
+            mask = self._where_mask(where) & ~self._dead
+            return {self._ids[row] for row in np.flatnonzero(mask)}
+
+    def query(self, query_embeddings, n_results=3, where=None):
+        """
+        Exact nearest-neighbour search, returning results shaped like
+        collection.query() with the collection's distance function.
+
+        Args:
+            query_embeddings (list): One or more query embeddings.
+            n_results (int): The number of results per query.
+            where (dict): Optional metadata filter, as for ChromaDB.
+        """
+        with self._reading():
+            vectors = self._mapped_vectors()
+            excluded = self._dead.copy()
+            if where:
+                # Filter first, so only matching rows can be returned
+                excluded |= ~self._where_mask(where)
+            candidates = int((~excluded).sum())
+
+            results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+            k = min(n_results, candidates)
+            for query in queries:
+                if k == 0:
+                    for key in results:
+                        results[key].append([])
+                    continue
+
+                dots = vectors @ query
+                if self.space == "cosine":
+                    distances = 1 - dots / np.maximum(np.sqrt(self._norms) * np.linalg.norm(query), 1e-12)
+                elif self.space == "ip":
+                    distances = 1 - dots
+                else:
+                    # Squared L2, as hnswlib reports it
+                    distances = self._norms - 2 * dots + float(query @ query)
+                distances = np.where(excluded, np.inf, distances)
+
+                top = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+                top = top[np.argsort(distances[top], kind="stable")]
+                results["ids"].append([self._ids[row] for row in top])
+                results["documents"].append(self._read_documents(top))
+                results["metadatas"].append([self._metadatas[row] for row in top])
+                results["distances"].append([float(distances[row]) for row in top])
+        return results
+
+    def get(self, ids):
+        """
+        Returns the documents and metadata of the given IDs that are present,
+        shaped like collection.get().
+        """
+        with self._reading():
+            rows = [self._row_of[doc_id] for doc_id in ids if doc_id in self._row_of]
+            return {
+                "ids": [self._ids[row] for row in rows],
+                "documents": self._read_documents(rows),
+                "metadatas": [self._metadatas[row] for row in rows],
+            }
+
+    def live_vectors(self):
+        """
+        Returns the IDs and a copy of the embeddings of every live row.
+        """
+        with self._reading():
+            rows = sorted(self._row_of.values())
+            return [self._ids[row] for row in rows], np.array(self._mapped_vectors()[rows])
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        """
+        Appends rows, tombstoning any earlier rows with the same IDs.
+        """
+        with self._writing():
+            replaced = [self._row_of[doc_id] for doc_id in ids if doc_id in self._row_of]
+
+            with open(self._file(_DOCUMENTS_FILE), "ab") as f:
+                offset = f.tell()
+                spans = []
+                for document in documents:
+                    data = (document or "").encode("utf-8")
+                    f.write(data)
+                    spans.append((offset, len(data)))
+                    offset += len(data)
+            with open(self._file(_VECTORS_FILE), "ab") as f:
+                f.write(np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim).tobytes())
+
+            first_row = len(self._ids)
+            for doc_id, metadata, span in zip(ids, metadatas, spans):
+                self._row_of[doc_id] = len(self._ids)
+                self._ids.append(doc_id)
+                self._metadatas.append(metadata)
+                self._doc_spans.append(span)
+            with open(self._file(_ROWS_FILE), "a", encoding="utf-8") as f:
+                for row in range(first_row, len(self._ids)):
+                    f.write(json.dumps(self._row_json(row)) + "\n")
+            self._rows_size = _file_size(self._file(_ROWS_FILE))
+
+            self._dead = np.concatenate([self._dead, np.zeros(len(self._ids) - first_row, dtype=bool)])
+            # Rows replaced by this write, including repeats of an ID within it
+            replaced.extend(row for row in range(first_row, len(self._ids)) if self._row_of[self._ids[row]] != row)
+            self._tombstone_locked(replaced)
+            self._vectors = None
+            self._columns = {}
+
+    def delete(self, ids):
+        with self._writing():
+            rows = [self._row_of.pop(doc_id) for doc_id in ids if doc_id in self._row_of]
+            self._tombstone_locked(rows)
+
+    def _tombstone_locked(self, rows):
+        if not rows:
+            return
+        self._dead[rows] = True
+        with open(self._file(_TOMBSTONES_FILE), "ab") as f:
+            f.write(np.asarray(rows, dtype=np.int32).tobytes())
+        self._tombstones_size = _file_size(self._file(_TOMBSTONES_FILE))
+
+    def close(self):
+        """
+        Releases the mapped embedding matrix and the in-memory row index.
+        """
+        with self._lock:
+            self._clear_locked()
+
+    def needs_compaction(self):
+        total = len(self._ids)
+        return total > 0 and (total - self.live_count) / total > _COMPACT_FRACTION
+
+    @classmethod
+    def create(cls, path, dim, space="l2", model_id=None):
+        """
+        Creates an empty snapshot, for a collection whose first rows are being written.
+        """
+        generation = uuid.uuid4().hex
+        with _file_lock(path):
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            for name in (_VECTORS_FILE, _ROWS_FILE, _DOCUMENTS_FILE):
+                open(os.path.join(path, name), "wb").close()
+            with open(os.path.join(path, _META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"version": SNAPSHOT_VERSION, "dim": dim, "space": space, "model_id": model_id, "generation": generation}, f)
+        return cls(path, dim, space, model_id, generation)
+
+    @classmethod
+    def export(cls, collection, path, model_id=None, space="l2"):
+        """
+        Writes a snapshot of a ChromaDB collection, replacing any existing one.
+
+        The snapshot is built in a temporary directory and swapped into place,
+        so readers never see a partial export. The exclusive file lock is held
+        throughout, so another process's writes wait for the new snapshot
+        rather than going to the one being replaced.
+
+        Returns:
+            The loaded snapshot.
+        """
+        with _file_lock(path):
+            return cls._export_locked(collection, path, model_id, space)
+
+    @classmethod
+    def _export_locked(cls, collection, path, model_id, space):
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        dim = None
+        total = collection.count()
+        with open(os.path.join(tmp_path, _VECTORS_FILE), "wb") as vectors_file, \
+                open(os.path.join(tmp_path, _DOCUMENTS_FILE), "wb") as documents_file, \
+                open(os.path.join(tmp_path, _ROWS_FILE), "w", encoding="utf-8") as rows_file:
+            for offset in range(0, total, _EXPORT_PAGE_SIZE):
+                page = collection.get(include=["embeddings", "documents", "metadatas"], limit=_EXPORT_PAGE_SIZE, offset=offset)
+                embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+                if len(embeddings) == 0:
+                    continue
+                dim = embeddings.shape[1]
+                vectors_file.write(embeddings.tobytes())
+                for doc_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                    data = (document or "").encode("utf-8")
+                    rows_file.write(json.dumps({"id": doc_id, "metadata": metadata, "offset": documents_file.tell(), "length": len(data)}) + "\n")
+                    documents_file.write(data)
+        if dim is None:
+            # Nothing to search yet; the snapshot is created on the first write instead
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return None
+
+        generation = uuid.uuid4().hex
+        with open(os.path.join(tmp_path, _META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "dim": dim, "space": space, "model_id": model_id, "generation": generation}, f)
+
+        old_path = path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        snapshot = cls(path, dim, space, model_id, generation)
+        snapshot._load_rows()
+        return snapshot
+
+    @staticmethod
+    def remove(path):
+        with _file_lock(path):
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,272 @@
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from chromadb.utils import embedding_functions
+from db_handler import DBHandlerPool, STORAGE_ROOT, list_books, manifest_path, safe_book_id
+
+DEFAULT_SHARD_TIMEOUT = 2.0
+# Books each query is routed to by default; well under the pool size, so routed shards stay open
+DEFAULT_MAX_SHARDS = 8
+# Stores kept open between queries
+DEFAULT_POOL_SIZE = 16
+_CENTROID_PAGE_SIZE = 1000
+
+
+# Bumped when the centroid definition changes, so older cached centroids are recomputed
+CENTROID_VERSION = 2
+
+
+def _normalize(vectors):
+    """
+    Scales vectors (or a single vector) to unit length.
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def centroid_path(book_id):
+    """
+    Returns the path of a book's cached full_text_source centroid.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.centroid.json")
+
+
+class FederatedSearch:
+    """
+    Searches full_text_source across many books with a single query embedding.
+
+    Each book is a shard with its own PersistentClient. Each book's
+    normalized mean embedding (its centroid) is cached next to its store,
+    and a query is only sent to the max_shards books whose centroids are
+    most similar to it (cosine), plus any book that has no centroid yet. A
+    book's best chunks can lie far from its centroid, so routed results are
+    approximate. With max_shards=0 every book is searched, and the merged
+    top results are exact, apart from shards that time out.
+
+    Opening stores and computing centroids is kept out of the query path:
+    prepare() does both in the background, and a routed query only schedules
+    missing centroids to be computed there.
+    """
+    def __init__(self, pool=None, embedding_function=None, max_workers=8,
+                 shard_timeout=DEFAULT_SHARD_TIMEOUT, max_shards=DEFAULT_MAX_SHARDS):
+        """
+        Args:
+            pool (DBHandlerPool): Keeps recently searched books open between queries.
+            embedding_function: Must match the one the books were indexed with.
+            max_workers (int): Number of shards searched concurrently.
+            shard_timeout (float): Seconds to wait for shards before merging what has returned.
+            max_shards (int): Number of books each query is routed to by centroid
+                similarity. 0 or None searches every book.
+        """
+        self.embedding_function = embedding_function or embedding_functions.DefaultEmbeddingFunction()
+        self.pool = pool or DBHandlerPool(max_open=max(max_shards or 0, DEFAULT_POOL_SIZE), embedding_function=self.embedding_function)
+        self.shard_timeout = shard_timeout
+        self.max_shards = max_shards
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="federated")
+        # Opening stores and computing centroids, off the query path
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="federated-prepare")
+        self._centroids = {}
+        self._pending_centroids = set()
+        # Books whose shard search is still running, e.g. after timing out
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def _load_centroid(self, book_id):
+        """
+        Returns the cached centroid for a book, or None if it is missing or the
+        book has been re-indexed since it was computed.
+        """
+        try:
+            manifest_mtime = os.stat(manifest_path(book_id)).st_mtime_ns
+        except OSError:
+            manifest_mtime = None
+
+        cached = self._centroids.get(book_id)
+        if cached is None:
+            try:
+                with open(centroid_path(book_id), "r", encoding="utf-8") as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if cached.get("version") != CENTROID_VERSION:
+                return None
+            cached["vector"] = np.asarray(cached["vector"], dtype=np.float32)
+            self._centroids[book_id] = cached
+
+        if cached.get("manifest_mtime_ns") != manifest_mtime:
+            return None
+        return cached["vector"]
+
+    def _compute_centroid(self, book_id):
+        """
+        Computes and caches a book's centroid: the normalized mean of its
+        normalized chunk embeddings.
+        """
+        try:
+            with self.pool.lease(book_id) as handler:
+                collection = handler.full_text_source
+                total = collection.count()
+                if total == 0:
+                    return
+                vector_sum = None
+                for offset in range(0, total, _CENTROID_PAGE_SIZE):
+                    rows = collection.get(include=["embeddings"], limit=_CENTROID_PAGE_SIZE, offset=offset)
+                    batch_sum = _normalize(np.asarray(rows["embeddings"], dtype=np.float32)).sum(axis=0)
+                    vector_sum = batch_sum if vector_sum is None else vector_sum + batch_sum
+            centroid = _normalize(vector_sum)
+
+            try:
+                manifest_mtime = os.stat(manifest_path(book_id)).st_mtime_ns
+            except OSError:
+                manifest_mtime = None
+            entry = {"version": CENTROID_VERSION, "manifest_mtime_ns": manifest_mtime, "count": total, "vector": centroid.tolist()}
+            with open(centroid_path(book_id), "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            entry["vector"] = centroid
+            self._centroids[book_id] = entry
+        except Exception as e:
+            print(f"Federated search: error computing the centroid of '{book_id}': {e}")
+        finally:
+            with self._lock:
+                self._pending_centroids.discard(book_id)
+
+    def _schedule_centroid(self, book_id):
+        with self._lock:
+            if book_id in self._pending_centroids:
+                return
+            self._pending_centroids.add(book_id)
+        self._background.submit(self._compute_centroid, book_id)
+
+    def prepare(self, book_ids=None):
+        """
+        Opens books' stores (up to the pool size) and, when routing, computes
+        missing centroids, in the background so later queries don't pay for it.
+        """
+        book_ids = book_ids if book_ids is not None else list_books()
+        if len(book_ids) > self.pool.max_open:
+            print(f"Federated search: opening {self.pool.max_open} of {len(book_ids)} books in advance (the pool size); "
+                  f"the rest are opened when a query is routed to them")
+        for book_id in book_ids[:self.pool.max_open]:
+            self._background.submit(self.pool.get, book_id)
+        if self.max_shards:
+            for book_id in book_ids:
+                if self._load_centroid(book_id) is None:
+                    self._schedule_centroid(book_id)
+
+    def _route(self, query_embedding, book_ids, max_shards):
+        """
+        Returns the books to search: every book without a centroid, plus the
+        max_shards books whose centroids are most similar to the query.
+        """
+        query = _normalize(query_embedding)
+        unrouted, scored = [], []
+        for book_id in book_ids:
+            centroid = self._load_centroid(book_id)
+            if centroid is None:
+                unrouted.append(book_id)
+                self._schedule_centroid(book_id)
+            else:
+                scored.append((float(centroid @ query), book_id))
+        return unrouted + [book_id for _, book_id in heapq.nlargest(max_shards, scored)]
+
+    def _search_shard(self, book_id, query_embedding, n_results, where, cancel_event):
+        try:
+            # A shard that only starts after the query has timed out is skipped
+            if cancel_event.is_set():
+                return []
+            with self.pool.lease(book_id) as handler:
+                if cancel_event.is_set():
+                    return []
+                results = handler.query_by_embedding(handler.full_text_source, query_embedding.tolist(), n_results=n_results, where=where)
+        finally:
+            with self._lock:
+                self._in_flight.discard(book_id)
+        if not results or not results['ids']:
+            return []
+        return [
+            {"book_id": book_id, "id": chunk_id, "document": document, "metadata": metadata, "distance": distance}
+            for chunk_id, document, metadata, distance in zip(
+                results['ids'][0], results['documents'][0], results['metadatas'][0], results['distances'][0]
+            )
+        ]
+
+    def search(self, query_text, n_results=5, book_ids=None, max_shards=None, timeout=None, where=None):
+        """
+        Searches full_text_source across books and merges the top results by distance.
+
+        Args:
+            query_text (str): The text to search for.
+            n_results (int): The number of merged results to return.
+            book_ids (list): Restrict the search to these books (default: all books).
+            max_shards (int): Overrides the routing set in the constructor; 0
+                searches every book.
+            timeout (float): Overrides the shard timeout. Shards that haven't
+                answered in time are left out of the results, and a book whose
+                previous search is still running is skipped rather than queued
+                again. Opening a store that prepare() hasn't opened yet counts
+                against the timeout.
+            where (dict): Optional metadata filter applied in every shard.
+
+        Returns:
+            A list of dicts with book_id, id, document, metadata and distance,
+            nearest first.
+        """
+        started = time.perf_counter()
+        query_embedding = np.asarray(self.embedding_function([query_text])[0], dtype=np.float32)
+        candidates = book_ids if book_ids is not None else list_books()
+        max_shards = self.max_shards if max_shards is None else max_shards
+        shards = self._route(query_embedding, candidates, max_shards) if max_shards else list(candidates)
+        if len(shards) > self.pool.max_open:
+            print(f"Federated search: {len(shards)} shards but only {self.pool.max_open} stores are kept open; "
+                  f"the rest are reopened on every query")
+
+        with self._lock:
+            busy = [book_id for book_id in shards if book_id in self._in_flight]
+            shards = [book_id for book_id in shards if book_id not in self._in_flight]
+            self._in_flight.update(shards)
+        for book_id in busy:
+            print(f"Federated search: shard '{book_id}' is still busy with an earlier query; skipped")
+
+        cancel_event = threading.Event()
+        futures = {
+            self._executor.submit(self._search_shard, book_id, query_embedding, n_results, where, cancel_event): book_id
+            for book_id in shards
+        }
+        done, not_done = wait(futures, timeout=timeout if timeout is not None else self.shard_timeout)
+        # Queued shards are dropped; running ones can't be interrupted, but skip their query if they haven't started it
+        cancel_event.set()
+        for future in not_done:
+            if future.cancel():
+                with self._lock:
+                    self._in_flight.discard(futures[future])
+            print(f"Federated search: shard '{futures[future]}' timed out")
+
+        hits = []
+        for future in done:
+            try:
+                hits.extend(future.result())
+            except Exception as e:
+                print(f"Federated search: error searching '{futures[future]}': {e}")
+
+        merged = heapq.nsmallest(n_results, hits, key=lambda hit: hit["distance"])
+        print(f"Federated search over {len(done)}/{len(shards) + len(busy)} shards ({len(candidates)} books) in {time.perf_counter() - started:.3f}s")
+        return merged
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._background.shutdown(wait=False, cancel_futures=True)
+        self.pool.close_all()
+
+if __name__ == '__main__':
+    # Search the whole library from the command line
+    query = " ".join(sys.argv[1:]) or "What is a Python decorator?"
+    search = FederatedSearch()
+    search.prepare()
+    for hit in search.search(query):
+        print(f"[{hit['book_id']} | {hit['distance']:.3f}] {hit['document'][:120]!r}")
+    search.close()
@@ -0,0 +1,155 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+# Priority of chat replies; lower values run first
+PRIORITY_INTERACTIVE = 0
+
+
+def plan_batches(lengths, max_new_tokens, token_budget, max_batch_size=None):
+    """
+    Groups prompts into batches for generate_batch().
+
+    Prompts are sorted by length so each batch pads as little as possible, and
+    a batch grows while batch size x (its longest prompt + max_new_tokens)
+    stays within token_budget. A prompt too long for the budget on its own
+    still gets a batch of one.
+
+    Args:
+        lengths (list): The token length of each prompt.
+        max_new_tokens (int): Tokens generated per prompt.
+        token_budget (int): Maximum padded tokens per batch, prompt plus output.
+        max_batch_size (int): Optional cap on prompts per batch.
+
+    Returns:
+        A list of batches, each a list of indexes into lengths.
+    """
+    batches = []
+    batch = []
+    longest = 0
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        longest_with = max(longest, lengths[index])
+        too_many = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (too_many or (len(batch) + 1) * (longest_with + max_new_tokens) > token_budget):
+            batches.append(batch)
+            batch = []
+            longest_with = lengths[index]
+        batch.append(index)
+        longest = longest_with
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class GenerationJob:
+    """
+    A queued generation. future resolves to the generated text (partial if the
+    job was stopped), or is cancelled if the job was stopped before it started.
+    """
+    def __init__(self, prompt, priority, max_new_tokens, prefix, on_text):
+        self.prompt = prompt
+        self.priority = priority
+        self.max_new_tokens = max_new_tokens
+        self.prefix = prefix
+        self.on_text = on_text
+        self.future = Future()
+        self.stop_event = threading.Event()
+
+    def cancel(self):
+        """
+        Stops the job: a queued job never starts, and a running one stops
+        after its current token.
+        """
+        self.stop_event.set()
+        self.future.cancel() # Only succeeds while the job is still queued
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+
+class GenerationWorker:
+    """
+    Runs every generation on one background thread, which owns the model.
+
+    Jobs are taken from a priority queue, lowest priority value first and in
+    submission order within a priority. Each submit() returns a GenerationJob
+    whose future the UI can poll without blocking the Tk loop.
+    """
+    def __init__(self, llm_handler):
+        self.llm_handler = llm_handler
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._current = None
+        self._thread = threading.Thread(target=self._run, name="llm-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, priority=PRIORITY_INTERACTIVE, max_new_tokens=150, prefix=None, on_text=None):
+        """
+        Queues a generation.
+
+        Args:
+            prompt (str or callable): The prompt, or a function returning it,
+                called on the worker thread when the job starts. Use a function
+                when building the prompt is slow or should see the latest state.
+            priority (int): Lower values run first; chat uses PRIORITY_INTERACTIVE.
+            max_new_tokens (int): The maximum number of tokens to generate.
+            prefix (str): Stable prompt prefix, see LLMHandler.generate_response().
+            on_text (callable): Called on the worker thread with each piece of
+                text as it is generated.
+
+        Returns:
+            GenerationJob
+        """
+        job = GenerationJob(prompt, priority, max_new_tokens, prefix, on_text)
+        self._queue.put((priority, next(self._sequence), job))
+        return job
+
+    def _run(self):
+        # Jobs can be queued while the model is still loading
+        self.llm_handler.ready.wait()
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue # Cancelled while queued
+
+            self._current = job
+            try:
+                job.future.set_result(self._generate(job))
+            except Exception as e:
+                print(f"Error during text generation: {e}")
+                job.future.set_exception(e)
+            finally:
+                self._current = None
+
+    def _generate(self, job):
+        prompt = job.prompt() if callable(job.prompt) else job.prompt
+        pieces = []
+        for text in self.llm_handler.stream_response(prompt, max_new_tokens=job.max_new_tokens,
+                                                     prefix=job.prefix, stop_event=job.stop_event):
+            pieces.append(text)
+            if job.on_text:
+                job.on_text(text)
+        return "".join(pieces).strip()
+
+    def close(self, timeout=10):
+        """
+        Cancels queued and running jobs and stops the worker thread.
+        """
+        while True:
+            try:
+                _, _, job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.cancel()
+        current = self._current
+        if current:
+            current.cancel()
+        # Sorts ahead of any job submitted meanwhile
+        self._queue.put((float("-inf"), next(self._sequence), None))
+        if self.llm_handler.ready.is_set():
+            self._thread.join(timeout)
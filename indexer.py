@@ -0,0 +1,538 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+from ebooklib import epub, ITEM_DOCUMENT
+from bs4 import BeautifulSoup
+from chunker import TextChunker, load_chunker
+from pdf_extract import extract_page_range, init_worker, pdf_page_chunks, worker_context
+
+# Number of chunks sent to the collection per add call. Only one batch is
+# held in memory at a time, so this bounds the memory used by indexing.
+DEFAULT_BATCH_SIZE = 256
+
+# Parallel PDF extraction hands each worker process this many pages at a time.
+PAGES_PER_TASK = 16
+# Below this page count, process start-up costs more than it saves.
+PARALLEL_MIN_PAGES = 64
+
+
+def _epub_item_chunks(item, book_id, item_num, chunker):
+    """
+    Returns the (document, metadata, id) chunks for a single EPUB document item.
+    char_start/char_end are offsets into the item's extracted text.
+    """
+    soup = BeautifulSoup(item.get_content(), 'html.parser')
+    text = soup.get_text()
+    if not text.strip():
+        return []
+
+    # Paragraph breaks are the preferred chunk boundaries
+    return [
+        (
+            chunk_text,
+            {
+                "source": book_id, "item_num": item_num, "chunk_num": j,
+                "char_start": char_start, "char_end": char_end, "token_count": token_count
+            },
+            f"{book_id}_item_{item_num}_chunk_{j}"
+        )
+        for j, (chunk_text, char_start, char_end, token_count) in enumerate(chunker.chunk(text))
+    ]
+
+
+def iter_pdf_units(file_path, book_id, chunker):
+    """
+    Yields (page_num, chunks) for each page of a PDF, one page at a time.
+    """
+    with fitz.open(file_path) as doc:
+        for i, page in enumerate(doc):
+            yield i, pdf_page_chunks(page, book_id, i, chunker)
+
+
+def iter_pdf_units_parallel(file_path, book_id, chunker, workers=None, pages_per_task=PAGES_PER_TASK):
+    """
+    Yields the same (page_num, chunks) units as iter_pdf_units, in page order,
+    but extracts page ranges across a ProcessPoolExecutor.
+
+    At most two ranges per worker are in flight at once, so memory stays
+    bounded no matter how large the PDF is.
+    """
+    with fitz.open(file_path) as doc:
+        page_count = doc.page_count
+
+    workers = workers or os.cpu_count() or 1
+    if workers < 2 or page_count < PARALLEL_MIN_PAGES:
+        yield from iter_pdf_units(file_path, book_id, chunker)
+        return
+
+    ranges = iter([(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)])
+    # Workers are spawned without re-running the launching script, see pdf_extract.worker_context()
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=worker_context(),
+        initializer=init_worker, initargs=(chunker,)
+    )
+    try:
+        pending = deque()
+        for start, stop in ranges:
+            pending.append(executor.submit(extract_page_range, file_path, book_id, start, stop))
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            # Results are consumed in submission order, which is page order
+            units = pending.popleft().result()
+            next_range = next(ranges, None)
+            if next_range:
+                pending.append(executor.submit(extract_page_range, file_path, book_id, *next_range))
+            yield from units
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_epub_units(file_path, book_id, chunker):
+    """
+    Yields (item_num, chunks) for each ITEM_DOCUMENT of an EPUB, one item at a time.
+    """
+    book = epub.read_epub(file_path)
+    for i, item in enumerate(book.get_items_of_type(ITEM_DOCUMENT)):
+        yield i, _epub_item_chunks(item, book_id, i, chunker)
+
+
+def iter_document_units(file_path, book_id, chunker=None, parallel=False, workers=None):
+    """
+    Yields (unit_num, chunks) for a PDF (pages) or EPUB (document items).
+    With parallel=True, PDF pages are extracted across worker processes.
+    Without a chunker, a TextChunker with approximate token counts is used.
+    """
+    chunker = chunker or TextChunker()
+    if file_path.lower().endswith('.pdf'):
+        if parallel:
+            return iter_pdf_units_parallel(file_path, book_id, chunker, workers=workers)
+        return iter_pdf_units(file_path, book_id, chunker)
+    elif file_path.lower().endswith('.epub'):
+        return iter_epub_units(file_path, book_id, chunker)
+    raise ValueError(f"Unsupported document type: {file_path}")
+
+
+def count_document_units(file_path):
+    """
+    Returns the number of units (PDF pages or EPUB document items) in a document.
+    """
+    if file_path.lower().endswith('.pdf'):
+        with fitz.open(file_path) as doc:
+            return doc.page_count
+    elif file_path.lower().endswith('.epub'):
+        return sum(1 for _ in epub.read_epub(file_path).get_items_of_type(ITEM_DOCUMENT))
+    raise ValueError(f"Unsupported document type: {file_path}")
+
+
+def iter_document_chunks(file_path, book_id, chunker=None, parallel=False, workers=None):
+    """
+    Yields (document, metadata, id) chunks for a document, page by page.
+    """
+    for _, chunks in iter_document_units(file_path, book_id, chunker=chunker, parallel=parallel, workers=workers):
+        yield from chunks
+
+
+def chunk_hash(document, metadata, model_id=None):
+    """
+    Returns a stable content hash for a chunk's text and metadata.
+
+    With a model_id the hash also covers the embedding model, so a chunk
+    embedded by a different model never counts as unchanged.
+    """
+    content = [document, metadata] if model_id is None else [document, metadata, model_id]
+    payload = json.dumps(content, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def source_signature(file_path):
+    """
+    Returns the size and modification time of a source document.
+    """
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class IndexManifest:
+    """
+    Records the content hash of every chunk indexed for a book.
+
+    The manifest is an append-only JSON-lines file, so progress is saved after
+    every batch and an interrupted run can pick up where it stopped. compact()
+    rewrites it down to the current state once a run completes.
+
+    model_id is the embedding model the latest run wrote with. Manifests from
+    before it was recorded have none, and their hashes don't cover the model.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}
+        self.complete = False
+        self.source = None
+        self.model_id = None
+        self._load()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _load(self):
+        if not self.exists():
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from a killed run; everything before it is valid
+                    continue
+                op = entry.get("op")
+                if op == "set":
+                    self.hashes[entry["id"]] = entry["hash"]
+                elif op == "del":
+                    self.hashes.pop(entry["id"], None)
+                elif op == "begin":
+                    self.complete = False
+                    self.model_id = entry.get("model_id", self.model_id)
+                elif op == "complete":
+                    self.complete = True
+                    self.source = entry.get("source")
+
+    def _append(self, entries):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        torn = False
+        if self.exists() and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            if torn:
+                # Start a fresh line so the next entry isn't lost with the torn one
+                f.write("\n")
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def is_current(self, file_path, collection=None, model_id=None):
+        """
+        True if the last run completed and the source file has not changed since.
+        With a collection, it must also still hold exactly the manifest's chunks,
+        and with a model_id, they must have been embedded by that model.
+        """
+        if not (self.complete and self.source == source_signature(file_path)):
+            return False
+        if model_id is not None and self.model_id != model_id:
+            return False
+        return collection is None or self.matches(collection)
+
+    def matches(self, collection):
+        """
+        True if the collection holds as many chunks as the manifest records.
+        They differ if the book's store was deleted, cleared or lost, while the
+        manifest next to it survived.
+        """
+        return collection.count() == len(self.hashes)
+
+    def reset(self):
+        """
+        Forgets every recorded chunk and deletes the manifest file.
+        """
+        self.hashes = {}
+        self.complete = False
+        self.source = None
+        self.model_id = None
+        if self.exists():
+            os.remove(self.path)
+
+    def begin(self, model_id=None):
+        """
+        Starts a run. The chunks it records are hashed with model_id.
+        """
+        self.complete = False
+        entry = {"op": "begin"}
+        if model_id is not None:
+            self.model_id = model_id
+            entry["model_id"] = model_id
+        self._append([entry])
+
+    def record(self, hashes):
+        """
+        Records (id, hash) pairs for chunks that were written to the collection.
+        """
+        hashes = list(hashes)
+        self.hashes.update(hashes)
+        self._append({"op": "set", "id": chunk_id, "hash": h} for chunk_id, h in hashes)
+
+    def remove(self, ids):
+        for chunk_id in ids:
+            self.hashes.pop(chunk_id, None)
+        self._append({"op": "del", "id": chunk_id} for chunk_id in ids)
+
+    def mark_complete(self, source):
+        self.complete = True
+        self.source = source
+        self._append([{"op": "complete", "source": source}])
+
+    def compact(self):
+        """
+        Rewrites the manifest as one entry per chunk, replacing the log of past runs.
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if self.model_id is not None:
+                f.write(json.dumps({"op": "begin", "model_id": self.model_id}) + "\n")
+            for chunk_id, h in self.hashes.items():
+                f.write(json.dumps({"op": "set", "id": chunk_id, "hash": h}) + "\n")
+            if self.complete:
+                f.write(json.dumps({"op": "complete", "source": self.source}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def bootstrap(self, collection, model_id=None, page_size=1000):
+        """
+        Builds the manifest from chunks already in a collection, so books indexed
+        before manifests existed are diffed rather than re-embedded. Their
+        vectors are taken to be from model_id.
+        """
+        total = collection.count()
+        for offset in range(0, total, page_size):
+            rows = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            self.record([
+                (chunk_id, chunk_hash(document, metadata, model_id))
+                for chunk_id, document, metadata in zip(rows["ids"], rows["documents"], rows["metadatas"])
+            ])
+        if total:
+            print(f"Bootstrapped manifest with {total} existing chunks at {self.path}")
+
+
+class IndexStats:
+    """
+    Running counters for a single indexing run.
+    """
+    def __init__(self, units_total=0):
+        self.units_total = units_total
+        self.units_done = 0
+        self.chunks_indexed = 0
+        self.chunks_unchanged = 0
+        self.chunks_removed = 0
+        self.chunks_failed = 0
+        self.cancelled = False
+        # Time spent in collection writes, which is dominated by embedding
+        self.embed_seconds = 0.0
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def extract_seconds(self):
+        """
+        Time spent extracting, chunking and diffing, i.e. everything but writes.
+        """
+        return self.elapsed - self.embed_seconds
+
+    @property
+    def chunks_per_second(self):
+        elapsed = self.elapsed
+        return self.chunks_indexed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def fraction_done(self):
+        return self.units_done / self.units_total if self.units_total else 0.0
+
+    @property
+    def eta_seconds(self):
+        """
+        Estimated seconds remaining, based on the rate units have been processed so far.
+        """
+        if not self.units_done or not self.units_total:
+            return None
+        return (self.units_total - self.units_done) * self.elapsed / self.units_done
+
+
+def index_document(db_handler, file_path, book_id, batch_size=DEFAULT_BATCH_SIZE, progress_callback=None, parallel=False, workers=None, cancel_event=None, chunker=None):
+    """
+    Brings the full_text_source collection in line with a document.
+
+    Chunks are streamed in fixed-size batches and compared with the book's
+    IndexManifest: only new or changed chunks are embedded and written, and
+    chunks that no longer exist in the document are deleted. The book's BM25
+    lexical index is kept in step with the collection.
+
+    Chunk hashes include the handler's embedding model, so indexing with a
+    different model (e.g. --quantized on a book indexed in fp32) re-embeds
+    every chunk instead of leaving the collection with mixed vectors.
+
+    Args:
+        db_handler: The DBHandler for the book.
+        file_path (str): Path to the PDF or EPUB file.
+        book_id (str): The book ID used in chunk metadata and IDs.
+        batch_size (int): Number of chunks written per upsert call.
+        progress_callback: Optional callable receiving the IndexStats after each unit and batch.
+        parallel (bool): Extract PDF pages across worker processes.
+        workers (int): Number of worker processes (defaults to the CPU count).
+        cancel_event (threading.Event): When set, the run stops after the current
+            unit. Chunks written so far are kept in the manifest, so the next run
+            resumes from there.
+        chunker (TextChunker): Splits each unit's text into token-bounded chunks.
+
+    Returns:
+        The IndexStats for the run. A failed batch is counted in chunks_failed
+        and does not stop the remaining batches from being written.
+    """
+    collection = db_handler.full_text_source
+    model_id = db_handler.embedding_model_id
+    manifest = IndexManifest(db_handler.manifest_path)
+    if manifest.exists() and not manifest.matches(collection):
+        # The collection is the source of truth: rebuild the manifest from what it actually holds
+        print(f"Manifest for '{book_id}' records {len(manifest.hashes)} chunks but the collection has {collection.count()}; rebuilding it")
+        manifest.reset()
+    elif manifest.exists() and manifest.model_id is None:
+        # Written before manifests recorded the model; its hashes don't cover one
+        print(f"Manifest for '{book_id}' doesn't record its embedding model; rebuilding it for {model_id}")
+        manifest.reset()
+    elif manifest.exists() and manifest.model_id != model_id:
+        print(f"'{book_id}' was embedded with {manifest.model_id}; re-embedding every chunk with {model_id}")
+    if not manifest.exists():
+        manifest.bootstrap(collection, model_id)
+    # Loaded (or rebuilt from the collection) before the run changes the manifest
+    lexical_index = db_handler.lexical_index
+    manifest.begin(model_id)
+
+    stats = IndexStats(units_total=count_document_units(file_path))
+    seen_ids = set()
+    batch = []
+
+    def flush():
+        documents, metadatas, ids, hashes = zip(*batch)
+        write_started = time.perf_counter()
+        written = db_handler.upsert_to_collection(collection, list(documents), list(metadatas), list(ids))
+        stats.embed_seconds += time.perf_counter() - write_started
+        if written:
+            manifest.record(zip(ids, hashes))
+            lexical_index.add(ids, documents)
+            stats.chunks_indexed += len(batch)
+        else:
+            stats.chunks_failed += len(batch)
+        batch.clear()
+        print(f"Indexed {stats.chunks_indexed} chunks from '{book_id}' ({stats.chunks_per_second:.1f} chunks/s)")
+        if progress_callback:
+            progress_callback(stats)
+
+    units = iter_document_units(file_path, book_id, chunker=chunker, parallel=parallel, workers=workers)
+    try:
+        for _, chunks in units:
+            if cancel_event and cancel_event.is_set():
+                stats.cancelled = True
+                break
+            for document, metadata, chunk_id in chunks:
+                seen_ids.add(chunk_id)
+                h = chunk_hash(document, metadata, model_id)
+                if manifest.hashes.get(chunk_id) == h:
+                    stats.chunks_unchanged += 1
+                    continue
+                batch.append((document, metadata, chunk_id, h))
+                if len(batch) >= batch_size:
+                    flush()
+            stats.units_done += 1
+            if progress_callback:
+                progress_callback(stats)
+    finally:
+        units.close()
+
+    if batch:
+        flush()
+
+    if stats.cancelled:
+        print(f"Indexing of '{book_id}' cancelled after {stats.units_done} of {stats.units_total} units.")
+        lexical_index.save()
+        stats.finished_at = time.perf_counter()
+        return stats
+
+    # Anything in the manifest that the document no longer produces is stale
+    removed_ids = [chunk_id for chunk_id in manifest.hashes if chunk_id not in seen_ids]
+    for start in range(0, len(removed_ids), batch_size):
+        ids = removed_ids[start:start + batch_size]
+        if db_handler.delete_from_collection(collection, ids):
+            manifest.remove(ids)
+            lexical_index.remove(ids)
+            stats.chunks_removed += len(ids)
+        else:
+            stats.chunks_failed += len(ids)
+
+    if not stats.chunks_failed:
+        manifest.mark_complete(source_signature(file_path))
+        manifest.compact()
+    # Saved after the manifest, so a newer manifest means the index missed writes
+    lexical_index.save()
+
+    stats.finished_at = time.perf_counter()
+    return stats
+
+
+class IndexingWorker:
+    """
+    Runs index_document on a background thread.
+
+    Tk widgets may only be touched from the thread running mainloop, so the
+    worker never calls back into the UI. Instead the UI polls `stats`,
+    `is_alive()` and `error` (e.g. via root.after).
+
+    With tokenizer_path, the worker builds its own chunker with load_chunker()
+    on its thread: tokenizers are not safe to share across threads, and the
+    chunker must match the batch indexer's. on_finished is called on the
+    worker thread once it stops, however it stops.
+    """
+    def __init__(self, db_handler, file_path, book_id, tokenizer_path=None, on_finished=None, **index_kwargs):
+        self.db_handler = db_handler
+        self.file_path = file_path
+        self.book_id = book_id
+        self.tokenizer_path = tokenizer_path
+        self.on_finished = on_finished
+        self.index_kwargs = index_kwargs
+        self.cancel_event = threading.Event()
+        self.stats = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name=f"indexer-{book_id}", daemon=True)
+
+    def _run(self):
+        try:
+            if self.tokenizer_path:
+                self.index_kwargs["chunker"] = load_chunker(self.tokenizer_path)
+            self.stats = index_document(
+                self.db_handler, self.file_path, self.book_id,
+                progress_callback=self._on_progress,
+                cancel_event=self.cancel_event,
+                **self.index_kwargs
+            )
+        except Exception as e:
+            print(f"Error indexing '{self.book_id}': {e}")
+            self.error = e
+        finally:
+            if self.on_finished:
+                self.on_finished()
+
+    def _on_progress(self, stats):
+        self.stats = stats
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
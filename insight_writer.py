@@ -0,0 +1,163 @@
+import json
+import os
+import queue
+import threading
+import time
+from db_handler import STORAGE_ROOT, safe_book_id
+
+# Flush once this many writes are queued...
+DEFAULT_MAX_BATCH = 32
+# ...or once the oldest queued write has waited this many seconds
+DEFAULT_MAX_DELAY = 2.0
+
+
+def insight_journal_path(book_id):
+    """
+    Returns the path of a book's journal of not-yet-flushed insight writes.
+    """
+    return os.path.join(STORAGE_ROOT, f"{safe_book_id(book_id)}.insights.journal")
+
+
+class InsightWriter:
+    """
+    Write-behind queue for captured insights.
+
+    submit() appends the write to an fsync'd journal and returns immediately.
+    A background thread coalesces queued writes into one upsert per
+    collection, flushing when DEFAULT_MAX_BATCH writes are waiting or the
+    oldest has waited DEFAULT_MAX_DELAY seconds. The journal is truncated
+    once everything in it has been written; if the app is killed first,
+    the journal is replayed the next time the book is opened. Upserts make
+    the replay safe even if some of it had already been written.
+    """
+    def __init__(self, db_handler, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        self.db_handler = db_handler
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.journal_path = insight_journal_path(db_handler.book_id)
+
+        self._queue = queue.Queue()
+        self._journal_lock = threading.Lock()
+        self._unflushed = 0
+        self._stopping = False
+
+        self._replay_journal()
+        self._thread = threading.Thread(target=self._run, name=f"insight-writer-{db_handler.book_id}", daemon=True)
+        self._thread.start()
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        entries = []
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue # A torn final line; the write it held never returned
+        # Rewrite the journal without any torn line, so new entries start on a clean line
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+        for entry in entries:
+            self._queue.put(entry)
+        self._unflushed = len(entries)
+        if entries:
+            print(f"Replaying {len(entries)} unflushed insight writes from {self.journal_path}")
+
+    def submit(self, collection_name, document, metadata, doc_id):
+        """
+        Queues a write to one of the handler's collections (by name) and
+        records it in the journal. Returns as soon as the journal is synced.
+        After close(), the write is only journaled, and is written when the
+        book's next InsightWriter replays the journal.
+        """
+        entry = {"collection": collection_name, "document": document, "metadata": metadata, "id": doc_id}
+        with self._journal_lock:
+            os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._unflushed += 1
+        self._queue.put(entry)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            flush_event = None
+            if isinstance(item, threading.Event):
+                flush_event = item
+            elif item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_delay
+
+            due = deadline is not None and time.monotonic() >= deadline
+            if batch and (flush_event or due or len(batch) >= self.max_batch):
+                batch = self._write(batch)
+                deadline = time.monotonic() + self.max_delay if batch else None
+
+            if flush_event:
+                flush_event.set()
+                if self._stopping:
+                    return
+
+    def _write(self, batch):
+        """
+        Writes a batch with one upsert per collection. Returns the entries that
+        failed, which stay in the journal and are retried on the next flush.
+        """
+        by_collection = {}
+        for entry in batch:
+            by_collection.setdefault(entry["collection"], []).append(entry)
+
+        failed = []
+        for collection_name, entries in by_collection.items():
+            # Later writes to the same ID win, as they would have done inline
+            latest = {entry["id"]: entry for entry in entries}
+            written = self.db_handler.upsert_to_collection(
+                getattr(self.db_handler, collection_name),
+                documents=[entry["document"] for entry in latest.values()],
+                metadatas=[entry["metadata"] for entry in latest.values()],
+                ids=list(latest)
+            )
+            if not written:
+                failed.extend(entries)
+
+        with self._journal_lock:
+            self._unflushed -= len(batch) - len(failed)
+            if self._unflushed == 0:
+                # Everything journaled has been written
+                open(self.journal_path, "w").close()
+        return failed
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every write submitted so far has been attempted.
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        """
+        Flushes outstanding writes and stops the background thread.
+        """
+        if not self._thread.is_alive():
+            return
+        self._stopping = True
+        self.flush(timeout)
+        self._thread.join(timeout)
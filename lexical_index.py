@@ -0,0 +1,149 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+# Identifiers, numbers and dotted/namespaced symbols (os.path.join, std::vector) as single tokens
+_SYMBOL_RE = re.compile(r"[A-Za-z0-9_]+(?:(?:\.|::)[A-Za-z0-9_]+)*")
+# Sub-words of an identifier: snake_case parts, camelCase humps, acronyms and digit runs
+_SUBWORD_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+# Standard BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase lexical terms.
+
+    Symbols are kept whole, so an exact identifier such as `get_user_name`,
+    `ERR_CONNECTION_REFUSED` or `os.path.join` matches strongly, and their
+    parts are added too so a search for `user` or `join` still finds them.
+    """
+    terms = []
+    for match in _SYMBOL_RE.finditer(text):
+        symbol = match.group()
+        terms.append(symbol.lower())
+        parts = re.split(r"\.|::|_", symbol)
+        subwords = [sub.lower() for part in parts for sub in _SUBWORD_RE.findall(part)]
+        if len(subwords) > 1:
+            terms.extend(subwords)
+    return terms
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index over a book's chunks, persisted as JSON.
+
+    Postings map each term to the documents containing it with their term
+    frequencies, so a query only touches the postings of its own terms.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._postings = {}
+        self._doc_terms = {}
+        self._doc_lengths = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._doc_lengths)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._doc_lengths
+
+    def _remove_locked(self, doc_id):
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(doc_id)
+
+    def _add_locked(self, doc_id, term_counts, length):
+        self._remove_locked(doc_id)
+        for term, count in term_counts.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+        self._doc_terms[doc_id] = list(term_counts)
+        self._doc_lengths[doc_id] = length
+        self._total_length += length
+
+    def add(self, ids, documents):
+        """
+        Adds or replaces documents in the index.
+        """
+        with self._lock:
+            for doc_id, document in zip(ids, documents):
+                terms = tokenize(document)
+                self._add_locked(doc_id, Counter(terms), len(terms))
+
+    def remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                self._remove_locked(doc_id)
+
+    def search(self, query_text, n_results=10, candidate_ids=None):
+        """
+        Returns up to n_results (doc_id, score) pairs, best first.
+
+        Args:
+            query_text (str): The text to search for.
+            n_results (int): The number of results to return.
+            candidate_ids (set): If given, only these documents are scored.
+        """
+        query_terms = set(tokenize(query_text))
+        scores = Counter()
+        with self._lock:
+            doc_count = len(self._doc_lengths)
+            if not doc_count or not query_terms:
+                return []
+            avg_length = self._total_length / doc_count
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    if candidate_ids is not None and doc_id not in candidate_ids:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores.most_common(n_results)
+
+    def save(self, path=None):
+        """
+        Writes the index to disk atomically.
+        """
+        path = path or self.path
+        with self._lock:
+            docs = {
+                doc_id: [self._doc_lengths[doc_id], {term: self._postings[term][doc_id] for term in terms}]
+                for doc_id, terms in self._doc_terms.items()
+            }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "docs": docs}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index saved with save(), or returns None if there is none.
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        index = cls(path)
+        for doc_id, (length, term_counts) in data["docs"].items():
+            index._add_locked(doc_id, term_counts, length)
+        return index
@@ -1,80 +1,568 @@
+import argparse
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+import copy
+import gc
+import json
 import os
+import platform
+import queue
+import threading
+import time
+from chunker import DEFAULT_MODEL_PATH
+from generation_worker import plan_batches
+
+# Padded prompt + output tokens per generate_batch() batch, which bounds its memory use
+DEFAULT_BATCH_TOKEN_BUDGET = 16384
+
+# How the model runs on CPU: full float32, bfloat16 weights and activations, or
+# float32 with its linear layers dynamically quantized to int8. Which is fastest
+# depends on the CPU (bf16 is only quick with AVX-512 BF16/AMX; int8 with VNNI).
+CPU_PROFILES = ("fp32", "bf16", "int8")
+# "auto" is also accepted: the profile saved by `python main.py cpu-profile` for this
+# host and model, benchmarking them on first load if there is none
+DEFAULT_CPU_PROFILE = "fp32"
+CPU_PROFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cpu_profile.json")
+# Self-benchmark workload: a prompt of about this many tokens, then greedy decoding
+BENCHMARK_PROMPT_TOKENS = 256
+BENCHMARK_NEW_TOKENS = 16
+
+
+def host_id():
+    """
+    Identifies this machine's CPU and torch build, which decide the fastest profile.
+    """
+    return f"{platform.machine()}|{platform.processor()}|{os.cpu_count()} cpus|torch {torch.__version__}"
+
+
+def load_cpu_profile_choice(model_path, path=CPU_PROFILE_PATH):
+    """
+    Returns the profile chosen by an earlier self-benchmark of this model on
+    this host, or None if there isn't one.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            choices = json.load(f)
+    except (OSError, ValueError):
+        return None
+    choice = choices.get(f"{host_id()}|{os.path.abspath(model_path)}")
+    if choice and choice.get("profile") in CPU_PROFILES:
+        return choice["profile"]
+    return None
+
+
+def save_cpu_profile_choice(model_path, profile, results, path=CPU_PROFILE_PATH):
+    """
+    Records a self-benchmark's choice (and its timings) for this model and host.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            choices = json.load(f)
+    except (OSError, ValueError):
+        choices = {}
+    choices[f"{host_id()}|{os.path.abspath(model_path)}"] = {
+        "profile": profile,
+        "results": results,
+        "intra_op_threads": torch.get_num_threads(),
+        "benchmarked_at": time.time(),
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(choices, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def configure_cpu_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Sets torch's intra-op (within one matmul) and inter-op (between independent
+    ops) thread counts. None leaves torch's default. The inter-op count can
+    only be set before torch has run any parallel work.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            print(f"Error setting inter-op threads to {inter_op_threads}: {e}")
+    print(f"Torch CPU threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def load_weights(model_path, profile, device="cpu"):
+    """
+    Loads a model's weights for a CPU profile (see CPU_PROFILES).
+    """
+    if profile not in CPU_PROFILES:
+        raise ValueError(f"Unknown CPU profile {profile!r}, expected one of {CPU_PROFILES}")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        torch_dtype=torch.bfloat16 if profile == "bf16" else torch.float32,
+        device_map=device,
+    )
+    if profile == "int8":
+        # Weights of the linear layers become int8; activations are quantized on the fly
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    print(f"Using the {profile} profile")
+    return model
+
+
+def benchmark_cpu_profiles(model_path, tokenizer, profiles=CPU_PROFILES):
+    """
+    Loads the model with each CPU profile in turn, times a fixed prompt +
+    greedy generation, and saves the fastest profile for this host.
+
+    The fastest model so far stays loaded, so it is returned without loading
+    it again. At most two copies of the weights are held at a time.
+
+    Returns:
+        (fastest profile name, its loaded model). The model is None if no
+        profile could be benchmarked, in which case the profile is fp32.
+    """
+    filler = "The quick brown fox jumps over the lazy dog. "
+    prompt_ids = tokenizer(filler * BENCHMARK_PROMPT_TOKENS, return_tensors="pt")["input_ids"][:, :BENCHMARK_PROMPT_TOKENS]
+    results = {}
+    fastest, fastest_model = None, None
+    for profile in profiles:
+        model = None
+        try:
+            model = load_weights(model_path, profile)
+            inputs = dict(input_ids=prompt_ids, attention_mask=torch.ones_like(prompt_ids),
+                          max_new_tokens=BENCHMARK_NEW_TOKENS, min_new_tokens=BENCHMARK_NEW_TOKENS, do_sample=False)
+            with torch.inference_mode():
+                model.generate(**dict(inputs, max_new_tokens=2, min_new_tokens=2)) # Warm-up
+                started = time.perf_counter()
+                model.generate(**inputs)
+                results[profile] = time.perf_counter() - started
+            print(f"CPU profile {profile}: {results[profile]:.2f}s for {BENCHMARK_PROMPT_TOKENS} prompt + {BENCHMARK_NEW_TOKENS} new tokens")
+            if fastest is None or results[profile] < results[fastest]:
+                fastest, fastest_model, model = profile, model, fastest_model
+        except Exception as e:
+            print(f"Error benchmarking the {profile} profile: {e}")
+        finally:
+            # Drops the slower of this model and the fastest so far
+            del model
+            gc.collect()
+
+    if fastest is None:
+        print("Error: no CPU profile could be benchmarked; using fp32")
+        return "fp32", None
+    print(f"Fastest CPU profile on this host: {fastest}")
+    save_cpu_profile_choice(model_path, fastest, results)
+    return fastest, fastest_model
+
+
+class StopOnEvent(StoppingCriteria):
+    """
+    Stops generation after the current token once event is set.
+    """
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class CountingStreamer(TextIteratorStreamer):
+    """
+    A TextIteratorStreamer that counts put() calls. generate() puts the
+    prompt first, so more than one put means generated tokens were streamed.
+    """
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.puts = 0
+
+    def put(self, value):
+        self.puts += 1
+        super().put(value)
+
 
 class LLMHandler:
-    def __init__(self, model_path):
+    def __init__(self, model_path, background=False, warm_up=False, cpu_profile=DEFAULT_CPU_PROFILE,
+                 intra_op_threads=None, inter_op_threads=None):
         """
         Initializes the LLM handler by loading the tokenizer and model from a local path.
+
+        Args:
+            model_path (str): Directory of the local model.
+            background (bool): Load the model weights on a background thread, so
+                the caller isn't blocked. The tokenizer is always loaded first,
+                since it's quick and needed for chunking. Wait on self.ready
+                (or check is_ready) before generating.
+            warm_up (bool): Run a tiny generation after loading, so the first
+                real request doesn't pay for kernel compilation and allocation.
+            cpu_profile (str): On CPU, one of CPU_PROFILES, or "auto" to use the
+                fastest profile saved in CPU_PROFILE_PATH. If none is saved, the
+                profiles are benchmarked on load and the fastest model is kept.
+                Ignored on GPU, which uses bf16.
+            intra_op_threads (int): Torch intra-op threads; None for torch's default.
+            inter_op_threads (int): Torch inter-op threads; None for torch's default.
         """
         self.model_path = model_path
         self.tokenizer = None
         self.model = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Using device: {self.device}")
+        self.cpu_profile = cpu_profile
+        if self.device == "cpu":
+            configure_cpu_threads(intra_op_threads, inter_op_threads)
+        # Timing of the last streamed response
+        self.last_stats = None
 
-        self._load_model()
+        # Past key/values of the last stable prompt prefix (see _prefix_inputs)
+        self.prefix_caching = True
+        self._prefix_cache = None
+        self._prefix_lock = threading.Lock()
 
-    def _load_model(self):
+        # Set once loading has finished, whether or not it succeeded
+        self.ready = threading.Event()
+        self.status = "Not loaded"
+        self.warm_up_on_load = warm_up
+        self._load_started = time.perf_counter()
+
+        self._load_tokenizer()
+        if background:
+            threading.Thread(target=self._load_model, name="llm-load", daemon=True).start()
+        else:
+            self._load_model()
+
+    @property
+    def is_ready(self):
+        return self.ready.is_set() and self.model is not None
+
+    @property
+    def load_seconds(self):
+        return time.perf_counter() - self._load_started
+
+    def _load_tokenizer(self):
         """
-        Loads the tokenizer and model from the local filesystem.
+        Loads the tokenizer from the local filesystem.
         """
         if not os.path.isdir(self.model_path):
             print(f"Error: Model path does not exist: {self.model_path}")
+            self.status = "Model not found"
             return
 
         try:
+            self.status = "Loading tokenizer"
             print(f"Loading tokenizer from {self.model_path}...")
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
             print("Tokenizer loaded successfully.")
+        except Exception as e:
+            print(f"Error loading tokenizer: {e}")
+            self.status = "Failed to load tokenizer"
+            self.tokenizer = None
+
+    def _load_model(self):
+        """
+        Loads the model from the local filesystem, then optionally warms it up.
+        """
+        try:
+            if self.tokenizer is None:
+                return
+
+            model = None
+            if self.device == "cpu" and self.cpu_profile == "auto":
+                self.cpu_profile = load_cpu_profile_choice(self.model_path)
+                if self.cpu_profile is None:
+                    self.status = "Benchmarking CPU profiles"
+                    self.cpu_profile, model = benchmark_cpu_profiles(self.model_path, self.tokenizer)
+
+            if model is None:
+                self.status = "Loading model weights"
+                print(f"Loading model from {self.model_path}...")
+                model = load_weights(self.model_path, self.cpu_profile if self.device == "cpu" else "bf16", self.device)
+            self.model = model
+            print(f"Model loaded successfully in {self.load_seconds:.1f}s.")
 
-            print(f"Loading model from {self.model_path}...")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                torch_dtype=torch.bfloat16,
-                device_map=self.device,
-            )
-            print("Model loaded successfully.")
+            if self.warm_up_on_load:
+                self.status = "Warming up"
+                self.warm_up()
+            self.status = "Ready"
 
         except Exception as e:
             print(f"Error loading model: {e}")
-            self.tokenizer = None
+            self.status = "Failed to load model"
+            # The tokenizer loaded fine and is still usable on its own, e.g. for counting tokens
             self.model = None
+        finally:
+            self.ready.set()
+
+    def warm_up(self):
+        """
+        Generates a couple of tokens from a short prompt, so kernels are
+        compiled and buffers allocated before the first real request.
+        """
+        started = time.perf_counter()
+        inputs = self.tokenizer("Hello", return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            self.model.generate(**inputs, max_new_tokens=2, do_sample=False)
+        print(f"Model warmed up in {time.perf_counter() - started:.1f}s.")
+
+    def _generation_kwargs(self, max_new_tokens, stop_event=None):
+        kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.7,
+            top_k=50,
+            top_p=0.95
+        )
+        if stop_event is not None:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([StopOnEvent(stop_event)])
+        return kwargs
 
-    def generate_response(self, prompt, max_new_tokens=150):
+    def _cached_prefix(self, prefix):
+        """
+        Returns (prefix token IDs, past key/values) for a prompt prefix,
+        prefilling it only if it differs from the one cached last time.
+        """
+        with self._prefix_lock:
+            if self._prefix_cache is None or self._prefix_cache["text"] != prefix:
+                started = time.perf_counter()
+                prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.device)
+                with torch.inference_mode():
+                    outputs = self.model(input_ids=prefix_ids, use_cache=True)
+                self._prefix_cache = {"text": prefix, "input_ids": prefix_ids, "past_key_values": outputs.past_key_values}
+                print(f"Prefilled {prefix_ids.shape[1]} prompt prefix tokens in {time.perf_counter() - started:.2f}s")
+            cache = self._prefix_cache
+            # generate() extends the cache in place, so each request gets its own copy
+            return cache["input_ids"], copy.deepcopy(cache["past_key_values"])
+
+    def _prefix_inputs(self, prompt, prefix=None):
+        """
+        Tokenizes a prompt for generate(), reusing the cached past key/values of
+        prefix when the prompt starts with it.
+
+        Only the tokens after the prefix then need to be prefilled. The cache is
+        used only if the prompt's own tokens start with exactly the prefix's
+        tokens, so a different split at the boundary can't change the output.
+
+        Returns:
+            (generate() keyword arguments, number of prefix tokens reused)
+        """
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        if not (self.prefix_caching and prefix and prompt.startswith(prefix)):
+            return dict(inputs), 0
+
+        try:
+            prefix_ids, past_key_values = self._cached_prefix(prefix)
+        except Exception as e:
+            print(f"Error prefilling the prompt prefix, prefix caching disabled: {e}")
+            self.prefix_caching = False
+            return dict(inputs), 0
+
+        prefix_length = prefix_ids.shape[1]
+        input_ids = inputs["input_ids"]
+        if input_ids.shape[1] <= prefix_length or not torch.equal(input_ids[0, :prefix_length], prefix_ids[0]):
+            return dict(inputs), 0
+        return dict(inputs, past_key_values=past_key_values), prefix_length
+
+    def _generate(self, inputs, new_streamer=None, **kwargs):
+        """
+        Runs generate(), retrying without the prefix cache if the model rejects it.
+
+        Args:
+            inputs (dict): From _prefix_inputs().
+            new_streamer (callable): Returns a fresh CountingStreamer for each
+                attempt, since a failed attempt has already consumed its
+                streamer's prompt. An attempt that already streamed generated
+                tokens is not retried, so no text is repeated.
+        """
+        streamer = new_streamer() if new_streamer else None
+        try:
+            return self.model.generate(**inputs, **self._streamer_kwargs(streamer), **kwargs)
+        except Exception as e:
+            if streamer is not None:
+                streamer.end()
+            if "past_key_values" not in inputs or (streamer is not None and streamer.puts > 1):
+                raise
+            print(f"Error generating from the cached prompt prefix, prefix caching disabled: {e}")
+            self.prefix_caching = False
+        inputs = {key: value for key, value in inputs.items() if key != "past_key_values"}
+        streamer = new_streamer() if new_streamer else None
+        try:
+            return self.model.generate(**inputs, **self._streamer_kwargs(streamer), **kwargs)
+        except Exception:
+            if streamer is not None:
+                streamer.end()
+            raise
+
+    @staticmethod
+    def _streamer_kwargs(streamer):
+        return {"streamer": streamer} if streamer is not None else {}
+
+    def generate_response(self, prompt, max_new_tokens=150, prefix=None, stop_event=None):
         """
         Generates a response from the LLM based on a given prompt.
+
+        Args:
+            prompt (str): The full prompt.
+            max_new_tokens (int): The maximum number of tokens to generate.
+            prefix (str): The stable start of the prompt (e.g. the system prompt),
+                whose past key/values are cached and reused across calls.
+            stop_event (threading.Event): If set while generating, generation
+                stops after the current token and the text so far is returned.
         """
         if not self.model or not self.tokenizer:
             return "Model is not loaded. Please check for errors during initialization."
 
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        
         try:
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                do_sample=True,
-                temperature=0.7,
-                top_k=50,
-                top_p=0.95
-            )
-            response_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            # The prompt is often included in the response, so we remove it.
-            if response_text.startswith(prompt):
-                response_text = response_text[len(prompt):].lstrip()
-            return response_text
+            inputs, _ = self._prefix_inputs(prompt, prefix)
+            outputs = self._generate(inputs, **self._generation_kwargs(max_new_tokens, stop_event))
+            # Decode only the newly generated tokens, not the prompt
+            new_tokens = outputs[0][inputs["input_ids"].shape[1]:]
+            return self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
         except Exception as e:
             return f"Error during text generation: {e}"
 
+    def generate_batch(self, prompts, max_new_tokens=150, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, max_batch_size=None, stop_event=None):
+        """
+        Generates a response for each of many prompts, several at a time.
+
+        Prompts are left-padded so they all end where generation starts, and
+        grouped by plan_batches() into batches bounded by token_budget. Each
+        batch is one generate() call.
+
+        Args:
+            prompts (list): The prompts.
+            max_new_tokens (int): The maximum number of tokens to generate per prompt.
+            token_budget (int): Maximum padded prompt + output tokens per batch.
+            max_batch_size (int): Optional cap on prompts per batch.
+            stop_event (threading.Event): If set, the current batch stops after
+                its current token and no further batches are run.
+
+        Returns:
+            A list of responses in the same order as prompts. Prompts that were
+            not generated (after a stop or an error) get an error message or "".
+        """
+        if not self.model or not self.tokenizer:
+            return ["Model is not loaded. Please check for errors during initialization."] * len(prompts)
+
+        encoded = self.tokenizer(list(prompts))["input_ids"]
+        lengths = [len(ids) for ids in encoded]
+        responses = [""] * len(prompts)
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        started = time.perf_counter()
+        generated = 0
+
+        for batch in plan_batches(lengths, max_new_tokens, token_budget, max_batch_size):
+            if stop_event is not None and stop_event.is_set():
+                break
+            try:
+                longest = max(lengths[i] for i in batch)
+                input_ids = torch.full((len(batch), longest), pad_token_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(batch), longest), dtype=torch.long)
+                for row, i in enumerate(batch):
+                    # Left-pad, so every prompt's last token is in the last column
+                    input_ids[row, longest - lengths[i]:] = torch.tensor(encoded[i], dtype=torch.long)
+                    attention_mask[row, longest - lengths[i]:] = 1
+
+                with torch.inference_mode():
+                    outputs = self.model.generate(
+                        input_ids=input_ids.to(self.device),
+                        attention_mask=attention_mask.to(self.device),
+                        pad_token_id=pad_token_id,
+                        **self._generation_kwargs(max_new_tokens, stop_event)
+                    )
+                for row, i in enumerate(batch):
+                    new_tokens = outputs[row][longest:]
+                    generated += int((new_tokens != pad_token_id).sum())
+                    responses[i] = self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+            except Exception as e:
+                print(f"Error during batched generation of {len(batch)} prompts: {e}")
+                for i in batch:
+                    responses[i] = f"Error during text generation: {e}"
+
+        seconds = time.perf_counter() - started
+        if generated:
+            print(f"Generated {generated} tokens for {len(prompts)} prompts in {seconds:.2f}s ({generated / seconds:.1f} tokens/s)")
+        return responses
+
+    def stream_response(self, prompt, max_new_tokens=150, prefix=None, stop_event=None):
+        """
+        Generates a response, yielding decoded text as it is produced.
+
+        Generation runs on a background thread; iterating blocks only until the
+        next piece of text is ready. Only new tokens are decoded, so the prompt
+        never has to be stripped from the output. After the iterator is
+        exhausted, self.last_stats holds the time to first token, the token
+        count, the total time and how many prompt tokens came from the prefix
+        cache. prefix and stop_event are as for generate_response().
+        """
+        if not self.model or not self.tokenizer:
+            yield "Model is not loaded. Please check for errors during initialization."
+            return
+
+        started = time.perf_counter()
+        # One streamer per generate() attempt, read in order; None once generation is over
+        streamers = queue.Queue()
+        errors = []
+        reused = []
+
+        def new_streamer():
+            streamer = CountingStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            streamers.put(streamer)
+            return streamer
+
+        def generate():
+            try:
+                inputs, prefix_tokens = self._prefix_inputs(prompt, prefix)
+                self._generate(inputs, new_streamer=new_streamer, **self._generation_kwargs(max_new_tokens, stop_event))
+                # Nothing was reused if the cache was rejected and the prompt prefilled in full
+                reused.append(prefix_tokens if self.prefix_caching else 0)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                streamers.put(None) # Unblock the consumer
+
+        first_token_seconds = None
+        pieces = []
+        thread = threading.Thread(target=generate, name="llm-generate", daemon=True)
+        thread.start()
+        for streamer in iter(streamers.get, None):
+            for text in streamer:
+                if not text:
+                    continue
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - started
+                pieces.append(text)
+                yield text
+        thread.join()
+
+        if errors:
+            yield f"\nError during text generation: {errors[0]}"
+        total_seconds = time.perf_counter() - started
+        token_count = len(self.tokenizer.encode("".join(pieces), add_special_tokens=False))
+        self.last_stats = {
+            "time_to_first_token": first_token_seconds,
+            "tokens": token_count,
+            "seconds": total_seconds,
+            "prefix_tokens_reused": reused[0] if reused else 0,
+        }
+        if first_token_seconds is not None:
+            print(f"Generated {token_count} tokens in {total_seconds:.2f}s "
+                  f"(time to first token {first_token_seconds:.2f}s, {token_count / total_seconds:.1f} tokens/s, "
+                  f"{self.last_stats['prefix_tokens_reused']} prompt tokens reused from the prefix cache)")
+
+def benchmark_main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the LLM's CPU profiles and save the fastest for this host (used with LLM_CPU_PROFILE = \"auto\").")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Local model directory")
+    parser.add_argument("--profiles", nargs="+", default=list(CPU_PROFILES), choices=CPU_PROFILES, help="Profiles to compare")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads, as the app will run with")
+    args = parser.parse_args(argv)
+
+    configure_cpu_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    fastest, _ = benchmark_cpu_profiles(args.model, tokenizer, args.profiles)
+    print(f"Saved {fastest} for this host to {CPU_PROFILE_PATH}")
+
 if __name__ == '__main__':
     # This is for testing the LLMHandler directly
     print("Performing a test run of the LLMHandler...")
     
-    # Construct the path to the local model directory
-    local_model_dir = os.path.join(os.path.dirname(__file__), "local_models", "gemma-3n-E2B-it")
-    
-    handler = LLMHandler(model_path=local_model_dir)
+    handler = LLMHandler(model_path=DEFAULT_MODEL_PATH)
     if handler.model:
         test_prompt = "What is the capital of France?"
         print(f"Test Prompt: {test_prompt}")
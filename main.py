@@ -1,16 +1,39 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext
+from tkinter import filedialog, messagebox, scrolledtext, ttk
 import fitz  # PyMuPDF
 from PIL import Image, ImageTk
 from ebooklib import epub, ITEM_DOCUMENT
+import bisect
 import os
+import queue
 import sys
+import time
+from collections import deque
 from Scripts.epub_analyzer import analyze_epub
 from native_viewer import NativeEpubViewer
 import re
-from bs4 import BeautifulSoup
-from llm_handler import LLMHandler
-from db_handler import DBHandler
+from llm_handler import LLMHandler, DEFAULT_CPU_PROFILE
+from generation_worker import GenerationWorker
+from db_handler import DBHandlerPool, UNSCOPED_FIELD, content_id, include_unscoped, range_filter
+from insight_writer import InsightWriter
+from indexer import IndexingWorker, IndexManifest
+from chunker import DEFAULT_MODEL_PATH
+
+# How often the UI polls a background indexing worker for progress
+INDEX_POLL_MS = 250
+# How often the UI appends text streamed from the LLM
+STREAM_POLL_MS = 50
+# How often the UI checks on the LLM loading in the background
+LLM_POLL_MS = 250
+# Run a tiny generation after loading, so the first real answer starts faster
+WARM_UP_LLM = True
+# CPU inference profile ("fp32", "bf16", "int8", or "auto" for the fastest found by
+# `python main.py cpu-profile`), and torch intra-/inter-op threads (None for torch's defaults)
+LLM_CPU_PROFILE = DEFAULT_CPU_PROFILE
+LLM_INTRA_OP_THREADS = None
+LLM_INTER_OP_THREADS = None
+# Retrieval is scoped to this many pages (PDF) or chapters (EPUB) either side of the current one
+RETRIEVAL_WINDOW = 5
 
 class TrainerBaseApp:
     def __init__(self, root):
@@ -27,10 +50,23 @@ class TrainerBaseApp:
         self.epub_chapters = []
         self.epub_chapter_index = 0
         self.href_map = {}
+        self.epub_item_nums = {} # Item ID -> item_num, as numbered by the indexer
+        # Explicit (first, last) page or chapter to scope retrieval to, instead of the window around the current one
+        self.retrieval_range = None
 
         # LLM and DB Handlers
         self.llm_handler = None
+        self.generation_worker = None # Runs every generation, in priority order
+        self.pending_replies = deque() # Chat replies being streamed or waiting their turn, oldest first
         self.db_handler = None # Will be initialized when a book is chosen
+        self.db_pool = DBHandlerPool() # Keeps recently opened books warm
+        self.insight_writer = None # Write-behind queue for the current book's insights
+
+        # Background indexing state
+        self.indexing_worker = None
+        self.indexing_file_path = None
+        self.index_status = ""
+        self.partial_index_notice_shown = False
 
         # LLM Context State
         self.system_prompt = "You are an expert AI Tutor. Your goal is to guide the user through the provided document context..."
@@ -79,6 +115,10 @@ class TrainerBaseApp:
         self.analyze_button = tk.Button(self.left_frame, text="Analyze EPUB", command=self.run_analysis, state=tk.DISABLED)
         self.analyze_button.pack(pady=5)
 
+        # Indexing control (cancel a running index, or resume a cancelled one)
+        self.index_button = tk.Button(self.left_frame, text="Cancel Indexing", command=self.toggle_indexing, state=tk.DISABLED)
+        self.index_button.pack(pady=5)
+
         # --- LLM Chat Section ---
         llm_frame = tk.LabelFrame(self.left_frame, text="Chat with LLM", padx=5, pady=5)
         llm_frame.pack(pady=10, fill=tk.X, expand=False)
@@ -93,6 +133,12 @@ class TrainerBaseApp:
         self.ask_button = tk.Button(llm_frame, text="Ask", command=self.ask_llm)
         self.ask_button.pack(pady=5)
 
+        self.stop_button = tk.Button(llm_frame, text="Stop", command=self.stop_reply, state=tk.DISABLED)
+        self.stop_button.pack(pady=5)
+
+        # Shown while the model loads in the background
+        self.llm_progress = ttk.Progressbar(llm_frame, mode="indeterminate")
+
         # --- Bottom Buttons ---
         bottom_frame = tk.Frame(self.left_frame)
         bottom_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=10)
@@ -100,7 +146,8 @@ class TrainerBaseApp:
         self.inspect_button = tk.Button(bottom_frame, text="Inspect Context", command=self.open_context_inspector)
         self.inspect_button.pack(side=tk.LEFT, padx=5)
 
-        tk.Button(bottom_frame, text="Exit", command=self.root.destroy).pack(side=tk.RIGHT, padx=5)
+        tk.Button(bottom_frame, text="Exit", command=self.shutdown).pack(side=tk.RIGHT, padx=5)
+        self.root.protocol("WM_DELETE_WINDOW", self.shutdown)
 
 
         # Right column (book viewer)
@@ -195,35 +242,87 @@ class TrainerBaseApp:
             return tokenizer.decode(truncated_tokens, skip_special_tokens=True) + "..."
         return text
 
-    def _build_master_prompt(self, user_input, tokenizer):
-        """Builds the complete prompt string from all context sources, managing token limits."""
+    def _prompt_prefix(self, system_prompt):
+        """
+        Returns the start of the master prompt that only changes with the
+        system prompt, so the LLM can reuse its cached key/values across turns.
+
+        Everything after it changes every turn, so with the default system
+        prompt only about 50 tokens of a prompt budgeted at up to 7,680 are
+        reused; the saving grows with a longer custom system prompt.
+        """
+        return f"""# SYSTEM PROMPT
+{system_prompt}
+---
+# CONTEXT BLOCK
+## [Relevant Prior Knowledge (from already_covered_db)]
+"""
+
+    def _prompt_context(self):
+        """
+        Captures what the prompt and the reply's insight need from the UI's
+        state. Called on the Tk thread when a reply is asked for, so the worker
+        building the prompt never touches the open document or the widgets,
+        and the reply is built and saved with the book, position and selection
+        it was asked from.
+        """
+        scope = self._retrieval_scope()
+        chapter = self._current_chapter()
+        return {
+            "system_prompt": self.system_prompt,
+            "task_prompt": self.task_prompt,
+            "user_selected_text": self.user_selected_text,
+            "user_notes": self.user_notes,
+            "db_handler": self.db_handler,
+            "insight_writer": self.insight_writer,
+            "scope": scope,
+            "insights_scope": {"chapter": chapter} if scope else None,
+            # Where the reply's insight is saved, see _capture_insight()
+            "location": self._current_location(),
+            "chapter": chapter,
+        }
+
+    def _build_master_prompt(self, user_input, tokenizer, context):
+        """
+        Builds the complete prompt string from all context sources, managing token limits.
+
+        Args:
+            user_input (str): The user's message.
+            tokenizer: Used to measure and truncate each section.
+            context (dict): UI state captured by _prompt_context(). Only the
+                conversation history is read here, so it includes replies that
+                finished after this one was asked for.
+        """
         
         # Define the token budget
         CONTEXT_BUDGET = 7680 # 8192 total, with a 512 buffer for the response
         
         # --- 1. Calculate Fixed Costs ---
         # These are the parts of the prompt that are always included.
-        fixed_template = f"""# SYSTEM PROMPT
-{self.system_prompt}
----
-# CONTEXT BLOCK
-## [Relevant Prior Knowledge (from already_covered_db)]
-{{retrieved_doc_context}}
+        # The prefix is escaped so braces in the system prompt survive format() unchanged;
+        # everything else, including the user's message, is filled in by format().
+        prefix = self._prompt_prefix(context["system_prompt"])
+        fixed_template = prefix.replace("{", "{{").replace("}", "}}") + """{retrieved_doc_context}
+## [Relevant Book Passages (from full_text_source)]
+{book_passages}
 ## [User-Selected Text]
-{{user_selected_text}}
+{user_selected_text}
 ## [Relevant Current Insights (from current_chapter_insights_db)]
-{{current_chapter_insights}}
+{current_chapter_insights}
 ## [Conversation History]
-{{history_str}}
+{history_str}
 ## [User Notes]
-{{user_notes}}
+{user_notes}
 ---
 # TASK BLOCK
-{self.task_prompt}
+{task_prompt}
 ## [User Message]
 {user_input}
 """
-        base_tokens = len(tokenizer.encode(fixed_template))
+        fixed_fields = {"task_prompt": context["task_prompt"], "user_input": user_input}
+        empty_sections = dict.fromkeys(["retrieved_doc_context", "book_passages", "user_selected_text",
+                                        "current_chapter_insights", "history_str", "user_notes"], "")
+        base_tokens = len(tokenizer.encode(fixed_template.format(**fixed_fields, **empty_sections)))
         remaining_budget = CONTEXT_BUDGET - base_tokens
 
         # --- 2. Allocate Budget to Dynamic Content ---
@@ -231,7 +330,7 @@ class TrainerBaseApp:
         
         # User-Selected Text (High Priority)
         user_selected_text_tokens = int(remaining_budget * 0.4) # 40% of remaining budget
-        truncated_selected_text = self._truncate_text(self.user_selected_text, tokenizer, user_selected_text_tokens)
+        truncated_selected_text = self._truncate_text(context["user_selected_text"], tokenizer, user_selected_text_tokens)
         remaining_budget -= len(tokenizer.encode(truncated_selected_text))
 
         # Conversation History (Medium Priority)
@@ -245,66 +344,109 @@ class TrainerBaseApp:
         history_str = "\n".join(truncated_history) or "N/A"
         remaining_budget -= len(tokenizer.encode(history_str))
 
-        # Retrieved Context (Low Priority) - Split remaining budget between the two DBs
-        db_context_tokens = int(remaining_budget * 0.45) # Use 45% of what's left for each DB query
+        # Retrieved Context (Low Priority) - Split remaining budget between the three DBs
+        db_context_tokens = int(remaining_budget * 0.3) # Use 30% of what's left for each DB query
+
+        query_text = user_input or context["user_selected_text"]
+        truncated_retrieved_docs = truncated_insights = truncated_passages = "N/A"
+
+        db_handler = context["db_handler"]
+        if db_handler:
+            # Search only around the current position; the filter is applied before the vector search
+            scope, insights_scope = context["scope"], context["insights_scope"]
+            # Captured rows from before positions were recorded match every window
+            covered_scope, insights_scope = include_unscoped(scope), include_unscoped(insights_scope)
+
+            # Embed the query once and search both collections concurrently
+            results = db_handler.query_collections(
+                [db_handler.already_covered_db, db_handler.current_chapter_insights_db],
+                query_text, n_results=2, parallel=True,
+                wheres={
+                    db_handler.already_covered_db.name: covered_scope,
+                    db_handler.current_chapter_insights_db.name: insights_scope,
+                }
+            )
 
-        query_text = user_input or self.user_selected_text
-        
-        retrieved_docs = self.db_handler.query_collection(self.db_handler.already_covered_db, [query_text], n_results=2)
-        retrieved_doc_context = "\n".join(retrieved_docs['documents'][0]) if retrieved_docs and retrieved_docs['documents'] else "N/A"
-        truncated_retrieved_docs = self._truncate_text(retrieved_doc_context, tokenizer, db_context_tokens)
+            retrieved_docs = results[db_handler.already_covered_db.name]
+            retrieved_doc_context = "\n".join(retrieved_docs['documents'][0]) if retrieved_docs and retrieved_docs['documents'] and retrieved_docs['documents'][0] else "N/A"
+            truncated_retrieved_docs = self._truncate_text(retrieved_doc_context, tokenizer, db_context_tokens)
+
+            insights = results[db_handler.current_chapter_insights_db.name]
+            current_chapter_insights = "\n".join(insights['documents'][0]) if insights and insights['documents'] and insights['documents'][0] else "N/A"
+            truncated_insights = self._truncate_text(current_chapter_insights, tokenizer, db_context_tokens)
+
+            # Book passages fuse vector and BM25 retrieval so exact identifiers are found too.
+            # If nothing near the current position matches (e.g. it isn't indexed yet), search the whole book.
+            passages = db_handler.hybrid_query(query_text, n_results=3, where=scope)
+            if scope and not passages:
+                passages = db_handler.hybrid_query(query_text, n_results=3)
+            book_passages = "\n".join(passages['documents'][0]) if passages and passages['documents'] else "N/A"
+            truncated_passages = self._truncate_text(book_passages, tokenizer, db_context_tokens)
 
-        insights = self.db_handler.query_collection(self.db_handler.current_chapter_insights_db, [query_text], n_results=2)
-        current_chapter_insights = "\n".join(insights['documents'][0]) if insights and insights['documents'] else "N/A"
-        truncated_insights = self._truncate_text(current_chapter_insights, tokenizer, db_context_tokens)
+            cache_stats = db_handler.query_cache.stats()
+            print(f"Query cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%} hit rate)")
 
         # --- 3. Assemble the Final Prompt ---
         final_prompt = fixed_template.format(
             retrieved_doc_context=truncated_retrieved_docs,
+            book_passages=truncated_passages,
             user_selected_text=truncated_selected_text or "N/A",
             current_chapter_insights=truncated_insights,
             history_str=history_str,
-            user_notes=self.user_notes or "N/A"
+            user_notes=context["user_notes"] or "N/A",
+            **fixed_fields
         )
 
         return final_prompt
 
     def ask_llm_from_inspector(self, window, system_prompt, user_notes):
         """Gathers context from the inspector window and sends it to the LLM."""
+        if not self._llm_available():
+            return
+
         # Update the main app's state from the inspector's text boxes
         self.system_prompt = system_prompt.strip()
         self.user_notes = user_notes.strip()
         
         user_input = "[Prompt sent from Inspector]"
-        self.add_to_chat(user_input)
-        self.conversation_history.append(user_input)
 
-        # Build the full prompt using the (potentially edited) context
-        final_prompt = self._build_master_prompt(user_input, self.llm_handler.tokenizer)
-        
-        print("--- MASTER PROMPT (Inspector) ---")
-        print(final_prompt)
-        print("---------------------------------")
-
-        # Generate response
-        response = self.llm_handler.generate_response(final_prompt)
-        
-        llm_message = f"LLM: {response}"
-        self.add_to_chat(llm_message)
-        self.conversation_history.append(llm_message)
-        
-        self._capture_insight(response)
+        # The reply streams into the chat; the prompt is printed once it is built
+        self._start_reply(user_input, user_input, print_prompt=True)
         window.destroy()
 
     def initialize_llm(self):
-        self.add_to_chat("Initializing LLM... This may take a moment.")
-        self.root.update_idletasks() # Update UI to show message
-        
-        local_model_dir = os.path.join(os.path.dirname(__file__), "local_models", "gemma-3n-E2B-it")
-        self.llm_handler = LLMHandler(model_path=local_model_dir)
-        
-        if self.llm_handler and self.llm_handler.model:
-            self.add_to_chat("LLM Initialized successfully.")
+        """
+        Starts loading the LLM in the background. The rest of the app is
+        usable meanwhile; asking is enabled once the model is ready.
+        """
+        self.add_to_chat("Loading LLM in the background... You can open a book meanwhile.")
+
+        self.llm_handler = LLMHandler(
+            model_path=DEFAULT_MODEL_PATH, background=True, warm_up=WARM_UP_LLM,
+            cpu_profile=LLM_CPU_PROFILE,
+            intra_op_threads=LLM_INTRA_OP_THREADS,
+            inter_op_threads=LLM_INTER_OP_THREADS
+        )
+        self.generation_worker = GenerationWorker(self.llm_handler)
+
+        self.ask_button.config(state=tk.DISABLED, text="Loading LLM...")
+        self.llm_progress.pack(pady=5, fill=tk.X)
+        self.llm_progress.start(10)
+        self.root.after(LLM_POLL_MS, self._poll_llm_loading)
+
+    def _poll_llm_loading(self):
+        handler = self.llm_handler
+        if not handler.ready.is_set():
+            self.ask_button.config(text=f"{handler.status}... {handler.load_seconds:.0f}s")
+            self.root.after(LLM_POLL_MS, self._poll_llm_loading)
+            return
+
+        self.llm_progress.stop()
+        self.llm_progress.pack_forget()
+        self.ask_button.config(text="Ask")
+        if handler.is_ready:
+            self.ask_button.config(state=tk.NORMAL)
+            self.add_to_chat(f"LLM Initialized successfully ({handler.load_seconds:.0f}s).")
         else:
             self.add_to_chat("Error: LLM failed to initialize. Check console for details.")
 
@@ -314,70 +456,248 @@ class TrainerBaseApp:
         self.chat_display.config(state=tk.DISABLED)
         self.chat_display.see(tk.END)
 
-    def ask_llm(self, event=None):
-        if not self.llm_handler or not self.llm_handler.model:
+    def _llm_available(self):
+        """
+        Returns True if the LLM can answer now, otherwise says why not in the chat.
+        """
+        if self.llm_handler and self.llm_handler.is_ready:
+            return True
+        if self.llm_handler and not self.llm_handler.ready.is_set():
+            self.add_to_chat(f"The LLM is still loading ({self.llm_handler.status.lower()}); please ask again in a moment.")
+        else:
             self.add_to_chat("LLM is not ready.")
+        return False
+
+    def ask_llm(self, event=None):
+        if not self._llm_available():
             return
 
         user_prompt = self.chat_input.get()
         if not user_prompt:
             return
 
-        user_message = f"You: {user_prompt}"
-        self.add_to_chat(user_message)
-        self.conversation_history.append(user_message)
         self.chat_input.delete(0, tk.END)
-        
-        self.chat_input.config(state=tk.DISABLED)
-        self.ask_button.config(state=tk.DISABLED)
-        self.root.update_idletasks()
 
-        # Build the master prompt
-        final_prompt = self._build_master_prompt(user_prompt, self.llm_handler.tokenizer)
+        notice = None
+        if self.indexing_worker and self.indexing_worker.is_alive() and not self.partial_index_notice_shown:
+            notice = "Note: the book is still being indexed, so answers may miss context from pages not yet indexed."
+            self.partial_index_notice_shown = True
 
-        # Generate response
-        response = self.llm_handler.generate_response(final_prompt)
-        
-        llm_message = f"LLM: {response}"
-        self.add_to_chat(llm_message)
-        self.conversation_history.append(llm_message)
+        self._start_reply(user_prompt, f"You: {user_prompt}", notice=notice)
 
-        self._capture_insight(response)
+    def _start_reply(self, user_input, user_message, print_prompt=False, notice=None):
+        """
+        Queues a chat reply on the generation worker and streams it into the
+        chat without blocking the UI. The worker only produces text; the chat
+        is updated from the Tk loop by _poll_reply. Replies asked for while
+        another is streaming wait their turn, and their message is shown when
+        it comes.
+        """
+        pieces = queue.Queue()
+        context = self._prompt_context()
+
+        def build_prompt():
+            # Runs on the worker when the reply starts, so the history already holds the replies before it
+            self.conversation_history.append(user_message)
+            final_prompt = self._build_master_prompt(user_input, self.llm_handler.tokenizer, context)
+            if print_prompt:
+                print("--- MASTER PROMPT (Inspector) ---")
+                print(final_prompt)
+                print("---------------------------------")
+            return final_prompt
+
+        def record_reply(future):
+            # Runs on the worker before it starts the next job
+            if not future.cancelled() and future.exception() is None:
+                self.conversation_history.append(f"LLM: {future.result()}")
+
+        job = self.generation_worker.submit(build_prompt, prefix=self._prompt_prefix(context["system_prompt"]), on_text=pieces.put)
+        job.future.add_done_callback(record_reply)
+
+        self.pending_replies.append({
+            "job": job,
+            "pieces": pieces,
+            "user_message": user_message,
+            "notice": notice,
+            "context": context,
+            "received": [],
+            "shown": False,
+        })
+        self.stop_button.config(state=tk.NORMAL)
+        self._update_queue_status()
+        if len(self.pending_replies) == 1:
+            self.root.after(STREAM_POLL_MS, self._poll_reply)
+
+    def stop_reply(self):
+        """Stops the reply currently streaming; queued ones still run."""
+        if self.pending_replies:
+            self.pending_replies[0]["job"].cancel()
+
+    def _update_queue_status(self):
+        waiting = len(self.pending_replies) - 1
+        self.ask_button.config(text=f"Ask ({waiting} queued)" if waiting > 0 else "Ask")
+
+    def _poll_reply(self):
+        """
+        Appends whatever text the worker has produced for the oldest pending
+        reply, and finishes it once its future is done.
+        """
+        while self.pending_replies:
+            reply = self.pending_replies[0]
+            if not reply["shown"]:
+                self.add_to_chat(reply["user_message"])
+                if reply["notice"]:
+                    self.add_to_chat(reply["notice"])
+                self.chat_display.config(state=tk.NORMAL)
+                self.chat_display.insert(tk.END, "LLM: ")
+                self.chat_display.config(state=tk.DISABLED)
+                reply["shown"] = True
+
+            # Check before draining: text is queued before the future completes
+            future = reply["job"].future
+            finished = future.done()
+            new_text = []
+            while True:
+                try:
+                    new_text.append(reply["pieces"].get_nowait())
+                except queue.Empty:
+                    break
 
-        self.chat_input.config(state=tk.NORMAL)
-        self.ask_button.config(state=tk.NORMAL)
+            if new_text:
+                reply["received"].extend(new_text)
+                self.chat_display.config(state=tk.NORMAL)
+                self.chat_display.insert(tk.END, "".join(new_text))
+                self.chat_display.config(state=tk.DISABLED)
+                self.chat_display.see(tk.END)
+
+            if not finished:
+                break
+            self._finish_reply(reply)
+            self.pending_replies.popleft()
+            self._update_queue_status()
+
+        if self.pending_replies:
+            self.root.after(STREAM_POLL_MS, self._poll_reply)
+        else:
+            self.stop_button.config(state=tk.DISABLED)
 
-    def _capture_insight(self, insight_text):
-        """Adds the last selected text and the new insight to the databases."""
-        if not self.db_handler or not self.user_selected_text:
+    def _finish_reply(self, reply):
+        job = reply["job"]
+        if job.future.cancelled():
+            self.add_to_chat("[Stopped]")
+            return
+        if job.future.exception() is not None:
+            self.add_to_chat(f"Error during text generation: {job.future.exception()}")
+            return
+        if job.stopped:
+            self.add_to_chat(" [Stopped]")
             return
 
-        # Use a hash of the selected text as a simple, unique ID
-        doc_id = f"doc_{hash(self.user_selected_text)}"
-        insight_id = f"insight_{hash(self.user_selected_text)}"
+        self.add_to_chat("")
+        self._capture_insight(job.future.result(), reply["context"])
 
-        # Add the original text to the 'already_covered' DB
-        self.db_handler.add_to_collection(
-            self.db_handler.already_covered_db,
-            documents=[self.user_selected_text],
-            metadatas=[{"source": "user_selection"}],
-            ids=[doc_id]
-        )
+        stats = self.llm_handler.last_stats
+        if stats and stats["time_to_first_token"] is not None:
+            print(f"Time to first token: {stats['time_to_first_token']:.2f}s")
 
-        # Add the LLM's response to the 'insights' DB
-        self.db_handler.add_to_collection(
-            self.db_handler.current_chapter_insights_db,
-            documents=[insight_text],
-            metadatas=[{"source_doc_id": doc_id}],
-            ids=[insight_id]
+    def _capture_insight(self, insight_text, context):
+        """
+        Adds the selected text a reply was asked about, and the reply, to that
+        book's databases.
+
+        Args:
+            insight_text (str): The LLM's reply.
+            context (dict): The state captured by _prompt_context() when the
+                reply was asked for. If another book has been opened since,
+                its (closed) writer still journals the rows, and they are
+                written when that book is next opened.
+        """
+        selected_text = context["user_selected_text"]
+        insight_writer = context["insight_writer"]
+        if not context["db_handler"] or not insight_writer or not selected_text:
+            return
+
+        # Derive the IDs from the selected text, so re-capturing a passage
+        # (in this or any later session) replaces its rows instead of adding new ones
+        doc_id = content_id("doc", selected_text)
+        insight_id = content_id("insight", selected_text)
+
+        # Queue the original text for the 'already_covered' DB and the LLM's
+        # response for the 'insights' DB; both are written in the background
+        # Without a position (e.g. an EPUB chapter the indexer didn't number) the rows match every window
+        location = context["location"] or {UNSCOPED_FIELD: True}
+        insight_writer.submit(
+            "already_covered_db",
+            document=selected_text,
+            metadata=dict(location, source="user_selection"),
+            doc_id=doc_id
+        )
+        insight_writer.submit(
+            "current_chapter_insights_db",
+            document=insight_text,
+            # created_at and chapter are also used by the retention policies in maintenance.py
+            metadata=dict(location, source_doc_id=doc_id, created_at=time.time(), chapter=context["chapter"]),
+            doc_id=insight_id
         )
 
         print(f"Captured insight for document ID: {doc_id}")
-        # Clear the selected text after processing to avoid re-capturing
-        self.user_selected_text = ""
+        # Clear the selection to avoid re-capturing it, unless a new one was made meanwhile
+        if self.user_selected_text == selected_text:
+            self.user_selected_text = ""
+
+    def _current_chapter(self):
+        """
+        Returns the index of the chapter being read: the EPUB chapter, or for a
+        PDF the top-level table-of-contents entry containing the current page
+        (the page itself if the PDF has no table of contents).
+        """
+        if self.epub_book:
+            return self.epub_chapter_index
+        if self.doc:
+            chapter_starts = sorted(page - 1 for level, _, page in self.doc.get_toc() if level == 1)
+            if chapter_starts:
+                return max(bisect.bisect_right(chapter_starts, self.page_num) - 1, 0)
+        return self.page_num
+
+    def _current_location(self):
+        """
+        Returns the current position as the metadata the indexer gives chunks:
+        {"page_num": n} for a PDF or {"item_num": n} for an EPUB.
+        """
+        if self.epub_book and self.epub_chapters:
+            item_num = self.epub_item_nums.get(self.epub_chapters[self.epub_chapter_index].id)
+            return {"item_num": item_num} if item_num is not None else {}
+        if self.doc:
+            return {"page_num": self.page_num}
+        return {}
+
+    def _retrieval_scope(self):
+        """
+        Returns the `where` filter limiting passages and prior knowledge to the
+        pages or chapters around the current one (or self.retrieval_range),
+        or None if there is no position to scope to.
+        """
+        if self.epub_book and self.epub_chapters:
+            first, last = self.retrieval_range or (self.epub_chapter_index - RETRIEVAL_WINDOW, self.epub_chapter_index + RETRIEVAL_WINDOW)
+            chapters = self.epub_chapters[max(first, 0):max(last + 1, 0)]
+            item_nums = [self.epub_item_nums[item.id] for item in chapters if item.id in self.epub_item_nums]
+            # Spine order need not follow item numbering, so the window is a set of items
+            return {"item_num": {"$in": item_nums}} if item_nums else None
+        if self.doc:
+            first, last = self.retrieval_range or (self.page_num - RETRIEVAL_WINDOW, self.page_num + RETRIEVAL_WINDOW)
+            return range_filter("page_num", max(first, 0), last)
+        return None
 
     def update_info_panel(self, book, skill, section):
-        self.info_text.set(f"Current Book: {book}\nTargeted Skill: {skill}\nCurrent Section: {section}")
+        self.info_fields = (book, skill, section)
+        self._render_info_panel()
+
+    def _render_info_panel(self):
+        book, skill, section = self.info_fields
+        info = f"Current Book: {book}\nTargeted Skill: {skill}\nCurrent Section: {section}"
+        if self.index_status:
+            info += f"\nIndex: {self.index_status}"
+        self.info_text.set(info)
 
     def choose_book(self, event=None):
         # Set the initial directory to the 'DocSource' folder
@@ -393,82 +713,148 @@ class TrainerBaseApp:
             ]
         )
         if file_path:
+            # Stop indexing the previous book; its progress is kept in its manifest
+            self._cancel_indexing()
+
             # Reset state before opening a new book
             self.doc = None
             self.epub_book = None
             self.epub_book_path = None
             self.epub_chapters = []
             self.href_map = {}
+            self.epub_item_nums = {}
+            self.retrieval_range = None
             self.page_num = 0
             self.epub_chapter_index = 0
             
             # Create a book-specific ID
             book_id = os.path.splitext(os.path.basename(file_path))[0]
             
-            # Initialize the DB Handler for this specific book
-            self.db_handler = DBHandler(book_id=book_id)
-
-            # Check if the book is already indexed
-            if self.db_handler.full_text_source.count() == 0:
-                self._process_and_index_document(file_path, book_id)
-            else:
-                self.add_to_chat(f"Found existing database for {book_id}. Skipping indexing.")
-
+            # Flush insights captured for the previous book before switching
+            if self.insight_writer:
+                self.insight_writer.close()
+
+            # Get the DB Handler for this specific book (reused if it was opened recently)
+            self.db_handler = self.db_pool.get(book_id)
+            self.insight_writer = InsightWriter(self.db_handler)
+            # Move insights captured before content IDs over to them, and mark rows
+            # captured before positions were recorded as unscoped (once per book)
+            self.insight_writer.flush()
+            self.db_handler.migrate_insight_ids()
+            self.db_handler.migrate_scope_fields()
+
+            # Show the document first; indexing runs in the background
             if file_path.lower().endswith('.pdf'):
                 self.open_pdf(file_path)
             elif file_path.lower().endswith('.epub'):
                 self.open_epub(file_path)
 
-    def _process_and_index_document(self, file_path, book_id):
-        """Extracts text from a document, chunks it, and indexes it in the DB."""
-        self.add_to_chat(f"Indexing {os.path.basename(file_path)}... Please wait.")
-        self.root.update_idletasks()
-
-        documents, metadatas, ids = [], [], []
-        
-        try:
-            if file_path.lower().endswith('.pdf'):
-                with fitz.open(file_path) as doc:
-                    for i, page in enumerate(doc):
-                        # Use get_text("blocks") to approximate paragraphs
-                        blocks = page.get_text("blocks")
-                        for j, block in enumerate(blocks):
-                            text = block[4].strip()
-                            if text: # Ensure block is not just whitespace
-                                documents.append(text)
-                                metadatas.append({"source": book_id, "page_num": i, "block_num": j})
-                                ids.append(f"{book_id}_page_{i}_block_{j}")
+            # Skip indexing if the book was fully indexed and hasn't changed since;
+            # otherwise only the chunks that differ from the manifest are re-indexed
+            if IndexManifest(self.db_handler.manifest_path).is_current(file_path, self.db_handler.full_text_source, self.db_handler.embedding_model_id):
+                self.add_to_chat(f"Found existing database for {book_id}. Skipping indexing.")
+                self.index_status = "Complete"
+                self._render_info_panel()
+            else:
+                self._process_and_index_document(file_path, book_id)
 
-            elif file_path.lower().endswith('.epub'):
-                book = epub.read_epub(file_path)
-                for i, item in enumerate(book.get_items_of_type(ITEM_DOCUMENT)):
-                    soup = BeautifulSoup(item.get_content(), 'html.parser')
-                    text = soup.get_text()
-                    if text.strip():
-                        # Chunk by paragraph for EPUB sections
-                        chunks = [chunk.strip() for chunk in text.split('\n\n') if chunk.strip()]
-                        for j, chunk in enumerate(chunks):
-                            documents.append(chunk)
-                            metadatas.append({"source": book_id, "item_num": i, "chunk_num": j})
-                            ids.append(f"{book_id}_item_{i}_chunk_{j}")
-        
-        except Exception as e:
-            self.add_to_chat(f"Error processing document: {e}")
+    def _process_and_index_document(self, file_path, book_id):
+        """Starts indexing a document on a background worker and polls its progress."""
+        self.add_to_chat(f"Indexing {os.path.basename(file_path)} in the background...")
+
+        self.indexing_file_path = file_path
+        self.partial_index_notice_shown = False
+        # Chunk with the LLM's tokenizer so chunk sizes match the prompt budget. The worker loads
+        # its own copy, as the batch indexer does, so chunks match and nothing is shared across threads.
+        # Leased so the pool can't close the handler while the worker (even a cancelled one) still uses it
+        self.db_pool.acquire(book_id)
+        self.indexing_worker = IndexingWorker(
+            self.db_handler, file_path, book_id, tokenizer_path=DEFAULT_MODEL_PATH, parallel=True,
+            on_finished=lambda: self.db_pool.release(book_id)
+        )
+        self.indexing_worker.start()
+
+        self.index_status = "Starting..."
+        self._render_info_panel()
+        self.index_button.config(text="Cancel Indexing", state=tk.NORMAL)
+        self.root.after(INDEX_POLL_MS, self._poll_indexing, self.indexing_worker)
+
+    def _poll_indexing(self, worker):
+        """Updates the info panel from the worker's progress until it finishes."""
+        if worker is not self.indexing_worker:
+            return # A newer book has replaced this worker
+
+        stats = worker.stats
+        if worker.is_alive():
+            if stats and stats.units_total:
+                eta = stats.eta_seconds
+                eta_str = f", ETA {int(eta // 60)}m {int(eta % 60)}s" if eta is not None else ""
+                self.index_status = (
+                    f"{stats.fraction_done:.0%} ({stats.units_done}/{stats.units_total} "
+                    f"{'pages' if worker.file_path.lower().endswith('.pdf') else 'sections'}, "
+                    f"{stats.chunks_indexed} chunks{eta_str})"
+                )
+                self._render_info_panel()
+            self.root.after(INDEX_POLL_MS, self._poll_indexing, worker)
             return
 
-        if not documents:
+        if worker.error:
+            self.add_to_chat(f"Error processing document: {worker.error}")
+            self.index_status = "Failed"
+            self.index_button.config(text="Resume Indexing", state=tk.NORMAL)
+        elif stats.cancelled:
+            self.add_to_chat(f"Indexing paused after {stats.units_done} of {stats.units_total} units. Click 'Resume Indexing' to continue.")
+            self.index_status = f"Paused ({stats.fraction_done:.0%})"
+            self.index_button.config(text="Resume Indexing", state=tk.NORMAL)
+        elif stats.chunks_indexed == 0 and stats.chunks_unchanged == 0 and stats.chunks_failed == 0:
             self.add_to_chat("Could not extract any text chunks from the document.")
-            return
-
-        # Add new data to the full_text_source collection
-        self.db_handler.add_to_collection(
-            self.db_handler.full_text_source,
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
-        
-        self.add_to_chat(f"Successfully indexed {len(documents)} text chunks.")
+            self.index_status = "Empty"
+            self.index_button.config(state=tk.DISABLED)
+        else:
+            self.add_to_chat(
+                f"Successfully indexed {stats.chunks_indexed} new or changed text chunks in {stats.elapsed:.1f}s "
+                f"({stats.chunks_per_second:.1f} chunks/s). {stats.chunks_unchanged} unchanged, {stats.chunks_removed} removed."
+            )
+            if stats.chunks_failed:
+                self.add_to_chat(f"Warning: {stats.chunks_failed} chunks failed to index. Check console for details.")
+                self.index_status = "Incomplete"
+                self.index_button.config(text="Resume Indexing", state=tk.NORMAL)
+            else:
+                self.index_status = "Complete"
+                self.index_button.config(state=tk.DISABLED)
+        self._render_info_panel()
+
+    def toggle_indexing(self):
+        """Cancels the running indexing worker, or resumes indexing the current book."""
+        if self.indexing_worker and self.indexing_worker.is_alive():
+            self.indexing_worker.cancel()
+            self.index_status = "Cancelling..."
+            self.index_button.config(state=tk.DISABLED)
+            self._render_info_panel()
+        elif self.indexing_file_path and self.db_handler:
+            self._process_and_index_document(self.indexing_file_path, self.indexing_worker.book_id)
+
+    def _cancel_indexing(self):
+        if self.indexing_worker and self.indexing_worker.is_alive():
+            self.indexing_worker.cancel()
+        self.indexing_worker = None
+        self.indexing_file_path = None
+        self.index_status = ""
+        self.index_button.config(text="Cancel Indexing", state=tk.DISABLED)
+
+    def shutdown(self):
+        """Stops background work cleanly before closing the window."""
+        worker = self.indexing_worker
+        self._cancel_indexing()
+        if worker:
+            # Let the worker flush its current batch so the manifest stays consistent
+            worker.join(timeout=10)
+        if self.generation_worker:
+            self.generation_worker.close()
+        if self.insight_writer:
+            self.insight_writer.close()
+        self.db_pool.close_all()
+        self.root.destroy()
 
     def open_pdf(self, file_path):
         if self.epub_viewer_frame:
@@ -631,6 +1017,8 @@ class TrainerBaseApp:
                         self.epub_chapters.append(item)
             
             self.href_map = {item.file_name: i for i, item in enumerate(self.epub_chapters)}
+            # The indexer numbers every document item in manifest order, not just the spine's chapters
+            self.epub_item_nums = {item.id: i for i, item in enumerate(self.epub_book.get_items_of_type(ITEM_DOCUMENT))}
 
             if self.epub_chapters:
                 self.epub_chapter_index = 0
@@ -696,7 +1084,27 @@ class TrainerBaseApp:
 
 def main():
     """Main function to run the app or CLI."""
-    # This version does not support CLI arguments
+    # `python main.py index [DIR] [options]` indexes a library without the GUI
+    if len(sys.argv) > 1 and sys.argv[1] == "index":
+        from batch_indexer import main as batch_index_main
+        batch_index_main(sys.argv[2:])
+        return
+    # `python main.py maintain [BOOK ...] [options]` reports on, prunes and compacts the stores
+    if len(sys.argv) > 1 and sys.argv[1] == "maintain":
+        from maintenance import main as maintain_main
+        maintain_main(sys.argv[2:])
+        return
+    # `python main.py cpu-profile [options]` benchmarks the LLM's CPU profiles and saves the fastest
+    if len(sys.argv) > 1 and sys.argv[1] == "cpu-profile":
+        from llm_handler import benchmark_main
+        benchmark_main(sys.argv[2:])
+        return
+    # `python main.py qa BOOK [...] [options]` generates candidate Q&A pairs from indexed books
+    if len(sys.argv) > 1 and sys.argv[1] == "qa":
+        from qa_generator import main as qa_main
+        qa_main(sys.argv[2:])
+        return
+
     root = tk.Tk()
     app = TrainerBaseApp(root)
     root.mainloop()
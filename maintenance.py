@@ -0,0 +1,318 @@
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import time
+from collections import defaultdict
+from db_handler import DBHandler, STORAGE_ROOT, list_books, safe_book_id
+
+# Rows copied per page when a collection's index is rebuilt
+_REBUILD_PAGE_SIZE = 1000
+# ChromaDB names each HNSW segment directory after the segment's UUID
+_SEGMENT_DIR_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+_SECONDS_PER_DAY = 86400
+COLLECTION_NAMES = ["full_text_source", "already_covered_db", "current_chapter_insights_db"]
+
+
+def directory_bytes(path):
+    """
+    Returns the total size of the files under a directory.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _sqlite_paths(db_path):
+    base = os.path.join(db_path, "chroma.sqlite3")
+    return [base, base + "-wal", base + "-shm"]
+
+
+def vector_segments(db_path):
+    """
+    Returns a dict of HNSW segment ID -> collection name, read from ChromaDB's sqlite catalog.
+    """
+    sqlite_path = os.path.join(db_path, "chroma.sqlite3")
+    try:
+        conn = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                "SELECT s.id, c.name FROM segments s JOIN collections c ON s.collection = c.id WHERE s.scope = 'VECTOR'"
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Error reading segments from {sqlite_path}: {e}")
+        return {}
+    return dict(rows)
+
+
+def orphaned_segment_dirs(db_path):
+    """
+    Returns segment directories that no collection refers to any more,
+    e.g. those left behind by deleted or cleared collections.
+    """
+    live = vector_segments(db_path)
+    if not live:
+        # Without a readable catalog, nothing can safely be called orphaned
+        return []
+    return sorted(
+        os.path.join(db_path, name) for name in os.listdir(db_path)
+        if _SEGMENT_DIR_RE.match(name) and name not in live and os.path.isdir(os.path.join(db_path, name))
+    )
+
+
+def storage_report(book_id, counts=None):
+    """
+    Measures a book's on-disk footprint.
+
+    Args:
+        book_id (str): The book to measure.
+        counts (dict): Row counts by collection name, if a handler was open to count them.
+
+    Returns:
+        A dict with per-collection rows and index bytes, the sqlite catalog's
+        bytes, orphaned segment bytes, sidecar file bytes and the total.
+    """
+    db_path = os.path.join(STORAGE_ROOT, safe_book_id(book_id))
+    collections = {}
+    for segment_id, name in vector_segments(db_path).items():
+        collections[name] = {
+            "rows": (counts or {}).get(name),
+            "index_bytes": directory_bytes(os.path.join(db_path, segment_id)),
+        }
+
+    sidecar_prefix = safe_book_id(book_id) + "."
+    sidecar_bytes = 0
+    for name in os.listdir(STORAGE_ROOT):
+        path = os.path.join(STORAGE_ROOT, name)
+        if name.startswith(sidecar_prefix):
+            # Manifest, BM25 index and centroid files, and snapshot directories
+            sidecar_bytes += directory_bytes(path) if os.path.isdir(path) else os.path.getsize(path)
+    return {
+        "collections": collections,
+        "sqlite_bytes": sum(os.path.getsize(path) for path in _sqlite_paths(db_path) if os.path.exists(path)),
+        "orphaned_bytes": sum(directory_bytes(path) for path in orphaned_segment_dirs(db_path)),
+        "sidecar_bytes": sidecar_bytes,
+        "total_bytes": directory_bytes(db_path) + sidecar_bytes,
+    }
+
+
+def _format_bytes(size):
+    if size < 1024:
+        return f"{size} B"
+    for unit in ("KB", "MB", "GB"):
+        size /= 1024
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+
+
+def _count_rows(db_handler):
+    return {name: db_handler.collection_count(getattr(db_handler, name)) for name in COLLECTION_NAMES}
+
+
+def print_report(book_id, report):
+    print(f"\n--- Storage for '{book_id}' ---")
+    for name, info in sorted(report["collections"].items()):
+        rows = "?" if info["rows"] is None else info["rows"]
+        print(f"  {name}: {rows} rows, index {_format_bytes(info['index_bytes'])}")
+    print(f"  sqlite catalog: {_format_bytes(report['sqlite_bytes'])}")
+    if report["orphaned_bytes"]:
+        print(f"  orphaned segments: {_format_bytes(report['orphaned_bytes'])}")
+    print(f"  sidecar files: {_format_bytes(report['sidecar_bytes'])}")
+    print(f"  total: {_format_bytes(report['total_bytes'])}")
+
+
+def select_expired_insights(metadatas, ids, max_age_days=None, max_per_chapter=None, now=None):
+    """
+    Chooses which insights a retention policy removes.
+
+    Insights older than max_age_days are removed, then only the newest
+    max_per_chapter insights of each chapter are kept. Insights captured
+    before created_at/chapter were recorded are never treated as expired,
+    and are not counted against a chapter's cap.
+
+    Returns:
+        The IDs to delete.
+    """
+    now = time.time() if now is None else now
+    expired = set()
+    by_chapter = defaultdict(list)
+    for doc_id, metadata in zip(ids, metadatas):
+        metadata = metadata or {}
+        created_at = metadata.get("created_at")
+        if created_at is None:
+            continue
+        if max_age_days is not None and created_at < now - max_age_days * _SECONDS_PER_DAY:
+            expired.add(doc_id)
+        elif "chapter" in metadata:
+            by_chapter[metadata["chapter"]].append((created_at, doc_id))
+
+    if max_per_chapter is not None:
+        for insights in by_chapter.values():
+            insights.sort(reverse=True)
+            expired.update(doc_id for _, doc_id in insights[max_per_chapter:])
+    return [doc_id for doc_id in ids if doc_id in expired]
+
+
+def apply_insight_retention(db_handler, max_age_days=None, max_per_chapter=None, dry_run=False):
+    """
+    Deletes insights from current_chapter_insights_db that fall outside the retention policy.
+
+    Returns:
+        The number of insights deleted (or that would be, with dry_run).
+    """
+    if max_age_days is None and max_per_chapter is None:
+        return 0
+    rows = db_handler.current_chapter_insights_db.get(include=["metadatas"])
+    expired = select_expired_insights(rows["metadatas"], rows["ids"], max_age_days, max_per_chapter)
+    if expired and not dry_run:
+        db_handler.delete_from_collection(db_handler.current_chapter_insights_db, expired)
+    print(f"Retention: {len(expired)} of {len(rows['ids'])} insights {'would be ' if dry_run else ''}removed")
+    return len(expired)
+
+
+def rebuild_collection(db_handler, collection_name):
+    """
+    Rebuilds a collection's HNSW index from its stored embeddings.
+
+    HNSW only marks deleted vectors, so an index that has seen many updates
+    and deletions keeps their space. The rows are copied into a fresh
+    collection, created with the handler's current HNSW settings, which then
+    replaces the original. Nothing is re-embedded.
+
+    Returns:
+        The rebuilt collection.
+    """
+    client = db_handler.client
+    original = getattr(db_handler, collection_name)
+    temp_name = f"{collection_name}__rebuild"
+    try:
+        leftover = client.get_collection(name=temp_name)
+    except Exception:
+        leftover = None
+    if leftover is not None:
+        if original.count() == 0 and leftover.count() > 0:
+            # An earlier rebuild was interrupted after dropping the original; finish it
+            client.delete_collection(name=collection_name)
+            leftover.modify(name=collection_name)
+            original = client.get_collection(name=collection_name, embedding_function=db_handler.embedding_function)
+            print(f"Recovered '{collection_name}' from an interrupted rebuild")
+        else:
+            client.delete_collection(name=temp_name)
+
+    # The rebuilt index takes the handler's configured HNSW settings, which can't be changed in place
+    metadata = {key: value for key, value in (original.metadata or {}).items() if not key.startswith("hnsw:")}
+    metadata.update(db_handler.hnsw_config.get(collection_name, {}))
+    rebuilt = client.create_collection(
+        name=temp_name,
+        metadata=metadata or None,
+        embedding_function=db_handler.embedding_function
+    )
+    total = original.count()
+    for offset in range(0, total, _REBUILD_PAGE_SIZE):
+        rows = original.get(include=["embeddings", "documents", "metadatas"], limit=_REBUILD_PAGE_SIZE, offset=offset)
+        rebuilt.add(ids=rows["ids"], embeddings=rows["embeddings"], documents=rows["documents"], metadatas=rows["metadatas"])
+
+    client.delete_collection(name=collection_name)
+    rebuilt.modify(name=collection_name)
+    setattr(db_handler, collection_name, rebuilt)
+    db_handler._collection_changed(collection_name)
+    print(f"Rebuilt index for '{collection_name}' ({total} rows)")
+    return rebuilt
+
+
+def compact_store(book_id, dry_run=False):
+    """
+    Removes orphaned segment directories and vacuums a book's sqlite catalog.
+
+    Must run while no client has the book open.
+    """
+    db_path = os.path.join(STORAGE_ROOT, safe_book_id(book_id))
+    for path in orphaned_segment_dirs(db_path):
+        print(f"{'Would remove' if dry_run else 'Removing'} orphaned segment {path}")
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+    if dry_run:
+        return
+
+    try:
+        conn = sqlite3.connect(os.path.join(db_path, "chroma.sqlite3"))
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Error vacuuming {db_path}: {e}")
+
+
+def maintain_book(book_id, max_age_days=None, max_per_chapter=None, rebuild=False, vacuum=True, dry_run=False):
+    """
+    Reports a book's storage, applies insight retention, optionally rebuilds
+    its indexes and compacts it, then reports again.
+
+    Returns:
+        (report before, report after)
+    """
+    db_handler = DBHandler(book_id=book_id)
+    try:
+        before = storage_report(book_id, _count_rows(db_handler))
+        print_report(book_id, before)
+
+        apply_insight_retention(db_handler, max_age_days, max_per_chapter, dry_run=dry_run)
+        if rebuild and not dry_run:
+            for name in COLLECTION_NAMES:
+                rebuild_collection(db_handler, name)
+        counts = _count_rows(db_handler)
+    finally:
+        db_handler.close()
+
+    if vacuum:
+        compact_store(book_id, dry_run=dry_run)
+    after = storage_report(book_id, counts)
+    if not dry_run:
+        print_report(book_id, after)
+        print(f"Reclaimed {_format_bytes(max(before['total_bytes'] - after['total_bytes'], 0))}")
+    return before, after
+
+
+def main(argv=None):
+    """Entry point for `python main.py maintain`. Run it while the app is closed."""
+    parser = argparse.ArgumentParser(description="Report on, prune and compact the per-book vector stores.")
+    parser.add_argument("books", nargs="*", help="Books to maintain (default: every book in chroma_storage)")
+    parser.add_argument("--max-age-days", type=float, default=None, help="Delete captured insights older than this")
+    parser.add_argument("--max-per-chapter", type=int, default=None, help="Keep only this many of the newest insights per chapter")
+    parser.add_argument("--rebuild-index", action="store_true", help="Rebuild each collection's HNSW index to drop deleted vectors")
+    parser.add_argument("--no-vacuum", action="store_true", help="Skip removing orphaned segments and vacuuming sqlite")
+    parser.add_argument("--report-only", action="store_true", help="Only print the storage report")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would be removed without changing anything")
+    args = parser.parse_args(argv)
+
+    for book_id in args.books or list_books():
+        if args.report_only:
+            db_handler = DBHandler(book_id=book_id)
+            try:
+                counts = _count_rows(db_handler)
+            finally:
+                db_handler.close()
+            print_report(book_id, storage_report(book_id, counts))
+            continue
+        maintain_book(
+            book_id,
+            max_age_days=args.max_age_days,
+            max_per_chapter=args.max_per_chapter,
+            rebuild=args.rebuild_index,
+            vacuum=not args.no_vacuum,
+            dry_run=args.dry_run
+        )
+
+
+if __name__ == "__main__":
+    main()
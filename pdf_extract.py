@@ -0,0 +1,95 @@
+import bisect
+import sys
+import types
+from multiprocessing.context import SpawnContext, SpawnProcess
+import fitz  # PyMuPDF
+
+# PDF page chunking, and the worker side of indexer.iter_pdf_units_parallel.
+# Worker processes import this module, so keep the rest of the app's imports out of it.
+
+
+def pdf_page_chunks(page, book_id, page_num, chunker):
+    """
+    Returns the (document, metadata, id) chunks for a single PDF page.
+
+    The page's text blocks are joined with blank lines and re-chunked to the
+    chunker's token target. char_start/char_end are offsets into that joined
+    text, and block_num is the first block the chunk covers.
+    """
+    texts, block_nums, block_starts = [], [], []
+    offset = 0
+    # Use get_text("blocks") to approximate paragraphs
+    for j, block in enumerate(page.get_text("blocks")):
+        text = block[4].strip()
+        if text: # Ensure block is not just whitespace
+            texts.append(text)
+            block_nums.append(j)
+            block_starts.append(offset)
+            offset += len(text) + 2
+
+    page_text = "\n\n".join(texts)
+    chunks = []
+    for k, (text, char_start, char_end, token_count) in enumerate(chunker.chunk(page_text, block_starts)):
+        block_index = bisect.bisect_right(block_starts, char_start) - 1
+        chunks.append((
+            text,
+            {
+                "source": book_id, "page_num": page_num, "chunk_num": k,
+                "block_num": block_nums[block_index],
+                "char_start": char_start, "char_end": char_end, "token_count": token_count
+            },
+            f"{book_id}_page_{page_num}_chunk_{k}"
+        ))
+    return chunks
+
+
+# Set once per worker process by init_worker, so the chunker (and its
+# tokenizer) is pickled once per process rather than once per task
+_worker_chunker = None
+
+
+def init_worker(chunker):
+    global _worker_chunker
+    _worker_chunker = chunker
+
+
+def extract_page_range(file_path, book_id, start, stop):
+    """
+    Worker entry point for parallel extraction. Opens its own fitz.Document
+    and returns the (page_num, chunks) units for pages [start, stop).
+    """
+    with fitz.open(file_path) as doc:
+        return [(i, pdf_page_chunks(doc.load_page(i), book_id, i, _worker_chunker)) for i in range(start, stop)]
+
+
+class _WorkerProcess(SpawnProcess):
+    """
+    A spawned process that doesn't re-run the launching script.
+
+    A spawned child normally runs the parent's __main__ (as __mp_main__)
+    before its task. For main.py that would import tkinter, torch and
+    chromadb in every worker. While the process starts, __main__ is
+    replaced by an empty module, so the child only imports the modules its
+    task is pickled from.
+    """
+    def start(self):
+        main_module = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            super().start()
+        finally:
+            sys.modules["__main__"] = main_module
+
+
+class _WorkerContext(SpawnContext):
+    Process = _WorkerProcess
+
+
+def worker_context():
+    """
+    Returns the multiprocessing context for extraction workers: spawn rather
+    than fork, since callers run torch/OpenMP and tokenizer threads that a
+    forked child would inherit in an undefined state, and without re-running
+    the launching script (see _WorkerProcess).
+    """
+    return _WorkerContext()
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import re
+import time
+from chunker import DEFAULT_MODEL_PATH
+from db_handler import DBHandler, safe_book_id
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "training_data")
+
+# Chunks read from ChromaDB, and prompts handed to generate_batch(), per round.
+# Results are appended to the output after each round, so an interrupted run loses at most one.
+_PAGE_SIZE = 256
+
+QA_PROMPT = """Write one question a student might ask about the passage below, and its answer, using only the passage.
+Reply in exactly this form:
+Question: <the question>
+Answer: <the answer>
+
+Passage:
+{passage}
+"""
+
+_QA_RE = re.compile(r"Question:\s*(?P<question>.+?)\s*Answer:\s*(?P<answer>.+)", re.DOTALL | re.IGNORECASE)
+# generate_batch() returns these in place of a reply; such chunks are retried on the next run
+_GENERATION_ERRORS = ("Error during text generation", "Model is not loaded")
+
+
+def parse_qa(text):
+    """
+    Extracts the question and answer from a reply to QA_PROMPT.
+
+    Returns:
+        (question, answer), or None if the reply isn't in the expected form.
+    """
+    match = _QA_RE.search(text)
+    if not match:
+        return None
+    question = match.group("question").strip()
+    answer = match.group("answer").strip()
+    if not question or not answer:
+        return None
+    return question, answer
+
+
+def default_output_path(book_id):
+    return os.path.join(DEFAULT_OUTPUT_DIR, f"{safe_book_id(book_id)}.qa.jsonl")
+
+
+def unparsed_path(output_path):
+    """
+    Returns the path recording chunks whose reply didn't parse, next to the output file.
+    """
+    return output_path + ".unparsed"
+
+
+def done_chunk_ids(output_path):
+    """
+    Returns the chunk IDs already written to an output file, or recorded as
+    unparsed next to it, so a run can resume without prompting them again.
+    """
+    done = set()
+    for path in (output_path, unparsed_path(output_path)):
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["source_id"])
+                except (ValueError, KeyError):
+                    continue # A torn final line from an interrupted run
+    return done
+
+
+def _open_for_append(path):
+    """
+    Opens a JSON lines file for appending, starting a fresh line if an
+    interrupted run left a torn one, so the next record isn't merged into it.
+    """
+    torn = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    f = open(path, "a", encoding="utf-8")
+    if torn:
+        f.write("\n")
+    return f
+
+
+def iter_chunks(db_handler, page_size=_PAGE_SIZE):
+    """
+    Yields (id, document, metadata) for every chunk in a book's full_text_source.
+    """
+    collection = db_handler.full_text_source
+    for offset in range(0, collection.count(), page_size):
+        rows = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        for chunk_id, document, metadata in zip(rows["ids"], rows["documents"], rows["metadatas"]):
+            yield chunk_id, document, metadata
+
+
+def generate_book_qa(llm_handler, book_id, output_path, max_new_tokens=150, token_budget=None, limit=None):
+    """
+    Generates a candidate Q&A pair from each of a book's chunks and appends
+    them to output_path as JSON lines. Chunks whose reply doesn't parse are
+    recorded in unparsed_path(output_path). Chunks in either file are skipped.
+
+    Returns:
+        {"chunks": chunks prompted, "pairs": pairs written, "unparsed": replies
+        that didn't parse, "seconds": elapsed}
+    """
+    done = done_chunk_ids(output_path)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    batch_kwargs = {"max_new_tokens": max_new_tokens}
+    if token_budget:
+        batch_kwargs["token_budget"] = token_budget
+
+    stats = {"chunks": 0, "pairs": 0, "unparsed": 0}
+    started = time.perf_counter()
+    db_handler = DBHandler(book_id=book_id)
+    try:
+        pending = []
+        for chunk in iter_chunks(db_handler):
+            if chunk[0] in done or not chunk[1]:
+                continue
+            if limit is not None and stats["chunks"] + len(pending) >= limit:
+                break
+            pending.append(chunk)
+            if len(pending) >= _PAGE_SIZE:
+                _generate_round(llm_handler, pending, output_path, batch_kwargs, stats)
+                pending = []
+        if pending:
+            _generate_round(llm_handler, pending, output_path, batch_kwargs, stats)
+    finally:
+        db_handler.close()
+
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+
+def _generate_round(llm_handler, chunks, output_path, batch_kwargs, stats):
+    replies = llm_handler.generate_batch([QA_PROMPT.format(passage=document) for _, document, _ in chunks], **batch_kwargs)
+    with _open_for_append(output_path) as f, _open_for_append(unparsed_path(output_path)) as unparsed:
+        for (chunk_id, document, metadata), reply in zip(chunks, replies):
+            pair = parse_qa(reply)
+            if pair is None:
+                if reply and not reply.startswith(_GENERATION_ERRORS):
+                    # The model answered, just not in the expected form; don't prompt this chunk again
+                    unparsed.write(json.dumps({"source_id": chunk_id, "reply": reply}) + "\n")
+                    stats["unparsed"] += 1
+                continue
+            f.write(json.dumps({
+                "question": pair[0],
+                "answer": pair[1],
+                "source_id": chunk_id,
+                "source_text": document,
+                "metadata": metadata,
+            }) + "\n")
+            stats["pairs"] += 1
+    stats["chunks"] += len(chunks)
+    print(f"Prompted {stats['chunks']} chunks, kept {stats['pairs']} Q&A pairs, {stats['unparsed']} replies unparsed")
+
+
+def main(argv=None):
+    """Entry point for `python main.py qa`: generates candidate Q&A training pairs from indexed books."""
+    parser = argparse.ArgumentParser(description="Generate candidate Q&A pairs from every indexed chunk of a book.")
+    parser.add_argument("books", nargs="+", help="IDs of indexed books (their file names without extension)")
+    parser.add_argument("--output", default=None, help="Output JSONL file (default: training_data/<book>.qa.jsonl; only with one book)")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Local model directory")
+    parser.add_argument("--max-new-tokens", type=int, default=150, help="Tokens generated per chunk")
+    parser.add_argument("--token-budget", type=int, default=None, help="Padded prompt + output tokens per batch")
+    parser.add_argument("--limit", type=int, default=None, help="Prompt at most this many new chunks per book")
+    parser.add_argument("--cpu-profile", default="fp32", choices=["auto", "fp32", "bf16", "int8"], help="CPU inference profile (auto: the fastest saved by `python main.py cpu-profile`)")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads")
+    args = parser.parse_args(argv)
+
+    if args.output and len(args.books) > 1:
+        parser.error("--output can only be used with a single book")
+
+    # Imported here so the rest of the module doesn't need torch
+    from llm_handler import LLMHandler
+    llm_handler = LLMHandler(model_path=args.model, cpu_profile=args.cpu_profile, intra_op_threads=args.threads)
+    if not llm_handler.model:
+        print("LLM failed to load; nothing generated.")
+        return
+
+    for book_id in args.books:
+        output_path = args.output or default_output_path(book_id)
+        stats = generate_book_qa(
+            llm_handler, book_id, output_path,
+            max_new_tokens=args.max_new_tokens, token_budget=args.token_budget, limit=args.limit
+        )
+        print(f"{book_id}: {stats['pairs']} Q&A pairs from {stats['chunks']} chunks in {stats['seconds']:.1f}s -> {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import pytest
+from chunker import TextChunker
+
+def test_small_paragraphs_are_merged():
+    """
+    Tests that many short paragraphs end up in a single chunk under the target size.
+    """
+    text = "\n\n".join(f"Paragraph {i} is short." for i in range(10))
+    chunker = TextChunker(target_tokens=200, overlap_tokens=10)
+
+    chunks = chunker.chunk(text)
+
+    assert len(chunks) == 1
+    chunk_text, char_start, char_end, token_count = chunks[0]
+    assert chunk_text == text[char_start:char_end]
+    assert token_count <= 200
+
+def test_large_text_is_split_with_overlap():
+    """
+    Tests that text over the target is split into bounded chunks that overlap.
+    """
+    text = " ".join(f"word{i}" for i in range(100))
+    chunker = TextChunker(target_tokens=30, overlap_tokens=5)
+
+    chunks = chunker.chunk(text)
+
+    assert len(chunks) > 1
+    assert all(token_count <= 30 for _, _, _, token_count in chunks)
+    # Consecutive chunks share their boundary tokens
+    for (_, _, prev_end, _), (_, next_start, _, _) in zip(chunks, chunks[1:]):
+        assert next_start < prev_end
+    assert chunks[-1][0].endswith("word99")
+
+def test_chunks_end_on_paragraph_boundaries():
+    """
+    Tests that chunk ends snap back to a paragraph break when one is nearby.
+    """
+    paragraphs = [" ".join(f"p{p}w{i}" for i in range(8)) for p in range(6)]
+    text = "\n\n".join(paragraphs)
+    chunker = TextChunker(target_tokens=20, overlap_tokens=0)
+
+    chunks = chunker.chunk(text)
+
+    assert [chunk_text for chunk_text, _, _, _ in chunks] == ["\n\n".join(paragraphs[i:i + 2]) for i in range(0, 6, 2)]
+
+def test_overlap_must_be_smaller_than_target():
+    with pytest.raises(ValueError):
+        TextChunker(target_tokens=10, overlap_tokens=10)
+
+def test_empty_text_has_no_chunks():
+    assert TextChunker().chunk("   \n\n  ") == []
@@ -1,7 +1,11 @@
 import pytest
 import os
 import shutil
-from db_handler import DBHandler
+import time
+from concurrent.futures import ThreadPoolExecutor
+import db_handler as db_handler_module
+from db_handler import (DBHandler, DBHandlerPool, QueryCache, content_id, include_unscoped, insight_ids_marker_path,
+                        range_filter, scope_fields_marker_path, snapshot_pending_path)
 
 # Pytest fixture to create a temporary directory for testing
 @pytest.fixture
@@ -82,3 +86,325 @@ def test_clear_collection(temp_db_path):
     
     # Verify it's empty
     assert db_handler.current_chapter_insights_db.count() == 0
+
+def test_upsert_and_delete_from_collection(temp_db_path):
+    """
+    Tests that upserting replaces documents by ID and that deletion removes them.
+    """
+    book_id = "test_upsert_book"
+    db_handler = DBHandler(book_id=book_id)
+    db_handler.current_chapter_insights_db = db_handler.clear_collection("current_chapter_insights_db")
+    collection = db_handler.current_chapter_insights_db
+
+    assert db_handler.upsert_to_collection(collection, ["first"], [{"s": "1"}], ["id1"])
+    assert db_handler.upsert_to_collection(collection, ["second"], [{"s": "1"}], ["id1"])
+    assert collection.count() == 1
+    assert collection.get(ids=["id1"])['documents'] == ["second"]
+
+    assert db_handler.delete_from_collection(collection, ["id1"])
+    assert collection.count() == 0
+
+def test_db_handler_pool_reuses_and_evicts(temp_db_path):
+    """
+    Tests that the pool returns the same handler for a recent book and closes the least recently used one.
+    """
+    pool = DBHandlerPool(max_open=2)
+
+    first = pool.get("test_pool_book_1")
+    assert pool.get("test_pool_book_1") is first
+
+    pool.get("test_pool_book_2")
+    pool.get("test_pool_book_1") # Make book 2 the least recently used
+    pool.get("test_pool_book_3")
+
+    assert len(pool) == 2
+    assert "test_pool_book_2" not in pool
+    assert "test_pool_book_1" in pool
+
+    # A closed book can be reopened and used again
+    reopened = pool.get("test_pool_book_2")
+    assert reopened.full_text_source.count() >= 0
+
+    pool.close_all()
+    assert len(pool) == 0
+    assert first.client is None
+
+def test_db_handler_pool_keeps_acquired_handlers_open(temp_db_path):
+    """
+    Tests that an acquired handler survives eviction until it is released.
+    """
+    pool = DBHandlerPool(max_open=1)
+    leased = pool.acquire("test_pool_book_1")
+    pool.get("test_pool_book_2")
+    pool.get("test_pool_book_3")
+
+    assert leased.client is not None
+    assert leased.full_text_source.count() >= 0
+
+    pool.release("test_pool_book_1")
+    assert leased.client is None
+    pool.close_all()
+
+def test_db_handler_pool_opens_a_book_once_across_threads(temp_db_path):
+    """
+    Tests that threads asking for the same unopened book share one handler.
+    """
+    pool = DBHandlerPool(max_open=2)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        handlers = list(executor.map(pool.get, ["test_pool_shared_book"] * 4))
+
+    assert all(handler is handlers[0] for handler in handlers)
+    assert handlers[0].full_text_source.count() >= 0
+    pool.close_all()
+
+def test_closing_a_handler_keeps_others_on_the_same_store_working(temp_db_path):
+    """
+    Tests that closing one of two handlers for the same book doesn't stop the store under the other.
+    """
+    first = DBHandler(book_id="test_shared_store_book")
+    second = DBHandler(book_id="test_shared_store_book")
+    first.close()
+
+    second.upsert_to_collection(second.current_chapter_insights_db, ["Still writable."], [{"s": "1"}], ["shared_1"])
+    assert second.current_chapter_insights_db.count() >= 1
+    second.close()
+
+def wait_for_snapshot(db_handler, collection, timeout=10):
+    """Queries until the collection's background snapshot export has finished."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        snapshot = db_handler.snapshot(collection)
+        if snapshot is not None:
+            return snapshot
+        time.sleep(0.05)
+    raise AssertionError("snapshot was not exported")
+
+def test_snapshot_left_mid_write_is_not_trusted(temp_db_path):
+    """
+    Tests that a snapshot whose write was interrupted is re-exported even though its row count still matches.
+    """
+    book_id = "test_snapshot_crash_book"
+    db_handler = DBHandler(book_id=book_id)
+    collection = db_handler.already_covered_db = db_handler.clear_collection("already_covered_db")
+    db_handler.upsert_to_collection(collection, ["old text"], [{"s": "1"}], ["row1"])
+    assert db_handler.snapshot(collection).get(["row1"])["documents"] == ["old text"]
+    assert not os.path.exists(snapshot_pending_path(book_id, collection.name))
+
+    # A same-ID upsert reached ChromaDB, then the process died before the snapshot was updated
+    open(snapshot_pending_path(book_id, collection.name), "w").close()
+    collection.upsert(ids=["row1"], documents=["new text"], metadatas=[{"s": "1"}])
+    db_handler.close()
+    assert db_handler._snapshots == {} and db_handler._lexical_index is None
+
+    reopened = DBHandler(book_id=book_id)
+    snapshot = wait_for_snapshot(reopened, reopened.already_covered_db)
+    assert snapshot.get(["row1"])["documents"] == ["new text"]
+    assert not os.path.exists(snapshot_pending_path(book_id, collection.name))
+    reopened.close()
+
+def test_writes_during_a_snapshot_export_are_replayed(temp_db_path, monkeypatch):
+    """
+    Tests that a write made while a snapshot is exporting ends up in the snapshot instead of discarding the export.
+    """
+    db_handler = DBHandler(book_id="test_snapshot_replay_book")
+    collection = db_handler.already_covered_db = db_handler.clear_collection("already_covered_db")
+    db_handler.upsert_to_collection(collection, ["first"], [{"s": "1"}], ["row1"])
+    db_handler.upsert_to_collection(collection, ["second"], [{"s": "1"}], ["row2"])
+    db_handler._snapshots.pop(collection.name).close()
+    db_handler._stale_snapshots.add(collection.name)
+
+    export = db_handler_module.EmbeddingSnapshot.export
+    def export_while_indexing(*args, **kwargs):
+        exported = export(*args, **kwargs)
+        db_handler.upsert_to_collection(collection, ["written meanwhile"], [{"s": "1"}], ["row3"])
+        db_handler.delete_from_collection(collection, ["row1"])
+        return exported
+    monkeypatch.setattr(db_handler_module.EmbeddingSnapshot, "export", export_while_indexing)
+
+    snapshot = wait_for_snapshot(db_handler, collection)
+    assert snapshot.live_count == 2
+    assert snapshot.get(["row1", "row2", "row3"])["documents"] == ["second", "written meanwhile"]
+    db_handler.close()
+
+def test_queries_move_to_chromadb_once_hnsw_has_loaded(temp_db_path):
+    """
+    Tests that the snapshot answers queries only until ChromaDB has loaded the collection's HNSW index.
+    """
+    db_handler = DBHandler(book_id="test_snapshot_hnsw_book")
+    collection = db_handler.already_covered_db = db_handler.clear_collection("already_covered_db")
+    db_handler.upsert_to_collection(collection, ["alpha", "beta"], [{"s": "1"}, {"s": "1"}], ["row1", "row2"])
+    snapshot = db_handler.snapshot(collection)
+    snapshot_queries = []
+    query = snapshot.query
+    snapshot.query = lambda *args, **kwargs: snapshot_queries.append(args) or query(*args, **kwargs)
+
+    query_embedding = db_handler.embed_query("alpha")
+    assert db_handler.query_by_embedding(collection, query_embedding, n_results=1)["ids"] == [["row1"]]
+    assert len(snapshot_queries) == 1
+
+    deadline = time.monotonic() + 10
+    while collection.name not in db_handler._hnsw_loaded and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert db_handler.query_by_embedding(collection, query_embedding, n_results=1)["ids"] == [["row1"]]
+    assert len(snapshot_queries) == 1
+    db_handler.close()
+
+def test_query_collections_embeds_once(temp_db_path):
+    """
+    Tests that querying several collections embeds the query text only once and returns results per collection.
+    """
+    book_id = "test_multi_query_book"
+    db_handler = DBHandler(book_id=book_id)
+    db_handler.already_covered_db = db_handler.clear_collection("already_covered_db")
+    db_handler.current_chapter_insights_db = db_handler.clear_collection("current_chapter_insights_db")
+
+    db_handler.add_to_collection(db_handler.already_covered_db, ["Covered text about decorators."], [{"s": "1"}], ["c1"])
+    db_handler.add_to_collection(db_handler.current_chapter_insights_db, ["Insight about decorators."], [{"s": "1"}], ["i1"])
+
+    calls = []
+    embedding_function = db_handler.embedding_function
+    def counting_embedding_function(texts):
+        calls.append(list(texts))
+        return embedding_function(texts)
+    db_handler.embedding_function = counting_embedding_function
+
+    results = db_handler.query_collections(
+        [db_handler.already_covered_db, db_handler.current_chapter_insights_db, db_handler.full_text_source],
+        "decorators", n_results=2, parallel=True
+    )
+
+    assert calls == [["decorators"]]
+    assert results["already_covered_db"]['documents'][0] == ["Covered text about decorators."]
+    assert results["current_chapter_insights_db"]['documents'][0] == ["Insight about decorators."]
+    assert "full_text_source" in results
+
+def test_query_cache_hits_and_invalidates_on_write(temp_db_path):
+    """
+    Tests that a repeated (normalized) query is served from the cache until the collection is written to.
+    """
+    book_id = "test_query_cache_book"
+    db_handler = DBHandler(book_id=book_id)
+    db_handler.current_chapter_insights_db = db_handler.clear_collection("current_chapter_insights_db")
+    collection = db_handler.current_chapter_insights_db
+    db_handler.add_to_collection(collection, ["An insight about generators."], [{"s": "1"}], ["g1"])
+
+    first = db_handler.query_collection(collection, ["What are generators?"])
+    second = db_handler.query_collection(collection, ["  what are   GENERATORS? "])
+    assert second is first
+    assert db_handler.query_cache.hits == 1
+
+    db_handler.add_to_collection(collection, ["Another insight about generators."], [{"s": "2"}], ["g2"])
+    third = db_handler.query_collection(collection, ["What are generators?"])
+    assert third is not first
+    assert len(third['documents'][0]) == 2
+
+def test_query_cache_expires_entries():
+    """
+    Tests that cached results expire after the TTL and that the cache stays bounded.
+    """
+    cache = QueryCache(max_entries=2, ttl_seconds=0)
+    key = QueryCache.make_key("c", ["q"], 3)
+    cache.put(key, {"documents": [["d"]]})
+    assert cache.get(key) is None
+
+    cache = QueryCache(max_entries=2, ttl_seconds=60)
+    for i in range(3):
+        cache.put(QueryCache.make_key("c", [f"q{i}"], 3), {"i": i})
+    assert cache.get(QueryCache.make_key("c", ["q0"], 3)) is None
+    assert cache.get(QueryCache.make_key("c", ["q2"], 3)) == {"i": 2}
+    assert cache.stats()["entries"] == 2
+
+def test_content_id_is_stable():
+    """
+    Tests that content IDs depend only on the prefix and the whitespace-normalized text.
+    """
+    assert content_id("doc", "A passage\nof text") == content_id("doc", "A  passage of text ")
+    assert content_id("doc", "A passage") != content_id("insight", "A passage")
+    assert content_id("doc", "A passage") != content_id("doc", "Another passage")
+
+def test_migrate_insight_ids_dedups_covered_passages(temp_db_path):
+    """
+    Tests that the migration collapses duplicate selections and relinks their insights, once.
+    """
+    book_id = "test_migrate_book"
+    db_handler = DBHandler(book_id=book_id)
+    db_handler.already_covered_db = db_handler.clear_collection("already_covered_db")
+    db_handler.current_chapter_insights_db = db_handler.clear_collection("current_chapter_insights_db")
+    if os.path.exists(insight_ids_marker_path(book_id)):
+        os.remove(insight_ids_marker_path(book_id))
+
+    # Rows as written by two sessions with differently salted hash() IDs
+    db_handler.add_to_collection(db_handler.already_covered_db, ["Decorators wrap functions."] * 2,
+                                 [{"source": "user_selection"}] * 2, ["doc_111", "doc_222"])
+    db_handler.add_to_collection(db_handler.current_chapter_insights_db, ["Insight one.", "Insight two."],
+                                 [{"source_doc_id": "doc_111"}, {"source_doc_id": "doc_222"}], ["insight_111", "insight_222"])
+
+    assert db_handler.migrate_insight_ids()
+
+    new_id = content_id("doc", "Decorators wrap functions.")
+    assert db_handler.already_covered_db.get()['ids'] == [new_id]
+    insights = db_handler.current_chapter_insights_db.get(include=["metadatas"])
+    assert [m["source_doc_id"] for m in insights['metadatas']] == [new_id, new_id]
+    assert os.path.exists(insight_ids_marker_path(book_id))
+
+def test_scoped_queries_still_find_rows_captured_before_positions(temp_db_path):
+    """
+    Tests that the migration marks rows without a position, and that scoped filters still match them.
+    """
+    book_id = "test_scope_fields_book"
+    db_handler = DBHandler(book_id=book_id)
+    covered = db_handler.already_covered_db = db_handler.clear_collection("already_covered_db")
+    insights = db_handler.current_chapter_insights_db = db_handler.clear_collection("current_chapter_insights_db")
+    if os.path.exists(scope_fields_marker_path(book_id)):
+        os.remove(scope_fields_marker_path(book_id))
+
+    db_handler.add_to_collection(covered, ["Legacy selection.", "Page 40 selection.", "Page 3 selection."],
+                                 [{"source": "user_selection"}, {"page_num": 40}, {"page_num": 3}], ["legacy", "far", "near"])
+    db_handler.add_to_collection(insights, ["Legacy insight.", "Chapter 2 insight."],
+                                 [{"source_doc_id": "legacy"}, {"chapter": 2}], ["legacy_insight", "chapter_insight"])
+
+    assert db_handler.migrate_scope_fields()
+    assert os.path.exists(scope_fields_marker_path(book_id))
+
+    matched = covered.get(where=include_unscoped(range_filter("page_num", 0, 5)))
+    assert sorted(matched["ids"]) == ["legacy", "near"]
+    matched = insights.get(where=include_unscoped({"chapter": 0}))
+    assert matched["ids"] == ["legacy_insight"]
+    assert include_unscoped(None) is None
+    db_handler.close()
+
+def test_hnsw_config_per_collection(temp_db_path):
+    """
+    Tests that collections get their configured HNSW settings and that search_ef can be retuned on reopen.
+    """
+    book_id = "test_hnsw_config_book"
+    db_handler = DBHandler(book_id=book_id)
+    config = db_handler.index_config(db_handler.full_text_source)
+    assert config["hnsw:space"] == "l2"
+    assert config["hnsw:M"] == db_handler.hnsw_config["full_text_source"]["hnsw:M"]
+    db_handler.close()
+
+    db_handler = DBHandler(book_id=book_id, hnsw_config={"full_text_source": {"hnsw:search_ef": 150}})
+    assert db_handler.index_config(db_handler.full_text_source)["hnsw:search_ef"] == 150
+    assert db_handler.index_config(db_handler.current_chapter_insights_db)["hnsw:search_ef"] == 10
+    db_handler.close()
+
+def test_hybrid_query_scoped_by_where(temp_db_path):
+    """
+    Tests that a page-range filter limits both the vector and the lexical results.
+    """
+    from db_handler import range_filter
+    db_handler = DBHandler(book_id="test_scoped_book")
+    db_handler.full_text_source = db_handler.clear_collection("full_text_source")
+    db_handler.upsert_to_collection(
+        db_handler.full_text_source,
+        [f"Decorators wrap functions, page {i}." for i in range(10)],
+        [{"page_num": i} for i in range(10)],
+        [f"p{i}" for i in range(10)]
+    )
+    db_handler.lexical_index.add([f"p{i}" for i in range(10)], [f"Decorators wrap functions, page {i}." for i in range(10)])
+
+    results = db_handler.hybrid_query("decorators", n_results=10, where=range_filter("page_num", 3, 5))
+
+    assert sorted(results['ids'][0]) == ["p3", "p4", "p5"]
+    db_handler.close()
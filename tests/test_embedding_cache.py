@@ -0,0 +1,76 @@
+import pytest
+from embedding_cache import EmbeddingCache
+
+class CountingEmbeddingFunction:
+    """A fake embedding function that records how many texts it embeds."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0, 0.5] for text in texts]
+
+@pytest.fixture
+def cache(tmp_path):
+    """An embedding cache in a temporary directory."""
+    cache = EmbeddingCache(str(tmp_path / "embedding_cache.sqlite3"), max_entries=10)
+    yield cache
+    cache.close()
+
+def test_cached_text_is_not_re_embedded(cache):
+    """
+    Tests that repeated text (including whitespace variants and in-batch duplicates) is embedded once.
+    """
+    ef = CountingEmbeddingFunction()
+
+    first = cache.embed(["license text", "chapter one", "license text"], ef, "model-a")
+    second = cache.embed(["license   text\n", "chapter two"], ef, "model-a")
+
+    assert ef.calls == [["license text", "chapter one"], ["chapter two"]]
+    assert first[0] == first[2] == second[0]
+    assert cache.hits == 2
+    assert cache.misses == 3
+
+def test_cache_is_keyed_by_model(cache):
+    """
+    Tests that the same text is embedded again for a different model.
+    """
+    ef = CountingEmbeddingFunction()
+    cache.embed(["same text"], ef, "model-a")
+    cache.embed(["same text"], ef, "model-b")
+
+    assert len(ef.calls) == 2
+
+def test_least_recently_used_entries_are_evicted(cache):
+    """
+    Tests that the cache stays bounded and keeps recently used entries.
+    """
+    ef = CountingEmbeddingFunction()
+    cache.embed([f"text {i}" for i in range(10)], ef, "model-a")
+    cache.get_many([cache.key("text 9", "model-a")])
+    cache.embed(["text 10"], ef, "model-a")
+
+    count = cache._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    assert count <= 10
+    assert cache.key("text 10", "model-a") in cache.get_many([cache.key("text 10", "model-a")])
+
+def test_writes_below_the_limit_do_not_count_rows(cache):
+    """
+    Tests that the row count is tracked on writes instead of scanning the table each time.
+    """
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    cache.embed(["one", "two", "three"], CountingEmbeddingFunction(), "model-a")
+    cache._conn.set_trace_callback(None)
+
+    assert not any("COUNT(*)" in statement for statement in statements)
+
+def test_local_and_default_embedding_functions_share_a_model_id():
+    """
+    Tests that the fp32 local embedding function keys the cache like ChromaDB's default, and int8 doesn't.
+    """
+    from db_handler import DEFAULT_EMBEDDING_MODEL_ID
+    from embeddings import LocalEmbeddingFunction
+
+    assert LocalEmbeddingFunction().model_id == DEFAULT_EMBEDDING_MODEL_ID
+    assert LocalEmbeddingFunction(quantized=True).model_id != DEFAULT_EMBEDDING_MODEL_ID
@@ -0,0 +1,108 @@
+import os
+import numpy as np
+from embedding_snapshot import EmbeddingSnapshot
+
+class FakeCollection:
+    """A stand-in ChromaDB collection for exporting snapshots."""
+    def __init__(self, ids, embeddings, documents, metadatas):
+        self.ids, self.embeddings, self.documents, self.metadatas = ids, embeddings, documents, metadatas
+
+    def count(self):
+        return len(self.ids)
+
+    def get(self, include=None, limit=None, offset=0):
+        end = offset + limit
+        return {
+            "ids": self.ids[offset:end],
+            "embeddings": self.embeddings[offset:end],
+            "documents": self.documents[offset:end],
+            "metadatas": self.metadatas[offset:end],
+        }
+
+def make_collection(n=50, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(n, dim)).astype(np.float32)
+    return FakeCollection(
+        [f"id{i}" for i in range(n)], embeddings,
+        [f"document {i} ✓" for i in range(n)], [{"page_num": i % 5} for i in range(n)]
+    )
+
+def test_export_query_matches_brute_force(tmp_path):
+    """
+    Tests that an exported snapshot returns the exact nearest neighbours by squared L2, with their documents.
+    """
+    collection = make_collection()
+    snapshot = EmbeddingSnapshot.export(collection, str(tmp_path / "snap"), model_id="m")
+    query = collection.embeddings[7] + 0.01
+
+    results = snapshot.query([query], n_results=3)
+
+    expected = np.argsort(((collection.embeddings - query) ** 2).sum(axis=1))[:3]
+    assert results["ids"][0] == [f"id{i}" for i in expected]
+    assert results["documents"][0][0] == "document 7 ✓"
+    assert np.isclose(results["distances"][0][0], ((collection.embeddings[7] - query) ** 2).sum(), atol=1e-4)
+
+    filtered = snapshot.query([query], n_results=3, where={"page_num": {"$in": [1, 3]}})
+    assert all(m["page_num"] in (1, 3) for m in filtered["metadatas"][0])
+
+def test_writes_survive_reload(tmp_path):
+    """
+    Tests that upserts and deletes are applied incrementally and persist, including past a torn append.
+    """
+    collection = make_collection(n=10)
+    path = str(tmp_path / "snap")
+    snapshot = EmbeddingSnapshot.export(collection, path, model_id="m")
+
+    new_vector = np.full(8, 5.0, dtype=np.float32)
+    snapshot.upsert(["id1", "new"], [new_vector, -new_vector], ["replaced", "added"], [{}, {}])
+    snapshot.delete(["id2"])
+    assert snapshot.live_count == 10
+    assert snapshot.query([new_vector], n_results=1)["ids"][0] == ["id1"]
+
+    # Simulate a crash part way through writing a row
+    with open(os.path.join(path, "rows.jsonl"), "a") as f:
+        f.write('{"id": "torn"')
+
+    reloaded = EmbeddingSnapshot.load(path, model_id="m")
+    assert reloaded.live_count == 10
+    assert reloaded.get(["id1", "id2", "new"])["documents"] == ["replaced", "added"]
+    assert EmbeddingSnapshot.load(path, model_id="other-model") is None
+
+def test_where_filters_match_chroma_semantics(tmp_path):
+    """
+    Tests range, set and boolean filters, and that rows without the field never match.
+    """
+    collection = make_collection(n=20)
+    collection.metadatas[3] = {}
+    snapshot = EmbeddingSnapshot.export(collection, str(tmp_path / "snap"), model_id="m")
+
+    in_range = {"$and": [{"page_num": {"$gte": 1}}, {"page_num": {"$lte": 2}}]}
+    assert snapshot.matching_ids(in_range) == {f"id{i}" for i in range(20) if i % 5 in (1, 2)}
+    assert "id3" not in snapshot.matching_ids({"page_num": {"$ne": 0}})
+    assert snapshot.matching_ids({"$or": [{"page_num": 0}, {"page_num": {"$in": [4]}}]}) == {
+        f"id{i}" for i in range(20) if i % 5 in (0, 4)
+    }
+
+    query = collection.embeddings[0]
+    results = snapshot.query([query], n_results=20, where=in_range)
+    assert len(results["ids"][0]) == 8
+
+def test_writes_by_another_instance_are_picked_up(tmp_path):
+    """
+    Tests that a snapshot notices rows appended by another process, and a re-export, instead of overwriting them.
+    """
+    collection = make_collection(n=10)
+    path = str(tmp_path / "snap")
+    first = EmbeddingSnapshot.export(collection, path, model_id="m")
+    second = EmbeddingSnapshot.load(path, model_id="m")
+
+    vector = np.full(8, 5.0, dtype=np.float32)
+    second.upsert(["added"], [vector], ["by the other process"], [{}])
+    first.upsert(["id1"], [-vector], ["replaced"], [{}])
+    assert first.get(["added", "id1"])["documents"] == ["by the other process", "replaced"]
+    assert EmbeddingSnapshot.load(path, model_id="m").live_count == 11
+
+    EmbeddingSnapshot.export(make_collection(n=3, seed=1), path, model_id="m")
+    assert first.live_count == 11
+    assert sorted(first.query([vector], n_results=5)["ids"][0]) == ["id0", "id1", "id2"]
+    assert first.live_count == 3
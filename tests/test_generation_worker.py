@@ -0,0 +1,72 @@
+import threading
+from generation_worker import GenerationWorker, PRIORITY_INTERACTIVE, plan_batches
+
+class FakeHandler:
+    """A stand-in LLMHandler that 'generates' the words of its prompt, one per token."""
+    def __init__(self):
+        self.ready = threading.Event()
+        self.prompts = []
+
+    def stream_response(self, prompt, max_new_tokens=150, prefix=None, stop_event=None):
+        self.prompts.append(prompt)
+        for word in prompt.split()[:max_new_tokens]:
+            if stop_event is not None and stop_event.is_set():
+                return
+            yield word + " "
+
+def test_interactive_jobs_run_before_background_jobs():
+    """
+    Tests that jobs queued while the model loads run by priority, then in submission order.
+    """
+    handler = FakeHandler()
+    worker = GenerationWorker(handler)
+    background = worker.submit("background job", priority=PRIORITY_INTERACTIVE + 10)
+    first = worker.submit("first chat", priority=PRIORITY_INTERACTIVE)
+    second = worker.submit(lambda: "second chat")
+    handler.ready.set()
+
+    assert background.future.result(5) == "background job"
+    assert first.future.result(5) == "first chat"
+    assert second.future.result(5) == "second chat"
+    assert handler.prompts == ["first chat", "second chat", "background job"]
+    worker.close()
+
+def test_cancel_stops_running_and_queued_jobs():
+    """
+    Tests that cancelling a running job keeps its partial text, and a queued job never starts.
+    """
+    handler = FakeHandler()
+    worker = GenerationWorker(handler)
+
+    jobs = []
+    pieces = []
+    def on_text(text):
+        pieces.append(text)
+        # Stop both jobs once the first token has been generated
+        for job in jobs:
+            job.cancel()
+
+    jobs.append(worker.submit("one two three four", on_text=on_text))
+    jobs.append(worker.submit("never generated"))
+    handler.ready.set()
+
+    running, queued = jobs
+    assert running.future.result(5) == "one"
+    assert pieces == ["one "] and running.stopped
+    assert queued.future.cancelled()
+    worker.close()
+    assert handler.prompts == ["one two three four"]
+
+def test_plan_batches_respects_the_token_budget():
+    """
+    Tests that prompts are batched shortest first, with each batch's padded size within the budget.
+    """
+    lengths = [5, 100, 7, 3, 50]
+    batches = plan_batches(lengths, max_new_tokens=10, token_budget=100)
+
+    assert batches == [[3, 0, 2], [4], [1]]
+    for batch in batches[:-1]:
+        assert len(batch) * (max(lengths[i] for i in batch) + 10) <= 100
+    # A prompt over the budget on its own still gets a batch
+    assert plan_batches([500], max_new_tokens=10, token_budget=100) == [[0]]
+    assert plan_batches(lengths, max_new_tokens=10, token_budget=10000, max_batch_size=2) == [[3, 0], [2, 4], [1]]
@@ -0,0 +1,150 @@
+import os
+import fitz
+import pytest
+from chunker import TextChunker
+from indexer import IndexManifest, PARALLEL_MIN_PAGES, chunk_hash, index_document, iter_pdf_units, iter_pdf_units_parallel, source_signature
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    """Path for a temporary manifest file."""
+    return str(tmp_path / "book.manifest.jsonl")
+
+def test_manifest_round_trip(manifest_path):
+    """
+    Tests that recorded and removed chunks survive reloading the manifest.
+    """
+    manifest = IndexManifest(manifest_path)
+    manifest.begin()
+    manifest.record([("a", chunk_hash("alpha", {"page_num": 0})), ("b", chunk_hash("beta", {"page_num": 1}))])
+    manifest.remove(["a"])
+
+    reloaded = IndexManifest(manifest_path)
+    assert list(reloaded.hashes) == ["b"]
+    assert reloaded.hashes["b"] == chunk_hash("beta", {"page_num": 1})
+    assert not reloaded.complete
+
+def test_manifest_ignores_torn_line(manifest_path):
+    """
+    Tests that a partially written final line (e.g. from a killed run) is skipped.
+    """
+    manifest = IndexManifest(manifest_path)
+    manifest.record([("a", "hash_a")])
+    with open(manifest_path, "a", encoding="utf-8") as f:
+        f.write('{"op": "set", "id": "b"')
+    manifest.record([("c", "hash_c")])
+
+    reloaded = IndexManifest(manifest_path)
+    assert reloaded.hashes == {"a": "hash_a", "c": "hash_c"}
+
+def test_manifest_compact_keeps_completion(tmp_path, manifest_path):
+    """
+    Tests that compaction preserves the chunk hashes and the completed source signature.
+    """
+    source = tmp_path / "book.pdf"
+    source.write_bytes(b"%PDF")
+
+    manifest = IndexManifest(manifest_path)
+    manifest.begin()
+    manifest.record([("a", "hash_a")])
+    manifest.mark_complete(source_signature(str(source)))
+    manifest.compact()
+
+    reloaded = IndexManifest(manifest_path)
+    assert reloaded.hashes == {"a": "hash_a"}
+    assert reloaded.is_current(str(source))
+
+def test_chunk_hash_depends_on_metadata():
+    """
+    Tests that the same text at a different location hashes differently.
+    """
+    assert chunk_hash("text", {"page_num": 1}) == chunk_hash("text", {"page_num": 1})
+    assert chunk_hash("text", {"page_num": 1}) != chunk_hash("text", {"page_num": 2})
+
+def test_parallel_pdf_extraction_matches_serial(tmp_path):
+    """
+    Tests that extracting a PDF across worker processes yields the same units, in the same order, as serial extraction.
+    """
+    pdf_path = str(tmp_path / "book.pdf")
+    with fitz.open() as doc:
+        for i in range(PARALLEL_MIN_PAGES + 6):
+            page = doc.new_page()
+            page.insert_text((72, 72), f"Page {i} opens with its own paragraph.")
+            page.insert_text((72, 300), f"A second block on page {i}, mentioning os.path.join.")
+        doc.save(pdf_path)
+
+    serial = list(iter_pdf_units(pdf_path, "book", TextChunker()))
+    parallel = list(iter_pdf_units_parallel(pdf_path, "book", TextChunker(), workers=2, pages_per_task=8))
+
+    assert len(serial) == PARALLEL_MIN_PAGES + 6
+    assert parallel == serial
+
+def _write_pdf(path, pages):
+    with fitz.open() as doc:
+        for text in pages:
+            doc.new_page().insert_text((72, 72), text)
+        doc.save(path)
+
+@pytest.fixture
+def indexed_book(tmp_path):
+    """A DBHandler with an empty full_text_source and no manifest or lexical index."""
+    from db_handler import DBHandler
+    db_handler = DBHandler(book_id="test_index_document_book")
+    db_handler.full_text_source = db_handler.clear_collection("full_text_source")
+    for path in (db_handler.manifest_path, db_handler.lexical_index_path):
+        if os.path.exists(path):
+            os.remove(path)
+    yield db_handler
+    db_handler.close()
+
+def test_index_document_writes_only_changes(tmp_path, indexed_book):
+    """
+    Tests that re-indexing skips unchanged chunks, upserts changed ones and deletes removed ones.
+    """
+    pdf_path = str(tmp_path / "book.pdf")
+    _write_pdf(pdf_path, ["Alpha page about decorators.", "Beta page about generators.", "Gamma page about closures."])
+    stats = index_document(indexed_book, pdf_path, "book")
+    assert (stats.chunks_indexed, stats.chunks_unchanged, stats.chunks_removed) == (3, 0, 0)
+    assert IndexManifest(indexed_book.manifest_path).is_current(pdf_path, indexed_book.full_text_source)
+
+    _write_pdf(pdf_path, ["Alpha page about decorators.", "Beta page, rewritten, about iterators."])
+    stats = index_document(indexed_book, pdf_path, "book")
+    assert (stats.chunks_indexed, stats.chunks_unchanged, stats.chunks_removed) == (1, 1, 1)
+
+    rows = indexed_book.full_text_source.get(include=["documents"])
+    assert dict(zip(rows["ids"], rows["documents"])) == {
+        "book_page_0_chunk_0": "Alpha page about decorators.",
+        "book_page_1_chunk_0": "Beta page, rewritten, about iterators.",
+    }
+
+def test_index_document_recovers_from_a_lost_collection(tmp_path, indexed_book):
+    """
+    Tests that a manifest whose collection was emptied is not trusted, and the book is fully re-indexed.
+    """
+    pdf_path = str(tmp_path / "book.pdf")
+    _write_pdf(pdf_path, ["Alpha page about decorators.", "Beta page about generators."])
+    index_document(indexed_book, pdf_path, "book")
+
+    indexed_book.full_text_source = indexed_book.clear_collection("full_text_source")
+    assert not IndexManifest(indexed_book.manifest_path).is_current(pdf_path, indexed_book.full_text_source)
+
+    stats = index_document(indexed_book, pdf_path, "book")
+    assert stats.chunks_indexed == 2
+    assert indexed_book.full_text_source.count() == 2
+
+def test_index_document_re_embeds_after_a_model_change(tmp_path, indexed_book):
+    """
+    Tests that a book indexed with one embedding model is fully re-embedded, not skipped as unchanged, under another.
+    """
+    pdf_path = str(tmp_path / "book.pdf")
+    _write_pdf(pdf_path, ["Alpha page about decorators.", "Beta page about generators."])
+    index_document(indexed_book, pdf_path, "book")
+    original_model_id = indexed_book.embedding_model_id
+
+    indexed_book.embedding_model_id = "other-model"
+    manifest = IndexManifest(indexed_book.manifest_path)
+    assert manifest.model_id == original_model_id
+    assert not manifest.is_current(pdf_path, indexed_book.full_text_source, "other-model")
+
+    stats = index_document(indexed_book, pdf_path, "book")
+    assert (stats.chunks_indexed, stats.chunks_unchanged) == (2, 0)
+    assert IndexManifest(indexed_book.manifest_path).is_current(pdf_path, indexed_book.full_text_source, "other-model")
@@ -0,0 +1,68 @@
+import pytest
+import insight_writer
+from insight_writer import InsightWriter
+
+class FakeHandler:
+    """A stand-in DBHandler that records upserts instead of writing to ChromaDB."""
+    def __init__(self, fail=False):
+        self.book_id = "book.pdf"
+        self.already_covered_db = "already_covered_db"
+        self.current_chapter_insights_db = "current_chapter_insights_db"
+        self.fail = fail
+        self.upserts = []
+
+    def upsert_to_collection(self, collection, documents, metadatas, ids):
+        if self.fail:
+            return False
+        self.upserts.append((collection, list(ids), list(documents)))
+        return True
+
+@pytest.fixture(autouse=True)
+def storage_root(tmp_path, monkeypatch):
+    """Keeps journals in a temporary directory."""
+    monkeypatch.setattr(insight_writer, "STORAGE_ROOT", str(tmp_path))
+
+def test_writes_are_coalesced_per_collection():
+    """
+    Tests that queued writes are flushed as one upsert per collection, with later writes to an ID winning.
+    """
+    handler = FakeHandler()
+    writer = InsightWriter(handler, max_delay=60)
+    writer.submit("already_covered_db", "first", {"source": "user_selection"}, "doc_1")
+    writer.submit("current_chapter_insights_db", "insight", {"source_doc_id": "doc_1"}, "insight_1")
+    writer.submit("already_covered_db", "first again", {"source": "user_selection"}, "doc_1")
+    writer.close()
+
+    assert sorted(handler.upserts) == [
+        ("already_covered_db", ["doc_1"], ["first again"]),
+        ("current_chapter_insights_db", ["insight_1"], ["insight"]),
+    ]
+    with open(writer.journal_path) as f:
+        assert f.read() == ""
+
+def test_unflushed_writes_are_replayed():
+    """
+    Tests that writes which failed before shutdown are replayed from the journal when the book is reopened.
+    """
+    writer = InsightWriter(FakeHandler(fail=True), max_delay=60)
+    writer.submit("already_covered_db", "kept", {"source": "user_selection"}, "doc_1")
+    writer.close()
+
+    handler = FakeHandler()
+    writer = InsightWriter(handler, max_delay=60)
+    writer.close()
+
+    assert handler.upserts == [("already_covered_db", ["doc_1"], ["kept"])]
+
+def test_writes_submitted_after_close_are_replayed():
+    """
+    Tests that a reply captured after its book was switched away from is journaled and written on reopen.
+    """
+    writer = InsightWriter(FakeHandler(), max_delay=60)
+    writer.close()
+    writer.submit("current_chapter_insights_db", "late reply", {"source_doc_id": "doc_1"}, "insight_1")
+
+    handler = FakeHandler()
+    InsightWriter(handler, max_delay=60).close()
+
+    assert handler.upserts == [("current_chapter_insights_db", ["insight_1"], ["late reply"])]
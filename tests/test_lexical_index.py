@@ -0,0 +1,56 @@
+from lexical_index import BM25Index, tokenize
+
+def test_tokenize_keeps_symbols_and_their_parts():
+    """
+    Tests that identifiers are indexed whole and by their sub-words.
+    """
+    terms = tokenize("Call os.path.join or getUserName")
+    assert "os.path.join" in terms
+    assert "join" in terms
+    assert "getusername" in terms
+    assert "user" in terms
+
+def test_exact_identifier_ranks_first():
+    """
+    Tests that a chunk containing an exact identifier outranks chunks that merely share words with it.
+    """
+    index = BM25Index()
+    index.add(
+        ["c1", "c2", "c3"],
+        [
+            "The connection was refused by the server.",
+            "Raises ERR_CONNECTION_REFUSED when the socket is closed.",
+            "Error handling for network code.",
+        ]
+    )
+
+    results = index.search("ERR_CONNECTION_REFUSED", n_results=3)
+
+    assert results[0][0] == "c2"
+
+def test_remove_and_replace_documents():
+    """
+    Tests that removed documents stop matching and re-added documents are replaced, not duplicated.
+    """
+    index = BM25Index()
+    index.add(["c1", "c2"], ["alpha beta", "beta gamma"])
+    index.add(["c1"], ["delta"])
+    index.remove(["c2"])
+
+    assert len(index) == 1
+    assert index.search("beta") == []
+    assert index.search("delta")[0][0] == "c1"
+
+def test_save_and_load_round_trip(tmp_path):
+    """
+    Tests that a saved index answers queries identically after loading.
+    """
+    path = str(tmp_path / "book.bm25.json")
+    index = BM25Index(path)
+    index.add(["c1", "c2"], ["def parse_args(argv): ...", "Parsing arguments from the command line."])
+    index.save()
+
+    loaded = BM25Index.load(path)
+
+    assert loaded.search("parse_args") == index.search("parse_args")
+    assert BM25Index.load(str(tmp_path / "missing.json")) is None
@@ -0,0 +1,27 @@
+from maintenance import select_expired_insights
+
+DAY = 86400
+NOW = 1000 * DAY
+
+def test_retention_by_age():
+    """
+    Tests that insights older than the age limit expire and insights without a timestamp are kept.
+    """
+    ids = ["old", "new", "legacy"]
+    metadatas = [{"created_at": NOW - 40 * DAY}, {"created_at": NOW - DAY}, {"source_doc_id": "doc_1"}]
+
+    assert select_expired_insights(metadatas, ids, max_age_days=30, now=NOW) == ["old"]
+
+def test_retention_per_chapter_keeps_newest():
+    """
+    Tests that only the newest insights of each chapter are kept.
+    """
+    ids = ["a1", "a2", "a3", "b1"]
+    metadatas = [
+        {"created_at": NOW - 3, "chapter": 0},
+        {"created_at": NOW - 1, "chapter": 0},
+        {"created_at": NOW - 2, "chapter": 0},
+        {"created_at": NOW - 9, "chapter": 1},
+    ]
+
+    assert select_expired_insights(metadatas, ids, max_per_chapter=2, now=NOW) == ["a1"]
@@ -0,0 +1,56 @@
+import json
+from qa_generator import _generate_round, done_chunk_ids, parse_qa, unparsed_path
+
+def test_parse_qa():
+    """
+    Tests that a question and answer are extracted from a reply, and malformed replies are rejected.
+    """
+    reply = "Sure!\nQuestion: What does os.path.join do?\nAnswer: It joins path parts\nwith the separator."
+    assert parse_qa(reply) == ("What does os.path.join do?", "It joins path parts\nwith the separator.")
+    assert parse_qa("question: Why? answer: Because.") == ("Why?", "Because.")
+    assert parse_qa("Just an answer with no question.") is None
+    assert parse_qa("Question: What?\nAnswer:") is None
+
+def test_done_chunk_ids_skips_a_torn_line(tmp_path):
+    """
+    Tests that resuming reads the chunk IDs already written, ignoring a torn final line.
+    """
+    output_path = tmp_path / "book.qa.jsonl"
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"question": "q", "answer": "a", "source_id": "chunk_1"}) + "\n")
+        f.write('{"question": "q", "answer": "a", "sour')
+
+    assert done_chunk_ids(str(output_path)) == {"chunk_1"}
+    assert done_chunk_ids(str(tmp_path / "missing.jsonl")) == set()
+
+class FakeHandler:
+    """A stand-in LLMHandler replying with canned text per passage."""
+    def __init__(self, replies):
+        self.replies = replies
+
+    def generate_batch(self, prompts, max_new_tokens=150):
+        return [self.replies[prompt.split("Passage:\n")[1].strip()] for prompt in prompts]
+
+def test_generate_round_appends_after_a_torn_line_and_records_unparsed_chunks(tmp_path):
+    """
+    Tests that new records start on a fresh line, and unparsed replies (but not errors) count as done.
+    """
+    output_path = str(tmp_path / "book.qa.jsonl")
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write('{"question": "q", "answer": "a", "sour')
+
+    handler = FakeHandler({
+        "good": "Question: What?\nAnswer: That.",
+        "rambling": "I'd rather not.",
+        "failed": "Error during text generation: out of memory",
+    })
+    chunks = [("chunk_good", "good", {}), ("chunk_rambling", "rambling", {}), ("chunk_failed", "failed", {})]
+    stats = {"chunks": 0, "pairs": 0, "unparsed": 0}
+    _generate_round(handler, chunks, output_path, {}, stats)
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        assert json.loads(f.read().splitlines()[1])["source_id"] == "chunk_good"
+    with open(unparsed_path(output_path), "r", encoding="utf-8") as f:
+        assert [json.loads(line)["source_id"] for line in f] == ["chunk_rambling"]
+    assert stats == {"chunks": 3, "pairs": 1, "unparsed": 1}
+    assert done_chunk_ids(output_path) == {"chunk_good", "chunk_rambling"}